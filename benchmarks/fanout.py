@@ -0,0 +1,173 @@
+"""
+Fan-out throughput, with the server and the clients in separate processes.
+Subscribers are spread over a number of channels and a single publisher
+sends messages to each channel in turn. Throughput is the number of messages
+delivered to all subscribers per second.
+
+Runs against a server started with the current code, or with --url against
+any already running WSPS server, e.g. an older version for comparison.
+"""
+
+import argparse
+import json
+import multiprocessing
+import socket
+from time import sleep, time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from benchmarks.util import Settings, get_logger, report
+
+
+def _serve(port, overrides):
+    from wspsserver.server import Server
+
+    settings = Settings()
+    settings.LISTEN_PORT = port
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    Server(settings, get_logger()).run()
+
+
+def _wait_for_port(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            sleep(0.05)
+
+    raise RuntimeError("Server did not start")
+
+
+def _subscribe(url, subscribers, channels, offset, expected, ready, results):
+    @gen.coroutine
+    def _receive(connection):
+        for _ in range(expected):
+            yield connection.read_message()
+        raise gen.Return(time())
+
+    @gen.coroutine
+    def _run():
+        connections = []
+        for index in range(subscribers):
+            connection = yield websocket_connect(url)
+            connection.write_message(json.dumps({
+                "type": "subscribe",
+                "channel": "bench-{}".format((offset + index) % channels)
+            }))
+            connections.append(connection)
+
+        # Give the subscriptions time to go through
+        yield gen.sleep(0.5)
+        ready.set()
+
+        finished = yield [_receive(connection) for connection in connections]
+        results.put(max(finished))
+
+    IOLoop.current().run_sync(_run, timeout=300)
+
+
+@gen.coroutine
+def _publish(url, messages, channels):
+    publisher = yield websocket_connect(url)
+    start = time()
+    for index in range(messages):
+        publisher.write_message(json.dumps({
+            "type": "publish",
+            "channel": "bench-{}".format(index % channels),
+            "data": {"index": index}
+        }))
+        if index % 100 == 0:
+            yield gen.moment
+    raise gen.Return(start)
+
+
+def add_arguments(parser):
+    """
+    Add the common command line arguments for fan-out benchmarks
+
+    :param argparse.ArgumentParser parser:
+    """
+
+    parser.add_argument("--subscribers", type=int, default=400)
+    parser.add_argument("--processes", type=int, default=4,
+                        help="Processes to spread the subscribers over")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=52600)
+
+
+def _measure(name, url, args):
+    context = multiprocessing.get_context("spawn")
+    per_process = args.subscribers // args.processes
+    expected = args.messages // args.channels
+    results = context.Queue()
+    clients = []
+
+    for index in range(args.processes):
+        ready = context.Event()
+        client = context.Process(target=_subscribe, args=(
+            url, per_process, args.channels, index * per_process,
+            expected, ready, results
+        ))
+        client.daemon = True
+        client.start()
+        clients.append((client, ready))
+
+    for client, ready in clients:
+        ready.wait()
+
+    start = IOLoop.current().run_sync(
+        lambda: _publish(url, args.messages, args.channels)
+    )
+    end = max(results.get() for _ in clients)
+
+    for client, _ in clients:
+        client.join()
+
+    delivered = per_process * args.processes * expected
+    report(name, delivered, end - start)
+
+
+def run(name, overrides, args, port):
+    """
+    Start a server with the settings overrides, and measure it
+
+    :param str name: Name for the results
+    :param dict overrides: Settings to change from the defaults
+    :param argparse.Namespace args: Command line arguments
+    :param int port: Port for the server to listen to
+    """
+
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=_serve, args=(port, overrides))
+    server.daemon = True
+    server.start()
+
+    try:
+        _wait_for_port(port)
+        _measure(name, "ws://127.0.0.1:{}/".format(port), args)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--url", default=None,
+                        help="Measure an already running server")
+    args = parser.parse_args()
+
+    if args.url:
+        _measure(args.url, args.url, args)
+    else:
+        run("current", {}, args, args.port)
+
+
+if __name__ == "__main__":
+    main()
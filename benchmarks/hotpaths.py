@@ -0,0 +1,364 @@
+"""
+Microbenchmarks for the ConnectionManager hot paths, driven with stand-in
+handlers without sockets or an IOLoop. Reports operations per second, and
+from a separate run with tracemalloc the bytes still allocated per operation
+and the peak memory allocated during the run.
+
+Results depend on the machine, so there is no shared baseline. Save one
+with --save before making changes, and compare to it afterwards. With
+--check the benchmark exits with an error if anything is slower than the
+baseline by more than the threshold.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.util import Handler, Settings, get_logger
+from wspsserver.auth import SettingsAuthManager
+from wspsserver.server import ConnectionManager
+
+BASELINE = os.path.join(os.path.dirname(__file__), "hotpaths.json")
+
+FANOUT_SIZES = (1, 100, 10000, 100000)
+
+
+def _get_manager(**overrides):
+    settings = Settings()
+    # Deliver everything right away, chunks would need an IOLoop
+    settings.FANOUT_CHUNK_SIZE = 0
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    return ConnectionManager(settings, get_logger())
+
+
+def _get_handlers(manager, count):
+    handlers = [
+        Handler("10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        for i in range(count)
+    ]
+    for handler in handlers:
+        manager.on_open(handler)
+
+    return handlers
+
+
+def bench_on_message(count):
+    """
+    Parse and dispatch publish packets to a channel with one subscriber
+    """
+
+    manager = _get_manager()
+    publisher, subscriber = _get_handlers(manager, 2)
+    manager._subscribe(subscriber, "bench", None)
+
+    message = json.dumps({
+        "type": "publish",
+        "channel": "bench",
+        "data": {"id": 1, "text": "x" * 100}
+    })
+
+    def run():
+        on_message = manager.on_message
+        for _ in range(count):
+            on_message(publisher, message)
+
+        return count
+
+    return run
+
+
+def bench_subscribe(count):
+    """
+    Subscribe connections to a channel each, over 1000 channels
+    """
+
+    manager = _get_manager()
+    handlers = _get_handlers(manager, count)
+    channels = ["channel-{}".format(i % 1000) for i in range(count)]
+
+    def run():
+        subscribe = manager._subscribe
+        for handler, channel in zip(handlers, channels):
+            subscribe(handler, channel, None)
+
+        return count
+
+    return run
+
+
+def _bench_fanout(subscribers):
+    """
+    Publish messages to a channel with the given number of subscribers
+    """
+
+    def bench(count):
+        manager = _get_manager()
+        publisher = _get_handlers(manager, 1)[0]
+        for handler in _get_handlers(manager, subscribers):
+            manager._subscribe(handler, "bench", None)
+
+        packet = {"type": "publish", "channel": "bench", "data": "x" * 100}
+        # Enough messages to time even the largest channels
+        messages = max(10, count // subscribers)
+
+        def run():
+            for _ in range(messages):
+                manager._message(publisher, "bench", packet, None)
+
+            return messages
+
+        return run
+
+    return bench
+
+
+def bench_on_close(count):
+    """
+    Close connections subscribed to 5 channels each
+    """
+
+    manager = _get_manager()
+    handlers = _get_handlers(manager, count)
+    for index, handler in enumerate(handlers):
+        for offset in range(5):
+            channel = "channel-{}".format((index + offset) % 1000)
+            manager._subscribe(handler, channel, None)
+
+    def run():
+        on_close = manager.on_close
+        for handler in handlers:
+            on_close(handler)
+
+        return count
+
+    return run
+
+
+def _get_auth_manager():
+    """
+    SettingsAuthManager with 10000 exact channel keys and 1000 wildcard keys
+    """
+
+    settings = Settings()
+    settings.SUBSCRIBE_KEYS = dict(
+        ("private-{}".format(i), "key-{}".format(i)) for i in range(10000)
+    )
+    settings.SUBSCRIBE_KEYS.update(
+        ("team-{}/*".format(i), "key-{}".format(i)) for i in range(1000)
+    )
+
+    return SettingsAuthManager(settings)
+
+
+def bench_authenticate_cold(count):
+    """
+    Check keys on channels that haven't been checked before, i.e. match them
+    against the whole key table
+    """
+
+    auth = _get_auth_manager()
+
+    # Exact matches, wildcard matches and channels without a key, every
+    # channel name used only once
+    channels = []
+    for i in range(0, count, 3):
+        channels.append(("private-{}".format(i % 10000), "key-{}".format(
+            i % 10000
+        )))
+        channels.append((
+            "team-{}/chat-{}".format(i % 1000, i), "key-{}".format(i % 1000)
+        ))
+        channels.append(("public-{}".format(i), None))
+
+    def run():
+        authenticate = auth.authenticate
+        for channel, key in channels:
+            if not authenticate("subscribe", channel, key):
+                raise RuntimeError("Authentication failed")
+
+        return len(channels)
+
+    return run
+
+
+def bench_authenticate_warm(count):
+    """
+    Check keys on the same 3000 channels over and over, i.e. from the cache
+    """
+
+    auth = _get_auth_manager()
+
+    channels = []
+    for i in range(0, 10000, 10):
+        channels.append(("private-{}".format(i), "key-{}".format(i)))
+        channels.append(("team-{}/chat".format(i // 10), "key-{}".format(
+            i // 10
+        )))
+        channels.append(("public-{}".format(i), None))
+
+    # Fill the cache before measuring
+    for channel, key in channels:
+        auth.authenticate("subscribe", channel, key)
+
+    def run():
+        authenticate = auth.authenticate
+        done = 0
+        while done < count:
+            for channel, key in channels:
+                if not authenticate("subscribe", channel, key):
+                    raise RuntimeError("Authentication failed")
+            done += len(channels)
+
+        return done
+
+    return run
+
+
+BENCHMARKS = [
+    ("on_message", bench_on_message, 50000),
+    ("subscribe", bench_subscribe, 20000),
+] + [
+    ("fanout_{}".format(size), _bench_fanout(size), 200000)
+    for size in FANOUT_SIZES
+] + [
+    ("on_close", bench_on_close, 20000),
+    # Every channel name used once up to 30000, misses the cache anyway
+    ("authenticate_cold", bench_authenticate_cold, 30000),
+    ("authenticate_warm", bench_authenticate_warm, 100000),
+]
+
+
+def measure(bench, count, repeat):
+    """
+    :param function bench: Sets up the benchmark, returns the function to
+                           measure, which returns the number of operations
+    :param int count: Size of the benchmark
+    :param int repeat: Number of timed runs, the fastest one counts
+    :return dict: ops_per_sec, bytes_per_op and peak_bytes
+    """
+
+    best = 0.0
+    for _ in range(repeat):
+        run = bench(count)
+        gc.collect()
+        start = perf_counter()
+        ops = run()
+        best = max(best, ops / (perf_counter() - start))
+
+    run = bench(count)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ops = run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": best,
+        "bytes_per_op": float(current - before) / ops,
+        "peak_bytes": peak - before,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    :param dict results: Name to measurement
+    :param dict baseline: Name to measurement
+    :param float threshold: Largest allowed slowdown, e.g. 0.2 for 20%
+    :return list: Names of the benchmarks slower than allowed
+    """
+
+    slower = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+
+        if result["ops_per_sec"] < expected["ops_per_sec"] * (1 - threshold):
+            slower.append(name)
+
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="File with the results to compare to")
+    parser.add_argument("--save", action="store_true",
+                        help="Save the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if slower than the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fail if slower than the baseline by more than "
+                             "this, e.g. 0.2 for 20%%")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply the number of operations")
+    parser.add_argument("--only", default=None,
+                        help="Only run benchmarks with this in the name")
+    args = parser.parse_args()
+
+    if args.save and args.check:
+        parser.error("--check compares to the baseline, it can't be used "
+                     "with --save, which replaces it")
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif args.check:
+        print("No baseline in {}, save one with --save first".format(
+            args.baseline
+        ))
+        sys.exit(2)
+
+    print("{:<18} {:>12} {:>10} {:>10} {:>8}".format(
+        "benchmark", "ops/s", "bytes/op", "peak KB", "change"
+    ))
+
+    results = {}
+    for name, bench, count in BENCHMARKS:
+        if args.only is not None and args.only not in name:
+            continue
+
+        result = results[name] = measure(
+            bench, max(1, int(count * args.scale)), args.repeat
+        )
+
+        change = ""
+        if name in baseline:
+            change = "{:+.1%}".format(
+                result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+            )
+
+        print("{:<18} {:>12.0f} {:>10.1f} {:>10.1f} {:>8}".format(
+            name,
+            result["ops_per_sec"],
+            result["bytes_per_op"],
+            result["peak_bytes"] / 1024.0,
+            change
+        ))
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved the baseline to {}".format(args.baseline))
+        return
+
+    slower = compare(results, baseline, args.threshold)
+    if slower and args.check:
+        print("Slower than the baseline by more than {:.0%}: {}".format(
+            args.threshold, ", ".join(slower)
+        ))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
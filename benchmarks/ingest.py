@@ -0,0 +1,120 @@
+"""
+Compare publish throughput over WebSockets against the ingest listener's Unix
+domain socket. Both publishers send to a single WebSocket subscriber through
+the same ConnectionManager, timing is from the first publish until the
+subscriber has received every message.
+"""
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+from time import time
+
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+from tornado.websocket import websocket_connect
+
+from benchmarks.util import Settings, get_logger, report
+from wspsserver.ingest import IngestServer, encode_frame
+from wspsserver.server import ConnectionManager, _get_handler
+
+
+def _packet(index):
+    return json.dumps({
+        "type": "publish",
+        "channel": "bench",
+        "data": {"index": index, "payload": "x" * 64}
+    })
+
+
+@gen.coroutine
+def _subscribe(url):
+    subscriber = yield websocket_connect(url)
+    subscriber.write_message(json.dumps({
+        "type": "subscribe",
+        "channel": "bench"
+    }))
+    # Round trip a message so we know the subscription is active
+    subscriber.write_message(_packet(-1))
+    yield subscriber.read_message()
+    raise gen.Return(subscriber)
+
+
+@gen.coroutine
+def _receive(subscriber, count):
+    for _ in range(count):
+        message = yield subscriber.read_message()
+        if message is None:
+            raise RuntimeError("Subscriber disconnected")
+
+
+@gen.coroutine
+def _websocket_publish(url, subscriber, count):
+    publisher = yield websocket_connect(url)
+    start = time()
+    for index in range(count):
+        publisher.write_message(_packet(index))
+    yield _receive(subscriber, count)
+    elapsed = time() - start
+    publisher.close()
+    raise gen.Return(elapsed)
+
+
+@gen.coroutine
+def _ingest_publish(path, subscriber, count):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    publisher = IOStream(sock)
+    yield publisher.connect(path)
+    start = time()
+    for index in range(count):
+        publisher.write(encode_frame(_packet(index)))
+    yield _receive(subscriber, count)
+    elapsed = time() - start
+    publisher.close()
+    raise gen.Return(elapsed)
+
+
+@gen.coroutine
+def run(count, rounds):
+    manager = ConnectionManager(Settings(), get_logger())
+
+    app = web.Application([(r'/', _get_handler(manager))])
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    HTTPServer(app).add_sockets(sockets)
+    url = "ws://127.0.0.1:{}/".format(port)
+
+    path = os.path.join(tempfile.mkdtemp(), "wsps-ingest.sock")
+    ingest = IngestServer(manager, Settings.INGEST_MAX_FRAME_BYTES)
+    ingest.listen_unix(path)
+
+    subscriber = yield _subscribe(url)
+
+    for _ in range(rounds):
+        elapsed = yield _websocket_publish(url, subscriber, count)
+        report("websocket publish", count, elapsed)
+
+        elapsed = yield _ingest_publish(path, subscriber, count)
+        report("ingest unix socket publish", count, elapsed)
+
+    subscriber.close()
+    ingest.stop()
+    os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    IOLoop.current().run_sync(lambda: run(args.count, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
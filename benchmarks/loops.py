@@ -0,0 +1,22 @@
+"""
+Compare fan-out throughput on the asyncio and uvloop event loops. Falls back
+to asyncio if uvloop isn't installed.
+"""
+
+import argparse
+
+from benchmarks.fanout import add_arguments, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--loops", nargs="+", default=["asyncio", "uvloop"])
+    args = parser.parse_args()
+
+    for index, loop in enumerate(args.loops):
+        run(loop, {"EVENT_LOOP": loop}, args, args.port + index)
+
+
+if __name__ == "__main__":
+    main()
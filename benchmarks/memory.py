@@ -0,0 +1,119 @@
+"""
+Measure memory used per idle connection and per subscription. Mock handlers
+are created before the baseline measurement, so only the server's own
+bookkeeping is counted. Exits with an error if the limits given on the
+command line are exceeded, for tracking regressions.
+"""
+
+import argparse
+import gc
+import sys
+
+from benchmarks.util import Handler, Settings, get_logger
+from wspsserver.server import ConnectionManager
+
+
+def get_rss():
+    """
+    Current resident set size of the process
+
+    :return int: RSS in bytes
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    # Peak RSS is the best we can do elsewhere, reported in bytes on OS X
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(connections, subscriptions, channels):
+    """
+    :return tuple: (bytes per connection, bytes per subscription)
+    """
+
+    manager = ConnectionManager(Settings(), get_logger())
+    handlers = [
+        Handler("10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        for i in range(connections)
+    ]
+    channel_names = ["channel-{}".format(i) for i in range(channels)]
+
+    gc.collect()
+    start = get_rss()
+
+    for handler in handlers:
+        manager.on_open(handler)
+
+    gc.collect()
+    opened = get_rss()
+
+    for index, handler in enumerate(handlers):
+        for offset in range(subscriptions):
+            channel = channel_names[(index + offset) % channels]
+            manager._subscribe(handler, channel, None)
+
+    gc.collect()
+    subscribed = get_rss()
+
+    per_connection = float(opened - start) / connections
+    if subscriptions:
+        per_subscription = float(subscribed - opened) / (
+            connections * subscriptions
+        )
+    else:
+        per_subscription = 0.0
+
+    return per_connection, per_subscription
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=200000)
+    parser.add_argument("--subscriptions", type=int, default=2,
+                        help="Subscriptions per connection")
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--max-per-connection", type=float, default=None,
+                        help="Fail if a connection uses more bytes")
+    parser.add_argument("--max-per-subscription", type=float, default=None,
+                        help="Fail if a subscription uses more bytes")
+    args = parser.parse_args()
+
+    per_connection, per_subscription = measure(
+        args.connections, args.subscriptions, args.channels
+    )
+
+    print("{} idle connections, {} subscriptions each".format(
+        args.connections, args.subscriptions
+    ))
+    print("{:>10.1f} bytes per connection".format(per_connection))
+    print("{:>10.1f} bytes per subscription".format(per_subscription))
+
+    failed = False
+    if args.max_per_connection is not None and \
+            per_connection > args.max_per_connection:
+        print("Per connection memory over {} bytes".format(
+            args.max_per_connection
+        ))
+        failed = True
+
+    if args.max_per_subscription is not None and \
+            per_subscription > args.max_per_subscription:
+        print("Per subscription memory over {} bytes".format(
+            args.max_per_subscription
+        ))
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
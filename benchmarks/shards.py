@@ -0,0 +1,25 @@
+"""
+Compare fan-out throughput with different numbers of shards (IOLoops).
+
+Sharding only helps on builds where threads can run in parallel, e.g. free
+threaded Python.
+"""
+
+import argparse
+
+from benchmarks.fanout import add_arguments, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    for index, shards in enumerate(args.shards):
+        run("{} shard(s)".format(shards), {"SHARDS": shards}, args,
+            args.port + index)
+
+
+if __name__ == "__main__":
+    main()
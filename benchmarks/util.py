@@ -0,0 +1,120 @@
+import logging
+
+
+class Settings(object):
+    """
+    Minimal settings for running a server inside a benchmark
+    """
+
+    AUTHORIZATION_MANAGER = "wspsserver.auth:NullAuthManager"
+    ALLOWED_CHANNELS = ("*",)
+    CONNECTION_RATE_LIMITS = {}
+    CHANNEL_RATE_LIMITS = {}
+    CONFLATE_CHANNELS = {}
+    DELTA_CHANNELS = {}
+    FANOUT_CHUNK_SIZE = 1000
+    FANOUT_TIME_BUDGET = 0.005
+    OUTBOUND_HIGH_WATER = 1024 * 1024
+    OUTBOUND_QUEUE_LIMIT = 1000
+    FLOW_CONTROL_HIGH_WATER = 16 * 1024 * 1024
+    FLOW_CONTROL_LOW_WATER = 8 * 1024 * 1024
+    FLOW_CONTROL_ACTION = "pause"
+    RATE_LIMIT_ACTION = "drop"
+    RATE_LIMIT_MAX_DELAY = 5.0
+    RATE_LIMIT_CLOSE_CODE = 1008
+    MAX_CONNECTIONS = 0
+    MAX_HANDSHAKES_PER_SECOND = 0
+    HANDSHAKE_BURST = 100
+    MAX_IOLOOP_LAG = 0
+    ADMISSION_RETRY_SECONDS = 5
+    PING_INTERVAL = 30
+    IDLE_TIMEOUT = 90
+    HEARTBEAT_TICK = 1.0
+    HEARTBEAT_WHEEL_SLOTS = 512
+    STATS_SECONDS = 60
+    LOG_SAMPLE_RATE = 10
+    LOG_SAMPLE_BURST = 100
+    CAPTURE_FILE = None
+    MAX_MESSAGE_BYTES = 1024 * 1024
+    MAX_SUBSCRIPTIONS = 1000
+    MAX_CHANNEL_LENGTH = 256
+    MAX_CHANNELS = 1000000
+    MAX_SESSIONS = 10000
+    SHARDS = 1
+    EVENT_LOOP = "asyncio"
+    DRAIN_SECONDS = 10
+    DRAIN_FLUSH_SECONDS = 2
+    DRAIN_BATCH_SIZE = 100
+    DRAIN_CLOSE_CODE = 1012
+    DRAIN_RECONNECT_JITTER = 30
+    PRESENCE_INTERVAL = 1.0
+    PRESENCE_IDS = False
+    ADMIN_KEY = None
+    ADMIN_ADDRESS = "127.0.0.1"
+    ADMIN_PORT = None
+    RELOAD_RECHECK_SUBSCRIPTIONS = False
+    SUBSCRIBE_KEYS = {}
+    PUBLISH_KEYS = {}
+    TOKEN_SECRET = None
+    TOKEN_CACHE_SIZE = 10000
+    LISTEN_ADDRESS = "127.0.0.1"
+    LISTEN_PORT = 52525
+    INGEST_UNIX_SOCKET = None
+    INGEST_ADDRESS = "127.0.0.1"
+    INGEST_PORT = None
+    INGEST_MAX_FRAME_BYTES = 1024 * 1024
+    DEBUG = False
+
+
+class Request(object):
+    __slots__ = ("remote_ip",)
+
+    def __init__(self, remote_ip):
+        self.remote_ip = remote_ip
+
+
+class Handler(object):
+    """
+    As small a stand-in for the WebSocket handler as possible, for driving a
+    ConnectionManager without sockets
+    """
+
+    __slots__ = ("request",)
+
+    def __init__(self, remote_ip):
+        self.request = Request(remote_ip)
+
+    def write_message(self, message):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def close(self, code=None, reason=None):
+        pass
+
+
+def get_logger():
+    """
+    Logger that stays quiet, so logging doesn't skew the results
+    """
+
+    logger = logging.getLogger("wsps-benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.CRITICAL)
+
+    return logger
+
+
+def report(name, count, elapsed):
+    """
+    Print a single result line
+    """
+
+    print("{name:<30} {count:>8} msgs {elapsed:>8.3f}s {rate:>10.0f}/s".format(
+        name=name,
+        count=count,
+        elapsed=elapsed,
+        rate=count / elapsed
+    ))
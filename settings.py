@@ -5,6 +5,42 @@ LISTEN_ADDRESS = "0.0.0.0"
 # Which port to subscribe to
 LISTEN_PORT = 52525
 
+# Optional local ingest listener for co-located publishers, which skips the
+# WebSocket handshake and framing. Clients send the same JSON packets as over
+# WebSockets, each prefixed with its length as a 4-byte big-endian integer.
+# INGEST_UNIX_SOCKET is a filesystem path, INGEST_PORT a plain TCP port, None
+# disables either one.
+INGEST_UNIX_SOCKET = None
+INGEST_ADDRESS = "127.0.0.1"
+INGEST_PORT = None
+
+# Largest frame accepted by the ingest listener, in bytes
+INGEST_MAX_FRAME_BYTES = 1024 * 1024
+
+# Limits for what a single client can do, so a buggy or malicious one can't
+# make the server parse huge messages or keep huge subscription lists.
+# MAX_MESSAGE_BYTES is the largest message accepted from clients, checked
+# before reading or parsing it. MAX_SUBSCRIPTIONS is per connection,
+# MAX_CHANNEL_LENGTH the longest channel name, and MAX_CHANNELS the number of
+# channels with subscribers on each shard. 0 disables a limit.
+MAX_MESSAGE_BYTES = 1024 * 1024
+MAX_SUBSCRIPTIONS = 1000
+MAX_CHANNEL_LENGTH = 256
+MAX_CHANNELS = 1000000
+
+# Logical sessions a single gateway connection can multiplex, see the
+# "session" field in the README. 0 for no limit.
+MAX_SESSIONS = 10000
+
+# Which event loop to run on, "asyncio" or "uvloop". uvloop is faster, but
+# needs to be installed separately (pip install uvloop).
+EVENT_LOOP = "asyncio"
+
+# Number of IOLoops to run, each in its own thread. Connections are spread
+# between them, and every IOLoop writes messages to its own connections. Only
+# useful on Python builds where threads can run in parallel.
+SHARDS = 1
+
 # List of what channels are valid, supports wildcards (*, ?) as per fnmatch
 # https://docs.python.org/2/library/fnmatch.html
 ALLOWED_CHANNELS = (
@@ -32,6 +68,171 @@ AUTHORIZATION_MANAGER = "wspsserver.auth:NullAuthManager"
 SUBSCRIBE_KEYS = {}
 PUBLISH_KEYS = {}
 
+# TokenAuthManager configuration
+#
+# If using wspsserver.auth:TokenAuthManager, clients send tokens created with
+# wspsserver.auth.make_token() as their key. TOKEN_SECRET is the secret the
+# tokens are signed with, shared with whatever creates them. Valid tokens are
+# cached, up to TOKEN_CACHE_SIZE of them.
+#
+TOKEN_SECRET = None
+TOKEN_CACHE_SIZE = 10000
+
+# ALLOWED_CHANNELS, AUTHORIZATION_MANAGER, the *_KEYS and TOKEN_* -settings
+# are reloaded from this file and local_settings.py on SIGHUP, without
+# dropping connections. If this is True, existing subscriptions are also
+# checked against the new rules, and the ones no longer allowed are removed.
+RELOAD_RECHECK_SUBSCRIPTIONS = False
+
+
+# Clients can ask how many subscribers a channel has with a presence packet,
+# and ask to be told about changes when subscribing. Changes are sent at most
+# once every PRESENCE_INTERVAL seconds. If PRESENCE_IDS is True, clients can
+# also ask for the connection ids of the subscribers.
+PRESENCE_INTERVAL = 1.0
+PRESENCE_IDS = False
+
+# Key required for the admin API at /admin/, sent in the X-Admin-Key header.
+# If ADMIN_PORT is set, the admin API is served only on that port, and
+# ADMIN_KEY is optional. With neither, the admin API is disabled.
+ADMIN_KEY = None
+ADMIN_ADDRESS = "127.0.0.1"
+ADMIN_PORT = None
+
+
+# Conflation for channels where only the latest message matters, e.g. price
+# tickers. A map from channel match (supports wildcards like
+# ALLOWED_CHANNELS) to an interval in seconds. Messages published on a
+# matching channel are held for the interval, and only the newest one is
+# sent. To keep the newest message for each value of a field in the message
+# data instead, use an (interval, field) -tuple, e.g.:
+# {"prices/*": (0.1, "symbol")}
+CONFLATE_CHANNELS = {}
+
+# Channels publishing a JSON document that changes a little at a time, e.g.
+# {"dashboards/*": 100}. Subscribers are sent a JSON patch against the
+# previous message instead of the whole message, and a full message every
+# 100 messages.
+DELTA_CHANNELS = {}
+
+
+# Messages to channels with more than FANOUT_CHUNK_SIZE subscribers on a
+# shard are written to FANOUT_CHUNK_SIZE subscribers at a time, spending up
+# to FANOUT_TIME_BUDGET seconds per IOLoop iteration, so other clients don't
+# have to wait for all of it. 0 writes to every subscriber right away.
+FANOUT_CHUNK_SIZE = 1000
+FANOUT_TIME_BUDGET = 0.005
+
+# When a client has more than OUTBOUND_HIGH_WATER bytes waiting to be
+# written to it, further messages are queued for it, up to
+# OUTBOUND_QUEUE_LIMIT of them. Queued messages are sent as the client catches
+# up, those with the highest "priority" first, and the ones past their "ttl"
+# are dropped. OUTBOUND_HIGH_WATER 0 writes everything right away,
+# OUTBOUND_QUEUE_LIMIT 0 drops the messages instead of queuing them.
+OUTBOUND_HIGH_WATER = 1024 * 1024
+OUTBOUND_QUEUE_LIMIT = 1000
+
+# When more than FLOW_CONTROL_HIGH_WATER bytes of messages to a channel are
+# waiting to be written to its subscribers, across all shards, publishers to
+# it are held back until it's down to FLOW_CONTROL_LOW_WATER bytes.
+# FLOW_CONTROL_ACTION "pause" stops reading from the publishers, "signal"
+# sends them a "flow" packet with status "slow", and "ok" once it's caught up.
+# 0 disables flow control.
+FLOW_CONTROL_HIGH_WATER = 16 * 1024 * 1024
+FLOW_CONTROL_LOW_WATER = 8 * 1024 * 1024
+FLOW_CONTROL_ACTION = "pause"
+
+
+# Rate limits
+#
+# CONNECTION_RATE_LIMITS apply to each client connection separately, and are
+# a map from limit name to a (rate per second, burst) -tuple. Valid limit
+# names are "publishes", "bytes" (published bytes) and "subscribes", e.g.:
+# {"publishes": (100, 200), "bytes": (100000, 200000)}
+#
+# CHANNEL_RATE_LIMITS apply to each channel separately, regardless of which
+# client is using it, or which of the SHARDS it's connected to. They're a map
+# from channel match (supports wildcards like ALLOWED_CHANNELS) to limits in
+# the same format as above.
+#
+CONNECTION_RATE_LIMITS = {}
+CHANNEL_RATE_LIMITS = {}
+
+# What to do when a client exceeds the rate limits: "drop" the packet,
+# "delay" processing it until the limits allow it, or "close" the connection
+RATE_LIMIT_ACTION = "drop"
+
+# With the "delay" action, packets that would need to wait longer than this
+# many seconds are dropped instead
+RATE_LIMIT_MAX_DELAY = 5.0
+
+# Close code for the "close" action
+RATE_LIMIT_CLOSE_CODE = 1008
+
+
+# Admission control, for shedding load e.g. during reconnect storms. New
+# clients are rejected with HTTP 503 and a Retry-After header before the
+# WebSocket upgrade when:
+#  - MAX_CONNECTIONS clients are already connected
+#  - More than MAX_HANDSHAKES_PER_SECOND new clients are connecting to all
+#    SHARDS together, with bursts of up to HANDSHAKE_BURST
+#  - Timers on the IOLoop are running more than MAX_IOLOOP_LAG seconds late
+# 0 disables the limit.
+MAX_CONNECTIONS = 0
+MAX_HANDSHAKES_PER_SECOND = 0
+HANDSHAKE_BURST = 100
+MAX_IOLOOP_LAG = 0
+
+# Rejected clients are asked to retry after a random time between this and
+# twice this many seconds
+ADMISSION_RETRY_SECONDS = 5
+
+
+# Heartbeats
+#
+# Clients that haven't sent anything in PING_INTERVAL seconds are pinged, and
+# clients that haven't sent anything or answered pings in IDLE_TIMEOUT
+# seconds are closed, to get rid of half-open connections. 0 disables them.
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+# Heartbeats are scheduled on a timer wheel, turning every HEARTBEAT_TICK
+# seconds and with HEARTBEAT_WHEEL_SLOTS slots. Timers are accurate to one
+# tick, and shouldn't generally need adjusting.
+HEARTBEAT_TICK = 1.0
+HEARTBEAT_WHEEL_SLOTS = 512
+
+
+# Graceful shutdown
+#
+# On SIGINT or SIGTERM the server stops accepting new clients, waits up to
+# DRAIN_FLUSH_SECONDS for pending messages to be written, and then closes
+# the connections in batches of DRAIN_BATCH_SIZE spread out over the rest of
+# DRAIN_SECONDS. A second signal stops the server immediately.
+DRAIN_SECONDS = 10
+DRAIN_FLUSH_SECONDS = 2
+DRAIN_BATCH_SIZE = 100
+
+# Close code sent to clients when draining, 1012 is "Service Restart"
+DRAIN_CLOSE_CODE = 1012
+
+# Before closing, clients are sent a {"type": "reconnect", "delay": ...}
+# packet, with a random delay of up to this many seconds, so they don't all
+# reconnect at once
+DRAIN_RECONNECT_JITTER = 30
+
+
+# Per-client log lines, e.g. for new connections or invalid packets, are
+# limited to LOG_SAMPLE_RATE lines per second for each kind of line, with
+# bursts of up to LOG_SAMPLE_BURST. Everything is still counted in the
+# statistics, and the number of lines left out is logged. 0 logs everything.
+LOG_SAMPLE_RATE = 10
+LOG_SAMPLE_BURST = 100
+
+# Record the connections and packets from clients to this file, for replaying
+# them later with "python -m wspsserver.replay". Keys are hashed and message
+# data is left out. None disables capturing.
+CAPTURE_FILE = None
 
 # How many seconds between showing connection statistics in the log
 STATS_SECONDS = 60
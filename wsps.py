@@ -1,11 +1,19 @@
 import logging
 from logging import NullHandler
-from time import sleep
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from wspsserver import Server
 import settings
 
 
 def _get_logger():
+    """
+    Log through a queue, so writing the logs happens in a background thread
+    instead of blocking the IOLoops
+
+    :return tuple: (logger, listener), the listener needs to be started
+    """
+
     # Disable logging from Tornado
     tornado = logging.getLogger("tornado")
     tornado.addHandler(NullHandler())
@@ -20,22 +28,19 @@ def _get_logger():
         logging.Formatter('%(asctime)s [%(levelname)8s] %(message)s')
     )
 
-    logger.addHandler(ch)
+    queue = Queue(-1)
+    logger.addHandler(QueueHandler(queue))
     logger.setLevel(logging.DEBUG)
 
-    return logger
+    return logger, QueueListener(queue, ch)
 
 
 if __name__ == "__main__":
-    logger = _get_logger()
-
-
-    server = Server(settings, logger)
+    logger, listener = _get_logger()
+    listener.start()
 
-    # TODO: Figure out why the hell I need a thread + this to stop IOLoop
     try:
-        server.start()
-        while True:
-            sleep(0.05)
-    except:
-        server.stop()
+        server = Server(settings, logger)
+        server.run()
+    finally:
+        listener.stop()
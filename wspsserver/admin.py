@@ -0,0 +1,212 @@
+import hmac
+from time import time
+
+from tornado import web
+
+
+class AdminHandler(web.RequestHandler):
+    """
+    wspsserver.admin.AdminHandler
+
+    Base class for the admin API. Requests need the ADMIN_KEY from settings
+    in the X-Admin-Key header, and responses are JSON. Query arguments end up
+    in access logs, so the key isn't accepted in them. Without ADMIN_KEY the
+    API is only served on ADMIN_PORT, and is open to anyone who can connect
+    to it.
+    """
+
+    def initialize(self, server):
+        """
+        :param wspsserver.server.Server server:
+        """
+
+        self.server = server
+
+    def prepare(self):
+        admin_key = self.server.settings.ADMIN_KEY
+        if not admin_key:
+            return
+
+        key = self.request.headers.get("X-Admin-Key", "")
+
+        if not hmac.compare_digest(
+                key.encode("utf-8"), admin_key.encode("utf-8")):
+            raise web.HTTPError(403)
+
+    def get_flag(self, name):
+        """
+        Read a boolean query argument
+
+        :param str name:
+        :return bool:
+        """
+
+        return self.get_query_argument(name, "") in ("1", "true", "yes")
+
+    def get_limit(self):
+        """
+        Read the limit query argument for lists
+
+        :return int:
+        """
+
+        try:
+            return max(0, int(self.get_query_argument("limit", "100")))
+        except ValueError:
+            raise web.HTTPError(400)
+
+
+class PresenceHandler(AdminHandler):
+    """
+    Number of subscribers on a channel, and optionally their connection ids
+    """
+
+    def get(self):
+        channel = self.get_query_argument("channel")
+        manager = self.server.manager
+
+        response = {
+            "channel": channel,
+            "count": manager.get_subscriber_count(channel)
+        }
+
+        if self.get_flag("ids"):
+            response["ids"] = manager.get_subscriber_ids(channel)
+
+        self.write(response)
+
+
+class ChannelsHandler(AdminHandler):
+    """
+    Channels with their subscriber counts and traffic, busiest first
+    """
+
+    def get(self):
+        now = time()
+        limit = self.get_limit()
+        managers = self.server.get_managers()
+
+        # Messages are counted on the shard they're published on, and
+        # subscribers on their own shards, so the busiest channels of each
+        # shard are added up over all of them
+        candidates = set()
+        for manager in managers:
+            candidates.update(manager.get_busiest_channels(now, limit))
+
+        channels = []
+        for channel in candidates:
+            total = {"channel": channel}
+            for manager in managers:
+                info = manager.get_channel_info(channel, now)
+                for name, value in (info or {}).items():
+                    total[name] = total.get(name, 0) + value
+            channels.append(total)
+
+        channels.sort(key=lambda info: (-info["rate"], info["channel"]))
+
+        if len(managers) == 1:
+            count = len(managers[0].channel_stats)
+        else:
+            count = len(set().union(*[
+                list(manager.channel_stats) for manager in managers
+            ]))
+
+        self.write({
+            "total": count,
+            "channels": channels[:limit]
+        })
+
+
+class ConnectionsHandler(AdminHandler):
+    """
+    Client connections with the most data waiting to be written first,
+    optionally only the subscribers of a channel
+    """
+
+    def get(self):
+        channel = self.get_query_argument("channel", None)
+        limit = self.get_limit()
+        connections = []
+        total = 0
+
+        for index, manager in enumerate(self.server.get_managers()):
+            if channel is None:
+                total += len(manager.connections)
+            else:
+                total += len(manager.channel_subscribers.get(channel, ()))
+
+            for handler in manager.get_backlogged_connections(limit, channel):
+                info = manager.get_connection_info(handler)
+                if info is not None:
+                    info["shard"] = index
+                    connections.append(info)
+
+        connections.sort(key=lambda info: (-info["write_buffer"], info["id"]))
+
+        self.write({
+            "total": total,
+            "connections": connections[:limit]
+        })
+
+
+class ConnectionHandler(AdminHandler):
+    """
+    A single client connection, DELETE disconnects it
+    """
+
+    def get(self, connection_id):
+        connection_id = int(connection_id)
+
+        for index, manager in enumerate(self.server.get_managers()):
+            handler = manager.handlers_by_id.get(connection_id)
+            if handler is None:
+                continue
+
+            info = manager.get_connection_info(handler)
+            if info is not None:
+                info["shard"] = index
+                self.write(info)
+                return
+
+        raise web.HTTPError(404)
+
+    def delete(self, connection_id):
+        connection_id = int(connection_id)
+
+        for manager in self.server.get_managers():
+            if manager.disconnect(connection_id):
+                self.set_status(204)
+                return
+
+        raise web.HTTPError(404)
+
+
+class ReloadHandler(AdminHandler):
+    """
+    Reload the channel rules and keys, same as SIGHUP
+    """
+
+    async def post(self):
+        if not await self.server.reload():
+            raise web.HTTPError(500)
+
+        self.write({"reloaded": True})
+
+
+def get_admin_handlers(server):
+    """
+    Routes for the admin API
+
+    :param wspsserver.server.Server server:
+    :return list:
+    """
+
+    options = {"server": server}
+
+    return [
+        (r"/admin/presence", PresenceHandler, options),
+        (r"/admin/channels", ChannelsHandler, options),
+        (r"/admin/connections", ConnectionsHandler, options),
+        (r"/admin/connections/([0-9]+)", ConnectionHandler, options),
+        (r"/admin/reload", ReloadHandler, options),
+    ]
@@ -0,0 +1,97 @@
+from math import ceil
+from random import uniform
+from threading import Lock
+
+from wspsserver.ratelimit import TokenBucket
+
+
+class AdmissionController(object):
+    """
+    wspsserver.admission.AdmissionController
+
+    Decides if new connections should be accepted, based on the number of
+    connected clients, the rate of new handshakes, and how far behind the
+    IOLoop is running. Limits set to 0 are disabled.
+    """
+
+    def __init__(self, max_connections, max_handshake_rate, handshake_burst,
+                 max_lag, retry_seconds, now):
+        self.max_connections = max_connections
+        self.max_lag = max_lag
+        self.retry_seconds = retry_seconds
+        self.lag = 0.0
+
+        if max_handshake_rate:
+            self.handshakes = TokenBucket(
+                max_handshake_rate, handshake_burst, now
+            )
+        else:
+            self.handshakes = None
+        # Replaced by share_handshakes()
+        self._lock = Lock()
+
+    def share_handshakes(self, other):
+        """
+        Use the same handshake rate limit as another controller, so the rate
+        applies to both together. Used for the controllers of the shards,
+        which run in different threads.
+
+        :param AdmissionController other:
+        """
+
+        self.handshakes = other.handshakes
+        self._lock = other._lock
+
+    def update_lag(self, lag):
+        """
+        Record a new IOLoop lag measurement. Increases are taken into account
+        immediately, decreases gradually so one quick iteration doesn't let a
+        flood of connections in.
+
+        :param float lag: How many seconds late a timer was run
+        """
+
+        if lag >= self.lag:
+            self.lag = lag
+        else:
+            self.lag = self.lag * 0.8 + lag * 0.2
+
+    def check(self, connections, now):
+        """
+        Check if a new connection should be accepted
+
+        :param int connections: Number of currently connected clients
+        :param float now: Current timestamp
+        :return tuple|None: None if the connection is accepted, otherwise a
+                            (reason, retry after seconds) -tuple
+        """
+
+        if self.max_connections and connections >= self.max_connections:
+            return "connections", self._retry_after(self.retry_seconds)
+
+        if self.max_lag and self.lag > self.max_lag:
+            return "lag", self._retry_after(self.retry_seconds)
+
+        if self.handshakes is not None:
+            with self._lock:
+                wait = self.handshakes.wait_time(1, now)
+                if wait <= 0:
+                    self.handshakes.consume(1)
+                    return None
+
+            return "handshakes", self._retry_after(
+                max(wait, self.retry_seconds)
+            )
+
+        return None
+
+    def _retry_after(self, seconds):
+        """
+        Spread retries over time, so rejected clients don't all come back at
+        once
+
+        :param float seconds: Minimum time to wait
+        :return int: Seconds the client should wait before retrying
+        """
+
+        return int(ceil(seconds * uniform(1, 2)))
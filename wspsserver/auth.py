@@ -1,4 +1,23 @@
-from fnmatch import fnmatch
+import base64
+import hashlib
+import hmac
+import json
+from time import time
+
+from wspsserver.rules import PatternTable
+
+
+_NO_MATCH = object()
+
+# Limit for cached decisions per KeyGrant
+_MAX_CACHED_DECISIONS = 1000
+
+# Limit for cached channel lookups per TokenGrant, there can be
+# TOKEN_CACHE_SIZE of them
+_MAX_CACHED_TOKEN_LOOKUPS = 100
+
+# Longer keys aren't tokens, so they're rejected without verifying them
+_MAX_TOKEN_LENGTH = 4096
 
 
 class BaseAuthManager(object):
@@ -25,6 +44,57 @@ class BaseAuthManager(object):
             "Your auth manager seems to be rather incomplete"
         )
 
+    def get_grant(self, key):
+        """
+        Get the permissions for a key a client authenticated its connection
+        with. Override this if your auth manager can work out everything the
+        key allows up front.
+
+        :param str key: Key the client submitted
+        :return KeyGrant|None: None if the key is not valid at all
+        """
+
+        return KeyGrant(self, key)
+
+
+class KeyGrant(object):
+    """
+    wspsserver.auth.KeyGrant
+
+    The permissions for a key, for auth managers that can only check one
+    event and channel at a time. Decisions are cached, so each one is only
+    made once per connection.
+    """
+
+    __slots__ = ("auth_manager", "key", "expires", "_decisions")
+
+    def __init__(self, auth_manager, key):
+        self.auth_manager = auth_manager
+        self.key = key
+        self.expires = None
+        self._decisions = {}
+
+    def allows(self, event, channel):
+        """
+        Check if the key allows the event on the channel
+
+        :param str event: "publish" or "subscribe"
+        :param str channel: The name of the channel
+        :return bool:
+        """
+
+        try:
+            return self._decisions[(event, channel)]
+        except KeyError:
+            pass
+
+        decision = self.auth_manager.authenticate(event, channel, self.key)
+        if len(self._decisions) >= _MAX_CACHED_DECISIONS:
+            self._decisions.clear()
+        self._decisions[(event, channel)] = decision
+
+        return decision
+
 
 class NullAuthManager(BaseAuthManager):
     """
@@ -49,22 +119,235 @@ class SettingsAuthManager(BaseAuthManager):
 
     If there is no key defined for the channel, it's assumed ok. Limiting valid
     channels has a separate setting.
+
+    The keys are compiled into lookup tables when the manager is created, so
+    changes to the settings take effect when it's replaced on reload.
     """
 
+    def __init__(self, settings):
+        super(SettingsAuthManager, self).__init__(settings)
+        self._keys = {
+            "subscribe": PatternTable(settings.SUBSCRIBE_KEYS),
+            "publish": PatternTable(settings.PUBLISH_KEYS),
+        }
+
     def authenticate(self, event, channel, key):
-        if event == "subscribe":
-            channel_keys = self.settings.SUBSCRIBE_KEYS
-        elif event == "publish":
-            channel_keys = self.settings.PUBLISH_KEYS
-        else:
+        try:
+            channel_keys = self._keys[event]
+        except KeyError:
             raise ValueError("Invalid event type {}".format(event))
 
-        for match in channel_keys:
-            if match == channel or fnmatch(channel, match):
-                # If the channel matches, the key must match
-                return channel_keys[match] == key
+        valid_key = channel_keys.lookup(channel, _NO_MATCH)
 
         # If there's no channel match, it's all good
-        return True
+        if valid_key is _NO_MATCH:
+            return True
+
+        # If the channel matches, the key must match
+        return valid_key == key
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(secret, payload):
+    if not isinstance(secret, bytes):
+        secret = secret.encode("utf-8")
+
+    return hmac.new(secret, payload.encode("ascii"), hashlib.sha256).digest()
+
+
+def make_token(secret, subscribe=(), publish=(), expires=None):
+    """
+    Create a token for TokenAuthManager, e.g. in your application backend
+
+    :param str secret: Same as TOKEN_SECRET in the server settings
+    :param list subscribe: Channels (fnmatch -style wildcards are ok) the
+                           token allows subscribing to
+    :param list publish: Channels the token allows publishing to
+    :param float expires: Timestamp after which the token is no longer valid,
+                          None for never
+    :return str:
+    """
+
+    payload = _b64encode(json.dumps({
+        "subscribe": list(subscribe),
+        "publish": list(publish),
+        "exp": expires,
+    }).encode("utf-8"))
+
+    return "{}.{}".format(payload, _b64encode(_sign(secret, payload)))
+
+
+class TokenGrant(object):
+    """
+    wspsserver.auth.TokenGrant
+
+    The permissions carried by a verified token.
+    """
+
+    __slots__ = ("expires", "_channels")
+
+    def __init__(self, subscribe, publish, expires):
+        """
+        :param list subscribe: Channels allowed to subscribe to
+        :param list publish: Channels allowed to publish to
+        :param float expires: Expiry timestamp, None for never
+        """
+
+        self.expires = expires
+        self._channels = {
+            "subscribe": PatternTable(subscribe, _MAX_CACHED_TOKEN_LOOKUPS),
+            "publish": PatternTable(publish, _MAX_CACHED_TOKEN_LOOKUPS),
+        }
+
+    def is_expired(self, now):
+        """
+        :param float now: Current timestamp
+        :return bool:
+        """
+
+        return self.expires is not None and now >= self.expires
+
+    def allows(self, event, channel):
+        """
+        Check if the grant allows the event on the channel, ignoring expiry
+
+        :param str event: "publish" or "subscribe"
+        :param str channel: The name of the channel
+        :return bool:
+        """
+
+        try:
+            channels = self._channels[event]
+        except KeyError:
+            raise ValueError("Invalid event type {}".format(event))
+
+        return channels.matches(channel)
+
+
+class TokenAuthManager(BaseAuthManager):
+    """
+    wspsserver.auth.TokenAuthManager
+
+    Authentication with signed tokens, created with make_token() by something
+    that knows TOKEN_SECRET, e.g. your application backend. The token carries
+    the channels it allows subscribing and publishing to, and when it expires,
+    so the server doesn't need to know about individual clients.
+
+    Valid tokens are verified once, and the grants decoded from them are
+    cached for their lifetime in a cache of up to TOKEN_CACHE_SIZE tokens, so
+    checking a token again is a couple of dictionary lookups. Invalid tokens
+    aren't cached, so clients can't fill the cache with them.
+    """
+
+    def __init__(self, settings):
+        super(TokenAuthManager, self).__init__(settings)
+
+        if not settings.TOKEN_SECRET:
+            raise ValueError("TokenAuthManager requires TOKEN_SECRET")
+
+        self.secret = settings.TOKEN_SECRET
+        self.cache_size = settings.TOKEN_CACHE_SIZE
+        self._grants = {}
+
+    def authenticate(self, event, channel, key):
+        grant = self.get_grant(key)
+        if grant is None:
+            return False
+
+        return grant.allows(event, channel)
+
+    def get_grant(self, token, now=None):
+        """
+        Verify the token, or find it in the cache
+
+        :param str token:
+        :param float now: Current timestamp
+        :return TokenGrant|None: None if the token is not valid
+        """
+
+        if not isinstance(token, str) or not token or \
+                len(token) > _MAX_TOKEN_LENGTH:
+            return None
+
+        if now is None:
+            now = time()
+
+        # Cached by the signature, which is short and unique to the token
+        payload, _, signature = token.rpartition(".")
+
+        cached = self._grants.get(signature)
+        if cached is not None and cached[0] == payload:
+            grant = cached[1]
+        else:
+            grant = self._verify(token, now)
+            if grant is None:
+                return None
+            self._cache(signature, payload, grant, now)
+
+        if grant.is_expired(now):
+            return None
+
+        return grant
+
+    def _verify(self, token, now):
+        """
+        :return TokenGrant|None:
+        """
+
+        try:
+            payload, signature = token.split(".")
+            signature = _b64decode(signature)
+            expected = _sign(self.secret, payload)
+        except (AttributeError, ValueError, TypeError):
+            return None
+
+        if not hmac.compare_digest(signature, expected):
+            return None
+
+        try:
+            data = json.loads(_b64decode(payload).decode("utf-8"))
+            expires = data.get("exp")
+            if expires is not None:
+                expires = float(expires)
+
+            grant = TokenGrant(
+                data.get("subscribe", ()),
+                data.get("publish", ()),
+                expires
+            )
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+        return grant
+
+    def _cache(self, signature, payload, grant, now):
+        """
+        Cache the grant of a valid token
+
+        :param str signature: Signature part of the token
+        :param str payload: Payload part of the token
+        :param TokenGrant grant:
+        :param float now: Current timestamp
+        """
+
+        grants = self._grants
+
+        if len(grants) >= self.cache_size:
+            for cached in list(grants):
+                if grants[cached][1].is_expired(now):
+                    del grants[cached]
 
+            # Make some room by dropping the oldest ones, so this doesn't
+            # have to be done again for every new token
+            oldest = list(grants)[:len(grants) - int(self.cache_size * 0.9)]
+            for cached in oldest:
+                del grants[cached]
 
+        grants[signature] = (payload, grant)
@@ -0,0 +1,195 @@
+import hashlib
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+# Identifies capture files, and the version of the format
+MAGIC = b"WSPSCAP1"
+
+# Timestamp, connection id, event, size in bytes, redacted key, length of the
+# channel name that follows
+_record = struct.Struct(">dIBIIH")
+
+OPEN = 0
+CLOSE = 1
+INVALID = 2
+SUBSCRIBE = 3
+PUBLISH = 4
+PRESENCE = 5
+AUTH = 6
+OTHER = 7
+
+_EVENTS = {
+    "subscribe": SUBSCRIBE,
+    "publish": PUBLISH,
+    "presence": PRESENCE,
+    "auth": AUTH,
+}
+
+CaptureRecord = namedtuple(
+    "CaptureRecord",
+    ("timestamp", "connection", "event", "size", "key", "channel")
+)
+
+
+def redact_key(key):
+    """
+    Replace a key with a short hash, so captures can tell keys apart without
+    containing them
+
+    :param str key:
+    :return int: 0 for no key
+    """
+
+    if not key:
+        return 0
+
+    if not isinstance(key, bytes):
+        key = str(key).encode("utf-8")
+
+    return struct.unpack(">I", hashlib.sha256(key).digest()[:4])[0] or 1
+
+
+class Capture(object):
+    """
+    wspsserver.capture.Capture
+
+    Records what clients send to a binary file, for reproducing production
+    load with wspsserver.replay. Only the type, channel, size and a hash of
+    the key of each packet are recorded, never the message data.
+
+    Records are packed into a buffer in memory, and written to the file in a
+    background thread when flush() is called, so the IOLoops don't wait for
+    the disk. Shards share a single capture.
+    """
+
+    # Flush at least this often, and when the buffer grows this large
+    flush_seconds = 1.0
+    flush_bytes = 256 * 1024
+
+    def __init__(self, path, now):
+        """
+        :param str path: File to write to, overwritten if it exists
+        :param float now: Current timestamp
+        """
+
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._buffer = bytearray()
+        self._lock = Lock()
+        self._writer = ThreadPoolExecutor(1)
+        self._next_flush = now + self.flush_seconds
+        self._closed = False
+
+    def record(self, now, connection, event, size=0, key=None, channel=""):
+        """
+        :param float now: Current timestamp
+        :param int connection: Connection id
+        :param int event: One of the event constants, e.g. PUBLISH
+        :param int size: Size of the packet in bytes
+        :param str key: Key sent with the packet, only a hash is recorded
+        :param str channel:
+        """
+
+        if not isinstance(channel, str):
+            channel = ""
+
+        name = channel.encode("utf-8")[:0xffff]
+        data = _record.pack(
+            now,
+            connection,
+            event,
+            min(size, 0xffffffff),
+            redact_key(key),
+            len(name)
+        ) + name
+
+        with self._lock:
+            self._buffer += data
+
+    def record_packet(self, now, connection, packet, size):
+        """
+        Record a packet sent by a client
+
+        :param float now: Current timestamp
+        :param int connection: Connection id
+        :param packet: The parsed packet
+        :param int size: Size of the packet in bytes
+        """
+
+        if not isinstance(packet, dict):
+            self.record(now, connection, INVALID, size)
+            return
+
+        self.record(
+            now,
+            connection,
+            _EVENTS.get(packet.get("type"), OTHER),
+            size,
+            packet.get("key"),
+            packet.get("channel", "")
+        )
+
+    def flush(self, now, force=False):
+        """
+        Hand the buffered records to the background writer if it's time
+
+        :param float now: Current timestamp
+        :param bool force: Flush even if it isn't time yet
+        :return concurrent.futures.Future: None if there was nothing to flush
+        """
+
+        if self._closed:
+            return None
+
+        if not force and now < self._next_flush and \
+                len(self._buffer) < self.flush_bytes:
+            return None
+
+        with self._lock:
+            data, self._buffer = self._buffer, bytearray()
+            self._next_flush = now + self.flush_seconds
+
+        if not data:
+            return None
+
+        return self._writer.submit(self._file.write, data)
+
+    def close(self, now):
+        """
+        Write out everything and close the file
+        """
+
+        self.flush(now, force=True)
+        self._closed = True
+        self._writer.shutdown(wait=True)
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Read the records from a capture file
+
+    :param str path:
+    :return generator: CaptureRecord for each record
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a WSPS capture file".format(path))
+
+        while True:
+            header = f.read(_record.size)
+            if len(header) < _record.size:
+                return
+
+            timestamp, connection, event, size, key, length = \
+                _record.unpack(header)
+            channel = f.read(length).decode("utf-8", "replace")
+
+            yield CaptureRecord(
+                timestamp, connection, event, size, key, channel
+            )
@@ -0,0 +1,43 @@
+from math import exp
+
+
+class ChannelStats(object):
+    """
+    wspsserver.channel.ChannelStats
+
+    Traffic counters for a channel, updated as messages are published. The
+    message rate is an exponentially decaying average over roughly `window`
+    seconds, updated lazily so it doesn't need any timers.
+    """
+
+    __slots__ = ("messages", "bytes", "_rate", "_updated")
+
+    # Seconds the message rate is averaged over
+    window = 10.0
+
+    def __init__(self, now):
+        self.messages = 0
+        self.bytes = 0
+        self._rate = 0.0
+        self._updated = now
+
+    def add(self, size, now):
+        """
+        Count a message published on the channel
+
+        :param int size: Size of the message in bytes
+        :param float now: Current timestamp
+        """
+
+        self.messages += 1
+        self.bytes += size
+        self._rate = self.get_rate(now) + 1 / self.window
+        self._updated = now
+
+    def get_rate(self, now):
+        """
+        :param float now: Current timestamp
+        :return float: Messages per second
+        """
+
+        return self._rate * exp(-(now - self._updated) / self.window)
@@ -0,0 +1,72 @@
+def get_write_buffer_size(stream):
+    """
+    Number of bytes written to a Tornado IOStream that are still waiting to
+    be sent. IOStream has no public API for this, so it's read from its
+    private counters, and if a Tornado upgrade changes them, this falls back
+    to 1 while the stream is writing. Flow control and the outbound queues
+    then only see that a client is busy, not how far behind it is.
+
+    :param tornado.iostream.IOStream stream:
+    :return int:
+    """
+
+    try:
+        return stream._total_write_index - stream._total_write_done_index
+    except AttributeError:
+        return 1 if stream.writing() else 0
+
+
+class ConnectionState(object):
+    """
+    wspsserver.connection.ConnectionState
+
+    Everything the server keeps track of for a single client connection. Uses
+    __slots__ to keep the per-connection overhead small, since most
+    connections spend most of their time idle.
+    """
+
+    __slots__ = (
+        "id",
+        "remote_ip",
+        "connected_at",
+        "subscriptions",
+        "auth_key",
+        "grant",
+        "last_activity",
+        "messages_in",
+        "bytes_in",
+        "versions",
+        "filters",
+        "sessions",
+        "session_channels",
+    )
+
+    def __init__(self, connection_id, remote_ip, now, heartbeat):
+        """
+        :param int connection_id: Unique id for the connection
+        :param str remote_ip: Address of the client
+        :param float now: Current timestamp
+        :param bool heartbeat: If the connection is pinged and closed when
+                               idle
+        """
+
+        self.id = connection_id
+        self.remote_ip = remote_ip
+        self.connected_at = now
+        # Map of channel to the key used to subscribe to it
+        self.subscriptions = {}
+        # Set by an auth packet, checked instead of keys in every packet
+        self.auth_key = None
+        self.grant = None
+        self.last_activity = now if heartbeat else None
+        self.messages_in = 0
+        self.bytes_in = 0
+        # Latest version written on each delta channel
+        self.versions = {}
+        # Map of channel to the filter expression for the subscription, for
+        # filtered subscriptions only
+        self.filters = {}
+        # For gateways multiplexing logical sessions, map of session id to
+        # Session, and of channel to [session ids, serialized list of them]
+        self.sessions = None
+        self.session_channels = None
@@ -0,0 +1,232 @@
+import json
+from itertools import count
+from threading import Lock
+from time import time
+
+from wspsserver.rules import PatternTable
+
+
+def _escape(key):
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(part):
+    return part.replace("~1", "/").replace("~0", "~")
+
+
+def diff(old, new, path=""):
+    """
+    Create a JSON patch (RFC 6902) that turns one JSON document into another.
+    Objects and arrays are compared recursively, arrays by position, so
+    inserting into the middle of an array replaces the rest of it.
+
+    :param old: Previous document
+    :param new: New document
+    :param str path: JSON pointer to the documents, for recursion
+    :return list: Patch operations
+    """
+
+    # Compare types too, so e.g. 1 and 1.0 or 1 and True are different
+    if type(old) is not type(new):
+        return [{"op": "replace", "path": path, "value": new}]
+
+    if isinstance(new, dict):
+        ops = []
+        for key, value in old.items():
+            pointer = path + "/" + _escape(key)
+            if key in new:
+                ops.extend(diff(value, new[key], pointer))
+            else:
+                ops.append({"op": "remove", "path": pointer})
+
+        for key, value in new.items():
+            if key not in old:
+                ops.append({
+                    "op": "add",
+                    "path": path + "/" + _escape(key),
+                    "value": value
+                })
+
+        return ops
+
+    if isinstance(new, list):
+        ops = []
+        for index, (before, after) in enumerate(zip(old, new)):
+            ops.extend(diff(before, after, "{}/{}".format(path, index)))
+
+        for value in new[len(old):]:
+            ops.append({"op": "add", "path": path + "/-", "value": value})
+
+        # Remove from the end, so the indexes stay valid
+        for index in range(len(old) - 1, len(new) - 1, -1):
+            ops.append({"op": "remove", "path": "{}/{}".format(path, index)})
+
+        return ops
+
+    if old == new:
+        return []
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def patch(document, ops):
+    """
+    Apply a JSON patch created by diff(). Modifies the document in place.
+
+    :param document: JSON document
+    :param list ops: Patch operations
+    :return: The patched document
+    """
+
+    for op in ops:
+        path = op["path"]
+        if path == "":
+            document = op["value"]
+            continue
+
+        parts = [_unescape(part) for part in path.split("/")[1:]]
+
+        target = document
+        for part in parts[:-1]:
+            target = target[int(part) if isinstance(target, list) else part]
+
+        last = parts[-1]
+        if isinstance(target, list):
+            if op["op"] == "add" and last == "-":
+                target.append(op["value"])
+            elif op["op"] == "add":
+                target.insert(int(last), op["value"])
+            elif op["op"] == "remove":
+                del target[int(last)]
+            else:
+                target[int(last)] = op["value"]
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = op["value"]
+
+    return document
+
+
+class DeltaMessage(object):
+    """
+    wspsserver.delta.DeltaMessage
+
+    A message published on a delta channel, serialized both as the full
+    message and as a patch against the previous message. Which one a
+    subscriber gets is decided when it's written to them.
+    """
+
+    __slots__ = ("version", "base", "full", "delta")
+
+    def __init__(self, version, base, full, delta):
+        """
+        :param int version: Version of the channel's state in this message
+        :param int base: Version the delta applies to
+        :param str full: Serialized full message
+        :param str delta: Serialized delta message, None to always send the
+                          full message
+        """
+
+        self.version = version
+        self.base = base
+        self.full = full
+        self.delta = delta
+
+    def __len__(self):
+        return len(self.full)
+
+
+class DeltaEncoder(object):
+    """
+    wspsserver.delta.DeltaEncoder
+
+    Keeps the latest data published on delta channels, and encodes new
+    messages as patches against it. Versions come from a single counter for
+    all channels, so they only ever grow even if a channel is forgotten, and
+    they're consistent when shared between shards.
+    """
+
+    # Channels nothing has been published on for this many seconds are
+    # forgotten by prune()
+    idle_seconds = 300.0
+
+    def __init__(self, channels):
+        """
+        :param dict channels: Map of channel match to how many messages to
+                              send between full snapshots
+        """
+
+        self.channels = PatternTable(channels)
+        self._states = {}
+        self._versions = count(1)
+        self._lock = Lock()
+
+    def encode(self, channel, packet, now=None):
+        """
+        Serialize a message packet, with a delta against the previous message
+        if the channel is a delta channel. Adds the "version" to the packet.
+
+        :param str channel:
+        :param dict packet: The message packet
+        :param float now: Current timestamp
+        :return DeltaMessage: None if the channel isn't a delta channel
+        """
+
+        snapshot_every = self.channels.lookup(channel)
+        if snapshot_every is None:
+            return None
+
+        data = packet.get("data")
+        if now is None:
+            now = time()
+
+        with self._lock:
+            version = next(self._versions)
+            previous = self._states.get(channel)
+            sequence = 1 if previous is None else previous[2] + 1
+            self._states[channel] = (version, data, sequence, now)
+
+        packet["version"] = version
+        full = json.dumps(packet)
+
+        if previous is None or sequence % snapshot_every == 0:
+            return DeltaMessage(version, None, full, None)
+
+        base = previous[0]
+        delta_packet = dict(packet)
+        delta_packet.pop("data", None)
+        delta_packet["type"] = "delta"
+        delta_packet["base"] = base
+        delta_packet["patch"] = diff(previous[1], data)
+        delta = json.dumps(delta_packet)
+
+        # Not worth it if the whole document changed
+        if len(delta) >= len(full):
+            delta = None
+
+        return DeltaMessage(version, base, full, delta)
+
+    def forget(self, channel):
+        """
+        Drop the state kept for a channel, its next message is sent in full
+
+        :param str channel:
+        """
+
+        with self._lock:
+            self._states.pop(channel, None)
+
+    def prune(self, now):
+        """
+        Forget the channels nothing has been published on for idle_seconds.
+        Shards share the encoder, and only it knows when a channel was last
+        published on any of them.
+
+        :param float now: Current timestamp
+        """
+
+        with self._lock:
+            for channel, state in list(self._states.items()):
+                if now - state[3] >= self.idle_seconds:
+                    del self._states[channel]
@@ -0,0 +1,247 @@
+import json
+import operator
+import re
+
+
+# Longest filter expression accepted, and how deep parentheses can be nested
+_MAX_LENGTH = 1000
+_MAX_DEPTH = 16
+
+_TOKENS = re.compile(r"""
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+        |(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+        |(?P<op>==|!=|<=|>=|<|>)
+        |(?P<punct>[()\[\],])
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z0-9_]+)*)
+    )
+""", re.VERBOSE)
+
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, options: value in options,
+}
+
+_CONSTANTS = {
+    "true": True,
+    "false": False,
+    "null": None,
+}
+
+_KEYWORDS = ("and", "or", "not", "in")
+
+
+def _tokenize(expression):
+    """
+    :param str expression:
+    :return list: (kind, value) -tuples
+    """
+
+    tokens = []
+    position = 0
+    end = len(expression.rstrip())
+
+    while position < end:
+        match = _TOKENS.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid filter at {}".format(position))
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value in _KEYWORDS:
+            kind = value
+
+        tokens.append((kind, value))
+        position = match.end()
+
+    return tokens
+
+
+def _get_field(path):
+    """
+    :param str path: Dotted path to a field, e.g. data.region
+    :return function: Getter for the field, returning None if it's missing
+    """
+
+    parts = path.split(".")
+
+    def get_field(packet):
+        value = packet
+        for part in parts:
+            if isinstance(value, dict):
+                value = value.get(part)
+            elif isinstance(value, list) and part.isdigit() and \
+                    int(part) < len(value):
+                value = value[int(part)]
+            else:
+                return None
+
+        return value
+
+    return get_field
+
+
+class _Parser(object):
+    """
+    Recursive descent parser for filter expressions, builds the filter out of
+    closures so evaluating it doesn't need to look at the expression again
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+
+        return None
+
+    def take(self, kind=None):
+        if self.position >= len(self.tokens):
+            raise ValueError("Unexpected end of filter")
+
+        token_kind, value = self.tokens[self.position]
+        if kind is not None and token_kind != kind:
+            raise ValueError("Expected {}, got {}".format(kind, value))
+
+        self.position += 1
+        return value
+
+    def parse(self):
+        result = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError("Unexpected {}".format(self.take()))
+
+        return result
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == "or":
+            self.take()
+            terms.append(self.parse_and())
+
+        if len(terms) == 1:
+            return terms[0]
+
+        return lambda packet: any(term(packet) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek() == "and":
+            self.take()
+            terms.append(self.parse_not())
+
+        if len(terms) == 1:
+            return terms[0]
+
+        return lambda packet: all(term(packet) for term in terms)
+
+    def parse_not(self):
+        if self.peek() == "not":
+            self.take()
+            term = self.parse_not()
+            return lambda packet: not term(packet)
+
+        return self.parse_term()
+
+    def parse_term(self):
+        if self.peek() == "punct" and self.tokens[self.position][1] == "(":
+            self.take()
+            self.depth += 1
+            if self.depth > _MAX_DEPTH:
+                raise ValueError("Filter is nested too deep")
+
+            term = self.parse_or()
+            if self.take("punct") != ")":
+                raise ValueError("Expected )")
+
+            self.depth -= 1
+            return term
+
+        get_field = _get_field(self.take("name"))
+
+        kind = self.peek()
+        if kind not in ("op", "in"):
+            # Just a field, matches if it's set to anything truthy
+            return lambda packet: bool(get_field(packet))
+
+        compare = _OPERATORS[self.take()]
+        if kind == "in":
+            expected = self.parse_list()
+        else:
+            expected = self.parse_value()
+
+        def term(packet):
+            try:
+                return compare(get_field(packet), expected)
+            except TypeError:
+                # E.g. comparing a string to a number
+                return False
+
+        return term
+
+    def parse_list(self):
+        if self.take("punct") != "[":
+            raise ValueError("Expected [")
+
+        values = []
+        while True:
+            if self.peek() == "punct" and \
+                    self.tokens[self.position][1] == "]" and not values:
+                self.take()
+                return values
+
+            values.append(self.parse_value())
+
+            separator = self.take("punct")
+            if separator == "]":
+                return values
+            if separator != ",":
+                raise ValueError("Expected , or ]")
+
+    def parse_value(self):
+        kind = self.peek()
+        value = self.take()
+
+        if kind in ("string", "number"):
+            return json.loads(value)
+        if kind == "name" and value in _CONSTANTS:
+            return _CONSTANTS[value]
+
+        raise ValueError("Expected a value, got {}".format(value))
+
+
+def compile_filter(expression):
+    """
+    Compile a filter expression into a function that checks if a message
+    packet matches it. Expressions compare fields of the packet to JSON
+    values, e.g.
+
+        data.region == "eu" and (data.level >= 3 or data.tags.0 in ["a", "b"])
+
+    Missing fields are null, and comparing values of different types, e.g.
+    strings to numbers, doesn't match.
+
+    :param str expression:
+    :return function: Takes the message packet dict, returns a bool
+    :raises ValueError: If the expression is invalid
+    """
+
+    if not isinstance(expression, str):
+        raise ValueError("Filter must be a string")
+
+    if len(expression) > _MAX_LENGTH:
+        raise ValueError("Filter is too long")
+
+    tokens = _tokenize(expression)
+    if not tokens:
+        raise ValueError("Filter is empty")
+
+    return _Parser(tokens).parse()
@@ -0,0 +1,171 @@
+import json
+import struct
+
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+from tornado.websocket import WebSocketClosedError
+
+from wspsserver.connection import get_write_buffer_size
+
+
+_header = struct.Struct(">I")
+
+
+def encode_frame(message):
+    """
+    Frame a serialized WSPS packet for the ingest listener. Frames are a 4 byte
+    big-endian length followed by that many bytes of JSON.
+
+    :param str message: The serialized WSPS packet
+    :return bytes:
+    """
+
+    if not isinstance(message, bytes):
+        message = message.encode("utf-8")
+
+    return _header.pack(len(message)) + message
+
+
+class IngestRequest(object):
+    """
+    Stand-in for the Tornado request, ConnectionManager only needs the address
+    """
+
+    def __init__(self, remote_ip):
+        self.remote_ip = remote_ip
+
+
+class IngestConnection(object):
+    """
+    wspsserver.ingest.IngestConnection
+
+    A client connected to the ingest listener. Provides the same interface as
+    the WebSocket handler, so ConnectionManager can treat both the same way.
+    """
+
+    def __init__(self, stream, remote_ip):
+        self.stream = stream
+        self.request = IngestRequest(remote_ip)
+        self.closing = False
+
+    def write_message(self, message):
+        """
+        Send a serialized WSPS packet to the client
+
+        :param str message:
+        """
+
+        if self.closing or self.stream.closed():
+            raise WebSocketClosedError()
+
+        self.stream.write(encode_frame(message))
+
+    def is_writing(self):
+        """
+        Check if there is data waiting to be written to the client
+
+        :return bool:
+        """
+
+        return self.stream.writing()
+
+    def get_write_buffer_size(self):
+        """
+        Number of bytes waiting to be written to the client
+
+        :return int:
+        """
+
+        return get_write_buffer_size(self.stream)
+
+    def close(self, code=None, reason=None):
+        """
+        Close the connection, telling the client why first
+
+        :param int code: Close code, same as for WebSockets
+        :param str reason: Human readable reason
+        """
+
+        if self.closing or self.stream.closed():
+            return
+
+        self.closing = True
+
+        packet = json.dumps({
+            "type": "close",
+            "code": code,
+            "reason": reason
+        })
+
+        try:
+            future = self.stream.write(encode_frame(packet))
+        except StreamClosedError:
+            return
+
+        future.add_done_callback(lambda f: self.stream.close())
+
+
+class IngestServer(TCPServer):
+    """
+    wspsserver.ingest.IngestServer
+
+    Listener for co-located publishers, skipping the WebSocket handshake,
+    framing and masking. Accepts the same packets as the WebSocket interface
+    and hands them to the same ConnectionManager.
+    """
+
+    def __init__(self, manager, max_frame_bytes, **kwargs):
+        super(IngestServer, self).__init__(**kwargs)
+        self.manager = manager
+        self.max_frame_bytes = max_frame_bytes
+
+    def listen_unix(self, path):
+        """
+        Start listening to a Unix domain socket
+
+        :param str path: Filesystem path for the socket
+        """
+
+        self.add_socket(bind_unix_socket(path))
+
+    async def handle_stream(self, stream, address):
+        """
+        Read frames from the client until the connection closes
+        """
+
+        if isinstance(address, tuple):
+            remote_ip = address[0]
+        else:
+            remote_ip = "unix"
+
+        connection = IngestConnection(stream, remote_ip)
+        # Local publishers are trusted to stay around while connected
+        self.manager.on_open(connection, heartbeat=False)
+
+        try:
+            while not connection.closing:
+                header = await stream.read_bytes(_header.size)
+                length, = _header.unpack(header)
+
+                # Empty frames are keepalives
+                if length == 0:
+                    continue
+
+                if length > self.max_frame_bytes:
+                    self.manager.stats["message_too_big"] += 1
+                    connection.close(1009, "Message too big")
+                    break
+
+                message = await stream.read_bytes(length)
+                # Stop reading while the publisher is held back
+                result = self.manager.on_message(connection, message)
+                if result is not None:
+                    await result
+        except StreamClosedError:
+            pass
+        finally:
+            if not connection.closing:
+                stream.close()
+
+            self.manager.on_close(connection)
@@ -0,0 +1,94 @@
+import logging
+from collections import defaultdict
+from time import time
+
+from wspsserver.ratelimit import TokenBucket
+
+
+class SampledLogger(object):
+    """
+    wspsserver.logs.SampledLogger
+
+    Logging for events that can happen for every client, e.g. connections
+    opening or clients sending invalid packets. Every event is counted, but
+    only up to `rate` lines per second (with bursts of up to `burst`) are
+    logged for each kind of event, so a reconnect storm or a misbehaving
+    client fleet can't flood the logs. The number of lines left out is logged
+    when flush() is called.
+
+    Messages are only formatted if they are logged.
+    """
+
+    def __init__(self, logger, counters, rate, burst):
+        """
+        :param logging.Logger logger:
+        :param dict counters: defaultdict(int) to count the events in
+        :param float rate: Lines per second per event, 0 for no limit
+        :param float burst: Lines allowed in a burst
+        """
+
+        self.logger = logger
+        self.counters = counters
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._suppressed = defaultdict(int)
+
+    def log(self, level, event, message, *args, **kwargs):
+        """
+        Count the event, and log it unless there's been too many of them
+
+        :param int level: Log level, e.g. logging.INFO
+        :param str event: Name of the event, used for the counter
+        :param str message: Message with str.format() -style placeholders
+        :param args: Values for the placeholders
+        :param bool exc_info: Include the current exception
+        """
+
+        self.counters[event] += 1
+
+        if not self.logger.isEnabledFor(level):
+            return
+
+        if self.rate:
+            now = time()
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                self._buckets[event] = bucket
+
+            if bucket.wait_time(1, now) > 0:
+                self._suppressed[event] += 1
+                return
+
+            bucket.consume(1)
+
+        self.logger.log(
+            level,
+            message.format(*args),
+            exc_info=kwargs.get("exc_info", False)
+        )
+
+    def debug(self, event, message, *args, **kwargs):
+        self.log(logging.DEBUG, event, message, *args, **kwargs)
+
+    def info(self, event, message, *args, **kwargs):
+        self.log(logging.INFO, event, message, *args, **kwargs)
+
+    def error(self, event, message, *args, **kwargs):
+        self.log(logging.ERROR, event, message, *args, **kwargs)
+
+    def flush(self):
+        """
+        Log how many lines were left out since the last flush
+        """
+
+        if not self._suppressed:
+            return
+
+        suppressed, self._suppressed = self._suppressed, defaultdict(int)
+
+        self.logger.warning("Suppressed log lines: {}".format(", ".join(
+            "{}={}".format(event, count)
+            for event, count in sorted(suppressed.items())
+        )))
@@ -0,0 +1,226 @@
+from threading import Lock
+
+from wspsserver.rules import PatternTable
+
+
+# Which limits apply to which events
+_EVENT_LIMITS = {
+    "publish": ("publishes", "bytes"),
+    "subscribe": ("subscribes",),
+}
+
+
+class TokenBucket(object):
+    """
+    wspsserver.ratelimit.TokenBucket
+
+    Classic token bucket, refilled at `rate` tokens per second up to `burst`
+    tokens. Refilling is done lazily when the bucket is checked, so there is
+    no need for timers.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def wait_time(self, cost, now):
+        """
+        How long until there are enough tokens for the cost
+
+        :param float cost: Number of tokens needed
+        :param float now: Current timestamp
+        :return float: Seconds to wait, 0 if tokens are available right away
+        """
+
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+
+        self.tokens = tokens
+        self.updated = now
+
+        if tokens >= cost:
+            return 0
+
+        return (cost - tokens) / self.rate
+
+    def consume(self, cost):
+        """
+        Take tokens from the bucket. This can go into debt, which delays any
+        following actions until it's paid back.
+
+        :param float cost: Number of tokens to take
+        """
+
+        self.tokens -= cost
+
+    def is_full(self, now):
+        """
+        Check if the bucket has refilled completely, i.e. has been idle
+
+        :param float now: Current timestamp
+        :return bool:
+        """
+
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+def _make_buckets(limits, now):
+    """
+    Create buckets for the limits configuration
+
+    :param dict limits: Map of limit name to (rate, burst)
+    :param float now: Current timestamp
+    :return dict: Map of limit name to TokenBucket
+    """
+
+    return dict(
+        (name, TokenBucket(rate, burst, now))
+        for name, (rate, burst) in limits.items()
+    )
+
+
+class RateLimiter(object):
+    """
+    wspsserver.ratelimit.RateLimiter
+
+    Keeps track of token buckets per connection and per channel.
+
+    Limits are maps from limit name ("publishes", "bytes" or "subscribes") to
+    a (rate per second, burst) -tuple. Channel limits are a map from channel
+    match (fnmatch -style wildcards are ok) to such limits, buckets are kept
+    separately for every channel matching the pattern.
+    """
+
+    def __init__(self, connection_limits, channel_limits):
+        self.connection_limits = connection_limits
+        self.channel_limits = PatternTable(channel_limits)
+        self.enabled = bool(connection_limits or channel_limits)
+
+        self._connection_buckets = {}
+        self._channel_buckets = {}
+        # Replaced by share_channels(), when shards share the channel limits
+        self._channel_lock = Lock()
+
+    def share_channels(self, other):
+        """
+        Use the same channel buckets as another limiter, so the channel
+        limits apply to both together. Used for the limiters of the shards,
+        which run in different threads.
+
+        :param RateLimiter other:
+        """
+
+        self._channel_buckets = other._channel_buckets
+        self._channel_lock = other._channel_lock
+
+    def acquire(self, handler, event, channel, size, max_wait, now):
+        """
+        Check the limits for an action, and take the tokens for it if it's
+        allowed to happen within max_wait seconds
+
+        :param handler: The client connection
+        :param str event: "publish" or "subscribe"
+        :param str channel: The name of the channel
+        :param int size: Size of the packet in bytes
+        :param float max_wait: How many seconds the action may be delayed
+        :param float now: Current timestamp
+        :return float: Seconds until the action may happen, if this is larger
+                       than max_wait, the action should not happen at all
+        """
+
+        groups = []
+
+        if self.connection_limits:
+            buckets = self._connection_buckets.get(handler)
+            if buckets is None:
+                buckets = _make_buckets(self.connection_limits, now)
+                self._connection_buckets[handler] = buckets
+            groups.append(buckets)
+
+        if not self.channel_limits:
+            return self._acquire(groups, event, size, max_wait, now)
+
+        with self._channel_lock:
+            buckets = self._get_channel_buckets(channel, now)
+            if buckets is not None:
+                groups.append(buckets)
+
+            return self._acquire(groups, event, size, max_wait, now)
+
+    def _acquire(self, groups, event, size, max_wait, now):
+        """
+        Take the tokens for an action from the buckets, see acquire()
+
+        :param list groups: Dicts of limit name to TokenBucket
+        :return float: Seconds until the action may happen
+        """
+
+        names = _EVENT_LIMITS[event]
+        wait = 0
+
+        for buckets in groups:
+            for name in names:
+                bucket = buckets.get(name)
+                if bucket is not None:
+                    cost = size if name == "bytes" else 1
+                    wait = max(wait, bucket.wait_time(cost, now))
+
+        if wait > max_wait:
+            return wait
+
+        for buckets in groups:
+            for name in names:
+                bucket = buckets.get(name)
+                if bucket is not None:
+                    bucket.consume(size if name == "bytes" else 1)
+
+        return wait
+
+    def forget(self, handler):
+        """
+        Drop the buckets for a closed connection
+
+        :param handler: The client connection
+        """
+
+        self._connection_buckets.pop(handler, None)
+
+    def prune(self, now):
+        """
+        Drop buckets for channels that have been idle long enough to refill,
+        so the number of buckets doesn't grow with every channel ever used
+
+        :param float now: Current timestamp
+        """
+
+        with self._channel_lock:
+            for channel in list(self._channel_buckets):
+                buckets = self._channel_buckets[channel]
+                if all(bucket.is_full(now) for bucket in buckets.values()):
+                    del self._channel_buckets[channel]
+
+    def _get_channel_buckets(self, channel, now):
+        """
+        Find the buckets for the channel, if it has limits configured
+
+        :param str channel: The name of the channel
+        :param float now: Current timestamp
+        :return dict|None:
+        """
+
+        buckets = self._channel_buckets.get(channel)
+        if buckets is not None:
+            return buckets
+
+        limits = self.channel_limits.lookup(channel)
+        if limits is None:
+            return None
+
+        buckets = _make_buckets(limits, now)
+        self._channel_buckets[channel] = buckets
+        return buckets
@@ -0,0 +1,200 @@
+"""
+Replay traffic recorded with CAPTURE_FILE against a WSPS server, e.g.
+
+    python -m wspsserver.replay capture.bin --url ws://127.0.0.1:52525/ -x 2
+
+Every captured connection is opened again, and sends the same kinds of
+packets on the same channels with the same sizes and timing, optionally
+sped up. Published data is filler, and keys aren't in the capture, so the
+server should allow everything, e.g. run with the default settings.
+"""
+
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+from time import time
+
+from tornado import gen
+from tornado.httpclient import HTTPClientError
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+from tornado.websocket import websocket_connect, WebSocketClosedError
+
+from wspsserver.capture import (
+    read_capture, CLOSE, OPEN, PRESENCE, PUBLISH, SUBSCRIBE
+)
+
+
+def make_packet(record):
+    """
+    Recreate a packet from a capture record
+
+    :param wspsserver.capture.CaptureRecord record:
+    :return str: Serialized packet, None if it isn't replayed
+    """
+
+    if record.event == SUBSCRIBE:
+        return json.dumps({"type": "subscribe", "channel": record.channel})
+
+    if record.event == PRESENCE:
+        return json.dumps({"type": "presence", "channel": record.channel})
+
+    if record.event == PUBLISH:
+        packet = {"type": "publish", "channel": record.channel, "data": ""}
+        padding = record.size - len(json.dumps(packet))
+        packet["data"] = "x" * max(0, padding)
+        return json.dumps(packet)
+
+    return None
+
+
+class ReplayConnection(object):
+    """
+    wspsserver.replay.ReplayConnection
+
+    A captured connection, sending its packets in order once it's connected
+    """
+
+    def __init__(self, url, stats):
+        """
+        :param str url: WebSocket URL of the server
+        :param dict stats: defaultdict(int) to count things in
+        """
+
+        self.url = url
+        self.stats = stats
+        self.queue = Queue()
+
+    async def run(self):
+        try:
+            connection = await websocket_connect(self.url)
+        except (OSError, IOError, HTTPClientError):
+            # Refused, or rejected by the server, e.g. 503 from admission
+            # control
+            self.stats["failed"] += 1
+            return
+
+        self.stats["connected"] += 1
+        IOLoop.current().spawn_callback(self._receive, connection)
+
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                break
+
+            try:
+                connection.write_message(message)
+            except WebSocketClosedError:
+                self.stats["closed_by_server"] += 1
+                return
+
+            self.stats["sent"] += 1
+
+        connection.close()
+
+    async def _receive(self, connection):
+        while await connection.read_message() is not None:
+            self.stats["received"] += 1
+
+
+class Replay(object):
+    """
+    wspsserver.replay.Replay
+
+    Replays capture records against a server
+    """
+
+    def __init__(self, url, speed=1.0):
+        """
+        :param str url: WebSocket URL of the server
+        :param float speed: How many times faster than captured to replay
+        """
+
+        self.url = url
+        self.speed = speed
+        self.stats = defaultdict(int)
+        self.connections = {}
+        self._tasks = []
+
+    def _open(self, connection_id):
+        connection = ReplayConnection(self.url, self.stats)
+        self.connections[connection_id] = connection
+        self._tasks.append(asyncio.ensure_future(connection.run()))
+        return connection
+
+    async def replay(self, records):
+        """
+        :param iterable records: CaptureRecords in the order they were
+                                 captured
+        :return dict: Statistics
+        """
+
+        loop = IOLoop.current()
+        start = loop.time()
+        first = None
+
+        for record in records:
+            if first is None:
+                first = record.timestamp
+
+            delay = (record.timestamp - first) / self.speed - \
+                (loop.time() - start)
+            if delay > 0:
+                await gen.sleep(delay)
+            else:
+                self.stats["max_lag"] = max(self.stats["max_lag"], -delay)
+
+            connection = self.connections.get(record.connection)
+
+            if record.event == OPEN:
+                self._open(record.connection)
+                continue
+
+            if record.event == CLOSE:
+                if connection is not None:
+                    del self.connections[record.connection]
+                    connection.queue.put_nowait(None)
+                continue
+
+            message = make_packet(record)
+            if message is None:
+                continue
+
+            # Connected before the capture was started
+            if connection is None:
+                connection = self._open(record.connection)
+
+            connection.queue.put_nowait(message)
+
+        for connection in self.connections.values():
+            connection.queue.put_nowait(None)
+        self.connections = {}
+
+        await gen.multi(self._tasks)
+        self.stats["elapsed"] = loop.time() - start
+
+        return dict(self.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("capture", help="File written with CAPTURE_FILE")
+    parser.add_argument("--url", default="ws://127.0.0.1:52525/")
+    parser.add_argument("-x", "--speed", type=float, default=1.0,
+                        help="Replay this many times faster than captured")
+    args = parser.parse_args()
+
+    replay = Replay(args.url, args.speed)
+    started = time()
+    stats = IOLoop.current().run_sync(
+        lambda: replay.replay(read_capture(args.capture))
+    )
+
+    print("Replayed {} in {:.3f}s".format(args.capture, time() - started))
+    for name, value in sorted(stats.items()):
+        print("{:<20} {}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import re
+from fnmatch import translate
+
+
+# Limit for cached lookups, so unique channel names can't grow the cache
+# forever
+_MAX_CACHED = 10000
+
+_WILDCARDS = re.compile(r"[*?\[]")
+
+_NO_MATCH = object()
+
+
+class PatternTable(object):
+    """
+    wspsserver.rules.PatternTable
+
+    Compiled lookup table from fnmatch -style channel patterns to values.
+    Patterns without wildcards are matched with a dictionary lookup, the rest
+    are combined into a single regular expression, and results are cached per
+    channel name. When several patterns match, the first one wins.
+
+    Tables are never modified after they're created, so they can be built
+    outside the IOLoop and swapped in atomically.
+    """
+
+    def __init__(self, patterns, cache_size=_MAX_CACHED):
+        """
+        :param dict|list patterns: Map of pattern to value, or a list of
+                                   patterns which all map to True
+        :param int cache_size: Most lookups to cache
+        """
+
+        if not hasattr(patterns, "items"):
+            patterns = dict((pattern, True) for pattern in patterns)
+
+        self._exact = {}
+        self._values = []
+        alternatives = []
+
+        for index, (pattern, value) in enumerate(patterns.items()):
+            self._values.append(value)
+
+            # Patterns always match themselves, even with wildcards in them
+            self._exact.setdefault(pattern, index)
+
+            if _WILDCARDS.search(pattern):
+                alternatives.append("(?P<p{}>{})".format(
+                    index, translate(pattern)
+                ))
+
+        if alternatives:
+            self._regex = re.compile("|".join(alternatives))
+        else:
+            self._regex = None
+
+        self._cache = {}
+        self._cache_size = cache_size
+
+    def __len__(self):
+        return len(self._values)
+
+    def lookup(self, channel, default=None):
+        """
+        Find the value for the first pattern matching the channel
+
+        :param str channel: The name of the channel
+        :param default: Value to return if nothing matches
+        :return:
+        """
+
+        index = self._cache.get(channel, _NO_MATCH)
+        if index is _NO_MATCH:
+            index = self._find(channel)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[channel] = index
+
+        if index is None:
+            return default
+
+        return self._values[index]
+
+    def matches(self, channel):
+        """
+        Check if any pattern matches the channel
+
+        :param str channel: The name of the channel
+        :return bool:
+        """
+
+        return self.lookup(channel, _NO_MATCH) is not _NO_MATCH
+
+    def _find(self, channel):
+        """
+        :return int|None: Index of the first matching pattern
+        """
+
+        index = self._exact.get(channel)
+
+        if self._regex is not None:
+            match = self._regex.match(channel)
+            if match is not None:
+                found = int(match.lastgroup[1:])
+                if index is None or found < index:
+                    index = found
+
+        return index
@@ -1,34 +1,37 @@
+import asyncio
 import signal
+import sys
 import importlib
-from fnmatch import fnmatch
+import importlib.util
 from copy import copy
 import json
+from math import ceil, isfinite
+from random import uniform
 from time import time
-import threading
+from itertools import count, islice
+from collections import defaultdict, deque
+from heapq import heapify, heappop, heappush, nlargest
 
 from tornado import websocket, web, ioloop
+from tornado.concurrent import Future
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
 from tornado.websocket import WebSocketClosedError
 
-
-_channel_subscribers = {}
-_connections = 0
-_is_closing = False
-_ioloop = None
-_periodic_callback = None
-
-
-def _signal_handler(signum, frame):
-    global _is_closing
-    _is_closing = True
-
-    print("Caught signal {}".format(signum))
-
-
-def _check_exit():
-    global _is_closing
-    if _is_closing:
-        print("Stopping IOLoop and periodic callback")
-        _ioloop.stop()
+from wspsserver.admin import get_admin_handlers
+from wspsserver.admission import AdmissionController
+from wspsserver.capture import Capture, CLOSE, INVALID, OPEN
+from wspsserver.channel import ChannelStats
+from wspsserver.connection import ConnectionState, get_write_buffer_size
+from wspsserver.delta import DeltaEncoder, DeltaMessage
+from wspsserver.filters import compile_filter
+from wspsserver.ingest import IngestServer
+from wspsserver.logs import SampledLogger
+from wspsserver.ratelimit import RateLimiter
+from wspsserver.rules import PatternTable
+from wspsserver.session import Session, add_field
+from wspsserver.shard import Shard, new_event_loop
+from wspsserver.timerwheel import TimerWheel
 
 
 def _load_auth_manager(settings):
@@ -70,49 +73,327 @@ def _load_auth_manager(settings):
     return auth_class(settings)
 
 
+def _load_fresh_settings(settings):
+    """
+    Load a new copy of the settings module from disk, without touching the
+    one in use
+
+    :param module settings: The application settings
+    :raises ValueError: If the settings are not a module that can be loaded
+    :return module:
+    """
+
+    spec = importlib.util.find_spec(getattr(settings, "__name__", ""))
+    if spec is None or spec.loader is None:
+        raise ValueError("Settings can't be reloaded from {}".format(
+            settings
+        ))
+
+    # Settings star-import local_settings, which would otherwise be cached
+    if "local_settings" in sys.modules:
+        importlib.reload(sys.modules["local_settings"])
+
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _compile_rules(settings):
+    """
+    Build the channel validator and auth manager for the settings. This can be
+    slow for large rule sets, so it's run outside the IOLoop on reload.
+
+    :param module settings: The application settings
+    :return tuple: (PatternTable, wspsserver.auth.BaseAuthManager)
+    """
+
+    return (
+        PatternTable(settings.ALLOWED_CHANNELS),
+        _load_auth_manager(settings)
+    )
+
+
+# Connection ids are unique across all the shards
+_connection_ids = count(1)
+
+# Settings replaced by Server.reload()
+RELOADABLE_SETTINGS = (
+    "ALLOWED_CHANNELS",
+    "AUTHORIZATION_MANAGER",
+    "SUBSCRIBE_KEYS",
+    "PUBLISH_KEYS",
+    "TOKEN_SECRET",
+    "TOKEN_CACHE_SIZE",
+    "RELOAD_RECHECK_SUBSCRIPTIONS",
+)
+
+
 class ConnectionManager(object):
     def __init__(self, settings, logger):
         self.settings = settings
         self.logger = logger
-        self.subscriptions = {}
-        self.auth_manager = _load_auth_manager(settings)
+        self.connections = {}
+        self.handlers_by_id = {}
+        # Connections multiplexing logical sessions, see _get_session
+        self._gateways = set()
+        self.channel_subscribers = {}
+        # Subscribers with a filter, grouped by the filter expression, see
+        # _filter_subscribers
+        self.channel_filters = {}
+        self.channel_stats = {}
+        self.channel_rules, self.auth_manager = _compile_rules(settings)
+        self.conflation = PatternTable(dict(
+            (match, value if isinstance(value, tuple) else (value, None))
+            for match, value in settings.CONFLATE_CHANNELS.items()
+        ))
+        self._conflated = {}
+        # Shared between the shards, see Server
+        self.delta = DeltaEncoder(settings.DELTA_CHANNELS)
+        # Set by Server when CAPTURE_FILE is set
+        self.capture = None
+        # Callbacks subscribed from Python code in the same process, see
+        # subscribe
+        self.local_subscribers = {}
+
+        # Messages being delivered to large channels in chunks, see
+        # _queue_fanout
+        self._fanout_jobs = {}
+        self._fanout_channels = deque()
+        self._fanout_scheduled = False
+
+        # Messages waiting for clients that are falling behind, see _send
+        self._outbound = {}
+        self._outbound_order = count()
+
+        # Bytes of messages waiting in the fan-out jobs and outbound queues
+        # above for each channel, and the publishers held back until they
+        # drain, see _flow_control
+        self._channel_backlog = {}
+        self._flow_paused = {}
+        self.rate_limiter = RateLimiter(
+            settings.CONNECTION_RATE_LIMITS,
+            settings.CHANNEL_RATE_LIMITS
+        )
+        self.stats = defaultdict(int)
+        self.log = SampledLogger(
+            logger,
+            self.stats,
+            settings.LOG_SAMPLE_RATE,
+            settings.LOG_SAMPLE_BURST
+        )
+        self.admission = AdmissionController(
+            settings.MAX_CONNECTIONS,
+            settings.MAX_HANDSHAKES_PER_SECOND,
+            settings.HANDSHAKE_BURST,
+            settings.MAX_IOLOOP_LAG,
+            settings.ADMISSION_RETRY_SECONDS,
+            time()
+        )
+        self.timers = TimerWheel(
+            settings.HEARTBEAT_TICK,
+            settings.HEARTBEAT_WHEEL_SLOTS,
+            time()
+        )
+        self._next_prune = time() + settings.STATS_SECONDS
+
+        # Clients watching channels for presence changes, and the changes
+        # since they were last told, see _send_presence
+        self.presence_watchers = {}
+        self._presence_changes = {}
+        self._presence_inbox = deque()
+        self._next_presence = time() + settings.PRESENCE_INTERVAL
 
-    @staticmethod
-    def reset():
+        # Managers for the other shards, and messages handed to this one
+        self.peers = []
+        self.loop = None
+        self._inbox = deque()
+        self._inbox_scheduled = False
+
+    def get_connections(self):
+        """
+        Number of clients connected to this manager
+        """
+        return len(self.connections)
+
+    def get_total_connections(self):
         """
-        Reset global values for testing purposes
+        Number of clients connected to all shards
         """
 
-        global _channel_subscribers, _connections
+        total = len(self.connections)
+        for peer in self.peers:
+            total += len(peer.connections)
 
-        _channel_subscribers = {}
-        _connections = 0
+        return total
 
-    def get_connections(self):
+    def get_channel_subscribers(self, channel):
         """
-        Provides access to the globals for tests
+        Provides access to the subscribers of a channel for tests
         """
-        return _connections
 
-    def get_channel_subscribers(self, channel):
+        return self.channel_subscribers[channel]
+
+    def get_subscriber_count(self, channel):
+        """
+        Number of clients subscribed to the channel on all shards
+
+        :param str channel:
+        :return int:
+        """
+
+        total = len(self.channel_subscribers.get(channel, ()))
+        for peer in self.peers:
+            total += len(peer.channel_subscribers.get(channel, ()))
+
+        return total
+
+    def get_subscriber_ids(self, channel):
+        """
+        Connection ids of the clients subscribed to the channel on all shards
+
+        :param str channel:
+        :return list:
+        """
+
+        ids = []
+        for manager in [self] + self.peers:
+            connections = manager.connections
+            for handler in list(manager.channel_subscribers.get(channel, ())):
+                state = connections.get(handler)
+                if state is not None:
+                    ids.append(state.id)
+
+        return ids
+
+    def get_channel_backlog(self, channel):
+        """
+        Bytes of messages to the channel waiting to be written to subscribers
+        on every shard
+
+        :param str channel:
+        :return int:
+        """
+
+        backlog = self._channel_backlog.get(channel, 0)
+        for peer in self.peers:
+            backlog += peer._channel_backlog.get(channel, 0)
+
+        return backlog
+
+    def publish(self, channel, data, priority=0, ttl=None):
+        """
+        Publish a message from Python code running in the same process, e.g.
+        a Tornado application the server is embedded in. Skips authorization
+        and rate limits, but otherwise the message is handled like one
+        published by a client, and it's only serialized once for all socket
+        subscribers. Must be called on this manager's IOLoop.
+
+        :param str channel:
+        :param data: Any JSON serializable data, copied when published
+        :param int priority: Higher priority messages are sent first to
+                             clients that are falling behind
+        :param float ttl: Seconds after which the message is dropped instead
+                          of sent, None for never
+        :raises ValueError: If the channel isn't a string, or the priority
+                            or ttl aren't finite numbers
+        :raises TypeError: If the data isn't JSON serializable
+        """
+
+        if not isinstance(channel, str):
+            raise ValueError("Channel must be a string")
+
+        priority, expires = _get_priority(priority, ttl)
+
+        # Parsing the serialized message gives a copy of the data exactly as
+        # clients will see it, e.g. with string keys, so the caller can
+        # modify theirs and publish it again
+        message = json.dumps(
+            {"type": "message", "channel": channel, "data": data}
+        )
+        packet = json.loads(message)
+
+        self.stats["local_published"] += 1
+
+        # Conflated and delta channels serialize the message later
+        if self.conflation.lookup(channel) is not None or \
+                self.delta.channels.lookup(channel) is not None:
+            self._publish_message(channel, packet, priority, expires)
+        else:
+            self._publish(channel, message, priority, expires, packet)
+
+    def subscribe(self, channel, callback):
+        """
+        Call a function with every message published on the channel, on any
+        shard. The callback gets the message packet as a dict, which is
+        shared with other subscribers and must not be modified. Callbacks are
+        run on this manager's IOLoop, and should return quickly.
+
+        :param str channel:
+        :param function callback: Takes the message packet dict
+        """
+
+        self.local_subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        """
+        Stop calling a function subscribed with subscribe()
+
+        :param str channel:
+        :param function callback:
+        """
+
+        callbacks = self.local_subscribers.get(channel)
+        if callbacks is None or callback not in callbacks:
+            return
+
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.local_subscribers[channel]
+
+    def check_admission(self):
         """
-        Provides access to the globals for tests
+        Called before a new connection is accepted, to shed load
+
+        :return int|None: None if the connection is accepted, otherwise the
+                          number of seconds the client should wait before
+                          retrying
         """
 
-        return _channel_subscribers[channel]
+        rejection = self.admission.check(self.get_total_connections(), time())
+        if rejection is None:
+            return None
 
-    def on_open(self, handler):
+        reason, retry_after = rejection
+        self.stats["rejected_" + reason] += 1
+
+        return retry_after
+
+    def on_open(self, handler, heartbeat=True):
         """
         Called when a new connection is opened by a client
+
+        :param bool heartbeat: If the connection should be pinged, and closed
+                               when idle
         """
 
-        global _connections
-        _connections += 1
+        heartbeat = heartbeat and bool(self.settings.PING_INTERVAL)
+        state = ConnectionState(
+            next(_connection_ids),
+            handler.request.remote_ip,
+            time(),
+            heartbeat
+        )
+        self.connections[handler] = state
+        self.handlers_by_id[state.id] = handler
+
+        if heartbeat:
+            self.timers.schedule(handler, self.settings.PING_INTERVAL)
 
-        self.subscriptions[handler] = []
+        if self.capture is not None:
+            self.capture.record(state.connected_at, state.id, OPEN)
 
-        self.logger.info("New client from {}".format(
-            handler.request.remote_ip)
+        self.log.info(
+            "clients_opened", "New client from {}", handler.request.remote_ip
         )
 
     def on_message(self, handler, message):
@@ -120,29 +401,62 @@ class ConnectionManager(object):
         Called when a client sends a message of any kind
 
         :param str message:
+        :return Future: Resolved when the client may send more, None if it
+                        can continue right away
         """
 
+        state = self.connections[handler]
+        state.messages_in += 1
+        state.bytes_in += len(message)
+        if state.last_activity is not None:
+            state.last_activity = time()
+
+        # Don't even parse messages that are too big, Tornado already refuses
+        # to read them, but ingest frames end up here
+        max_bytes = self.settings.MAX_MESSAGE_BYTES
+        if max_bytes and len(message) > max_bytes:
+            if self.capture is not None:
+                self.capture.record(time(), state.id, INVALID, len(message))
+
+            self.log.error(
+                "message_too_big",
+                "Client from {} sent a message of {} bytes",
+                handler.request.remote_ip,
+                len(message)
+            )
+            handler.close(1009, "Message too big")
+            return
+
         if self.settings.DEBUG:
             self.logger.debug("Client said: {}".format(message))
 
         try:
             packet = json.loads(message)
+            if not isinstance(packet, dict):
+                raise ValueError("Packet is not an object")
         except ValueError:
-            self.logger.exception(
-                "Client from {} sent an invalid message".format(
-                    handler.request.remote_ip
-                )
+            if self.capture is not None:
+                self.capture.record(time(), state.id, INVALID, len(message))
+
+            self.log.error(
+                "invalid_message",
+                "Client from {} sent an invalid message",
+                handler.request.remote_ip
             )
             handler.close(1002, "Invalid message")
             return
 
+        if self.capture is not None:
+            self.capture.record_packet(time(), state.id, packet, len(message))
+
         try:
-            self._process_packet(handler, packet)
+            return self._process_packet(handler, packet, len(message))
         except Exception:
-            self.logger.exception(
-                "Uncaught exception when processing message from {}".format(
-                    handler.request.remote_ip
-                )
+            self.log.error(
+                "packet_errors",
+                "Uncaught exception when processing message from {}",
+                handler.request.remote_ip,
+                exc_info=True
             )
             raise
 
@@ -151,286 +465,2141 @@ class ConnectionManager(object):
         Called when a client connection is closed
         """
 
-        global _connections
-        _connections -= 1
-
-        self.logger.info("Client from {} disconnected!".format(
+        self.log.info(
+            "clients_closed",
+            "Client from {} disconnected!",
             handler.request.remote_ip
-        ))
+        )
 
-        for channel in self.subscriptions[handler]:
-            if handler in _channel_subscribers[channel]:
-                _channel_subscribers[channel].remove(handler)
+        state = self.connections.pop(handler)
+        del self.handlers_by_id[state.id]
 
-    def _process_packet(self, handler, packet):
-        """
-        Handle WSPS packets
+        if self.capture is not None:
+            self.capture.record(time(), state.id, CLOSE)
 
-        :param dict packet: Data packet from the client
-        """
+        for channel in state.subscriptions:
+            self._remove_subscriber(channel, handler)
+        for channel, expression in state.filters.items():
+            self._remove_filter(handler, channel, expression)
 
-        try:
-            channel = packet["channel"]
-            if not self._is_channel_valid(channel):
-                self.logger.error(
-                    "Client from {} tried an invalid channel {}".format(
-                        handler.request.remote_ip,
-                        channel
-                    )
-                )
-                handler.close(1002, "Invalid channel")
-                return
+        if state.sessions is not None:
+            for session in list(state.sessions.values()):
+                self._end_session(session)
+            self._gateways.discard(handler)
 
-            # Extract and remove key from packet, so it doesn't
-            # accidentally # end up somewhere it shouldn't
-            key = None
-            if "key" in packet:
-                key = packet["key"]
-                del packet["key"]
+        self.rate_limiter.forget(handler)
+        self.timers.cancel(handler)
 
-            if packet["type"] == "subscribe":
-                self._subscribe(handler, channel, key)
-            elif packet["type"] == "publish":
-                self._message(handler, channel, packet, key)
-            else:
-                self.logger.error(
-                    "Client from {} sent an invalid message type {}".format(
-                        handler.request.remote_ip,
-                        packet["type"]
-                    )
-                )
-                handler.close(1002, "Invalid message type")
-        except KeyError:
-            self.logger.exception(
-                "Client from {} sent an invalid packet".format(
-                    handler.request.remote_ip
-                )
-            )
-            handler.close(1002, "Invalid message")
+        queue = self._outbound.pop(handler, None)
+        if queue:
+            for _, _, _, message, channel in queue:
+                self._add_backlog(channel, -len(message))
 
-    def _subscribe(self, handler, channel, key):
+        if self._flow_paused:
+            self._release_flow(handler)
+
+    def on_pong(self, handler):
+        """
+        Called when a client answers a ping
         """
-        Client is asking to subscribe to the given channel
 
-        :param str channel:
-        :param str key:
+        state = self.connections.get(handler)
+        if state is not None and state.last_activity is not None:
+            state.last_activity = time()
+
+    def periodic(self, now, lag):
         """
+        Called frequently by the IOLoop running this manager
 
-        if not self._authenticate("subscribe", channel, key):
-            self.logger.error(
-                "Client from {} failed subscribe authorization to {}".format(
-                    handler.request.remote_ip,
-                    channel
-                )
-            )
-            handler.close(1002, "Authorization failed")
-            return
+        :param float now: Current timestamp
+        :param float lag: How many seconds late the call was
+        """
 
-        if channel not in _channel_subscribers:
-            _channel_subscribers[channel] = []
+        self.admission.update_lag(lag)
+        self.heartbeat(now)
 
-        self.subscriptions[handler].append(channel)
-        _channel_subscribers[channel].append(handler)
+        if self._outbound:
+            self._flush_outbound(now)
 
-        if self.settings.DEBUG:
-            self.logger.debug(
-                "Client from {} subscribed to {}".format(
-                    handler.request.remote_ip,
-                    channel
-                )
-            )
+        if self._flow_paused:
+            self._check_flow()
+
+        if self.capture is not None:
+            self.capture.flush(now)
+
+        if now > self._next_prune:
+            self.rate_limiter.prune(now)
+            self._prune_channels(now)
+            self.log.flush()
+            self._next_prune = now + self.settings.STATS_SECONDS
 
-    def _authenticate(self, event, channel, key):
+        if now >= self._next_presence:
+            self._send_presence()
+            self._next_presence = now + self.settings.PRESENCE_INTERVAL
+
+    def _prune_channels(self, now):
         """
-        Check if the user has the permission to do things
+        Forget channels nobody is subscribed to, and that have been quiet for
+        a while
 
-        :param str event:
-        :param str channel:
-        :param str key:
-        :return bool:
+        :param float now: Current timestamp
         """
 
-        return self.auth_manager.authenticate(event, channel, key)
+        subscribers = self.channel_subscribers
+        for channel in [c for c, handlers in subscribers.items()
+                        if not handlers]:
+            del subscribers[channel]
 
-    def _is_channel_valid(self, channel):
-        """
-        Check if the given channel name is valid based on the configuration
+        for channel, stats in list(self.channel_stats.items()):
+            if channel not in subscribers and stats.get_rate(now) < 0.001:
+                del self.channel_stats[channel]
 
-        :param str channel: The name of the channel
-        :return bool:
+        self.delta.prune(now)
+
+    def get_busiest_channels(self, now, limit):
         """
+        Channels with the highest message rate on this manager, for the admin
+        API
 
-        for match in self.settings.ALLOWED_CHANNELS:
-            if fnmatch(channel, match):
-                return True
+        :param float now: Current timestamp
+        :param int limit: Most channels to return
+        :return list: Channel names, busiest first
+        """
 
-        return False
+        return [channel for channel, stats in nlargest(
+            limit,
+            list(self.channel_stats.items()),
+            key=lambda item: item[1].get_rate(now)
+        )]
 
-    def _message(self, handler, channel, packet, key):
+    def get_channel_info(self, channel, now):
         """
-        Send out a message to the channel
+        Subscriber count and traffic for a channel on this manager
 
         :param str channel:
-        :param dict packet: Original publish packet from client
-        :param str key:
+        :param float now: Current timestamp
+        :return dict|None: None if the channel isn't in use on this manager
         """
 
-        out_packet = copy(packet)
-        out_packet["type"] = "message"
-        message = json.dumps(out_packet)
-
-        if not self._authenticate("publish", channel, key):
-            self.logger.error(
-                "Client from {} failed publish authorization to {}".format(
-                    handler.request.remote_ip,
-                    channel
-                )
-            )
-            handler.close(1002, "Authorization failed")
+        stats = self.channel_stats.get(channel)
+        if stats is None:
+            return None
 
-        if self.settings.DEBUG:
-            self.logger.debug("Sending message from {} to channel {}".format(
-                handler.request.remote_ip,
-                channel
-            ))
+        return {
+            "subscribers": len(self.channel_subscribers.get(channel, ())),
+            "messages": stats.messages,
+            "bytes": stats.bytes,
+            "rate": stats.get_rate(now)
+        }
 
-        if channel in _channel_subscribers:
-            for subscriber in _channel_subscribers[channel]:
-                try:
-                    subscriber.write_message(message)
-                except WebSocketClosedError:
-                    self.logger.error("Error writing to client.")
+    def get_backlogged_connections(self, limit, channel=None):
+        """
+        Connections for the admin API, the ones with messages queued for them
+        first, most backlogged first, and then the rest in the order they
+        connected or subscribed
 
+        :param int limit: Most connections to return
+        :param str channel: Only the subscribers of this channel
+        :return list: Handlers
+        """
 
-def _get_handler(settings, logger):
-    """
-    Returns the WebSocket handler, giving it access to the settings
+        if channel is None:
+            candidates = self.connections
+            queued = list(self._outbound)
+        else:
+            candidates = self.channel_subscribers.get(channel, ())
+            connections = self.connections
+            queued = [
+                handler for handler in self._outbound
+                if channel in connections[handler].subscriptions
+            ]
+
+        handlers = nlargest(
+            limit, queued, key=lambda handler: handler.get_write_buffer_size()
+        )
 
-    :param module settings:
-    :return:
-    """
+        if len(handlers) < limit:
+            outbound = self._outbound
+            for handler in list(islice(
+                    candidates, limit - len(handlers) + len(queued))):
+                if handler not in outbound:
+                    handlers.append(handler)
 
-    manager = ConnectionManager(settings, logger)
+        return handlers[:limit]
 
-    class SocketHandler(websocket.WebSocketHandler):
+    def get_connection_info(self, handler):
         """
-        Handler for all communications over WebSockets
+        What's known about a client connection, for the admin API
+
+        :return dict|None: None if the client is no longer connected
         """
 
-        def check_origin(self, origin):
-            """
-            This is a security protection against cross site scripting attacks
-            on browsers, since WebSockets are allowed to bypass the usual
-            same-origin policies and don't use CORS headers.
+        state = self.connections.get(handler)
+        if state is None:
+            return None
+
+        return {
+            "id": state.id,
+            "remote_ip": state.remote_ip,
+            "connected_at": state.connected_at,
+            "subscriptions": list(state.subscriptions),
+            "messages_in": state.messages_in,
+            "bytes_in": state.bytes_in,
+            "write_buffer": handler.get_write_buffer_size(),
+            "sessions": len(state.sessions or ()),
+        }
+
+    def disconnect(self, connection_id, reason="Disconnected by admin"):
+        """
+        Close a client connection. Safe to call from any thread.
 
-            In the current system there is no need for this yet, thus we allow
-            all.
+        :param int connection_id:
+        :param str reason: Human readable reason sent to the client
+        :return bool: If the connection was found
+        """
 
-            :param origin:
-            :return:
-            """
+        handler = self.handlers_by_id.get(connection_id)
+        if handler is None:
+            return False
 
-            return True
+        self.stats["disconnected"] += 1
 
-        def open(self):
-            """
-            Called when a new connection is opened by a client
-            """
-            manager.on_open(self)
+        if self.loop is None or self.loop is ioloop.IOLoop.current():
+            handler.close(1008, reason)
+        else:
+            self.loop.add_callback(handler.close, 1008, reason)
 
-        def on_message(self, message):
-            """
-            Called when a client sends a message of any kind
+        return True
 
-            :param str message:
-            """
-            manager.on_message(self, message)
+    def heartbeat(self, now):
+        """
+        Called periodically to ping quiet clients, and close the ones that
+        have been idle for too long
 
-        def on_close(self):
-            """
-            Called when a client connection is closed
-            """
-            manager.on_close(self)
+        :param float now: Current timestamp
+        """
 
-    return SocketHandler
+        ping_interval = self.settings.PING_INTERVAL
+        idle_timeout = self.settings.IDLE_TIMEOUT
 
+        for handler in self.timers.advance(now):
+            idle = now - self.connections[handler].last_activity
 
-class Server(object):
-    """
-    Main manager for the server application
-    """
+            if idle_timeout and idle >= idle_timeout:
+                self.stats["idle_closed"] += 1
+                if self.settings.DEBUG:
+                    self.logger.debug(
+                        "Closing idle client from {}".format(
+                            handler.request.remote_ip
+                        )
+                    )
+                handler.close(1001, "Idle timeout")
+                continue
+
+            if idle < ping_interval:
+                self.timers.schedule(handler, ping_interval - idle)
+                continue
+
+            try:
+                handler.ping(b"")
+                self.stats["pings"] += 1
+            except WebSocketClosedError:
+                continue
+
+            if idle_timeout:
+                self.timers.schedule(
+                    handler, min(ping_interval, idle_timeout - idle)
+                )
+            else:
+                self.timers.schedule(handler, ping_interval)
 
-    def __init__(self, settings, logger):
-        self.settings = settings
-        self.logger = logger
+    async def reload(self, settings):
+        """
+        Switch to the channel rules and keys from new settings. The new rules
+        are compiled in a thread, and swapped in all at once, so every packet
+        is checked against either the old or the new rules.
 
-        handlers = [
-            (r'/', _get_handler(settings, logger))
-        ]
+        :param module settings: Freshly loaded application settings
+        """
 
-        self.app = web.Application(
-            handlers,
-            autoreload=settings.DEBUG,
-            debug=settings.DEBUG
+        loop = asyncio.get_event_loop()
+        channel_rules, auth_manager = await loop.run_in_executor(
+            None, _compile_rules, settings
         )
 
-    def start(self):
+        self.channel_rules = channel_rules
+        self.auth_manager = auth_manager
+
+        await self.refresh_connections(settings.RELOAD_RECHECK_SUBSCRIPTIONS)
+
+    async def refresh_connections(self, recheck_subscriptions,
+                                  batch_size=1000):
         """
-        Start the server
+        Get new grants from the current auth manager for connections that
+        have authenticated, and optionally check existing subscriptions
+        against the current rules, removing the ones that are no longer
+        allowed. Connections are handled in batches, letting the IOLoop run in
+        between.
+
+        :param bool recheck_subscriptions:
+        :param int batch_size: Number of connections to handle at a time
         """
-        global _ioloop, _periodic_callback
 
-        self.logger.info("Listening to {addr}:{port}".format(
-            addr=self.settings.LISTEN_ADDRESS,
-            port=self.settings.LISTEN_PORT
-        ))
+        handlers = list(self.connections)
 
-        self.app.listen(port=self.settings.LISTEN_PORT,
-                        address=self.settings.LISTEN_ADDRESS)
+        for start in range(0, len(handlers), batch_size):
+            for handler in handlers[start:start + batch_size]:
+                state = self.connections.get(handler)
+                if state is None:
+                    continue
 
-        signal.signal(signal.SIGINT, _signal_handler)
+                self._refresh_connection(handler, recheck_subscriptions)
+                if state.sessions:
+                    for session in list(state.sessions.values()):
+                        self._refresh_connection(
+                            session, recheck_subscriptions
+                        )
 
-        _ioloop = ioloop.IOLoop.instance()
+            await asyncio.sleep(0)
 
-        next_stat = time() + self.settings.STATS_SECONDS
+    def _refresh_connection(self, handler, recheck_subscriptions):
+        """
+        Refresh the grant and subscriptions of a connection or session, see
+        refresh_connections
+        """
 
-        def _check():
-            global next_stat
-            _check_exit()
-            current = time()
-            if current > next_stat:
-                self.show_stats()
-                next_stat = current + self.settings.STATS_SECONDS
+        state = self._get_state(handler)
+        if state.grant is not None:
+            state.grant = self.auth_manager.get_grant(state.auth_key)
 
-            if not _is_closing:
-                _ioloop.call_later(0.25, _check)
+        if not recheck_subscriptions:
+            return
 
-        def _run():
-            self.logger.info("Starting periodic checks")
-            _ioloop.call_later(0.25, _check)
+        for channel, key in list(state.subscriptions.items()):
+            if self._is_channel_valid(channel) and self._authenticate(
+                    handler, "subscribe", channel, key):
+                continue
 
-            self.logger.info("Starting IOLoop")
+            self._unsubscribe(handler, channel, "Rules changed")
 
-            _ioloop.start()
-            # Waits until loop is stopped
-            _ioloop.close()
+    async def drain(self, deadline):
+        """
+        Close every connection gradually, so clients don't all try to
+        reconnect at the same time. Pending writes are flushed first, then
+        clients are told when to reconnect and closed in batches spread out
+        until the deadline.
 
-            self.logger.info("IOLoop closed")
+        :param float deadline: Timestamp by which everything should be closed
+        """
 
-        thread = threading.Thread(target=_run)
-        thread.start()
+        settings = self.settings
 
-    def stop(self):
-        """
-        Stop the server
-        """
+        flush_until = min(deadline, time() + settings.DRAIN_FLUSH_SECONDS)
+        while time() < flush_until and (
+                self._outbound or self._fanout_jobs or any(
+                    handler.is_writing() for handler in self.connections)):
+            await asyncio.sleep(0.05)
 
-        self.logger.info("Stopping server")
-        _ioloop.stop()
+        handlers = list(self.connections)
+        batch_size = settings.DRAIN_BATCH_SIZE
+        batches = int(ceil(len(handlers) / float(batch_size)))
+
+        # Leave the last interval for the close handshakes
+        interval = max(0, deadline - time()) / (batches + 1)
+
+        for start in range(0, len(handlers), batch_size):
+            for handler in handlers[start:start + batch_size]:
+                if handler in self.connections:
+                    self._drain_connection(handler)
+
+            await asyncio.sleep(interval)
+
+        while self.connections and time() < deadline:
+            await asyncio.sleep(0.05)
+
+    def _drain_connection(self, handler):
+        """
+        Tell the client when to reconnect, and close the connection
+        """
+
+        settings = self.settings
+        self.stats["drained"] += 1
+
+        try:
+            handler.write_message(json.dumps({
+                "type": "reconnect",
+                "delay": round(uniform(0, settings.DRAIN_RECONNECT_JITTER), 2)
+            }))
+        except WebSocketClosedError:
+            pass
+
+        handler.close(settings.DRAIN_CLOSE_CODE, "Server shutting down")
+
+    def _process_packet(self, handler, packet, size=0):
+        """
+        Handle WSPS packets
+
+        :param dict packet: Data packet from the client
+        :param int size: Size of the packet in bytes, for rate limiting
+        :return Future: See on_message
+        """
+
+        try:
+            session = packet.pop("session", None)
+            if session is not None:
+                handler = self._get_session(handler, session, packet["type"])
+                if handler is None:
+                    return
+
+            if packet["type"] == "auth":
+                self._auth(handler, packet.get("key"))
+                return
+
+            channel = packet["channel"]
+            max_length = self.settings.MAX_CHANNEL_LENGTH
+            if max_length and isinstance(channel, str) and \
+                    len(channel) > max_length:
+                self.log.error(
+                    "channel_too_long",
+                    "Client from {} tried a channel name of {} characters",
+                    handler.request.remote_ip,
+                    len(channel)
+                )
+                handler.close(1002, "Invalid channel")
+                return
+
+            if not isinstance(channel, str) or \
+                    not self._is_channel_valid(channel):
+                self.log.error(
+                    "invalid_channel",
+                    "Client from {} tried an invalid channel {}",
+                    handler.request.remote_ip,
+                    channel
+                )
+                handler.close(1002, "Invalid channel")
+                return
+
+            # Extract and remove key from packet, so it doesn't
+            # accidentally # end up somewhere it shouldn't
+            key = None
+            if "key" in packet:
+                key = packet["key"]
+                del packet["key"]
+
+            if self.rate_limiter.enabled and packet["type"] in (
+                    "subscribe", "publish"):
+                if not self._rate_limit(handler, channel, packet, key, size):
+                    return
+
+            return self._dispatch(handler, channel, packet, key)
+        except KeyError:
+            self.log.error(
+                "invalid_packet",
+                "Client from {} sent an invalid packet",
+                handler.request.remote_ip
+            )
+            handler.close(1002, "Invalid message")
+
+    def _dispatch(self, handler, channel, packet, key):
+        """
+        Run the action requested by a validated packet
+
+        :param str channel:
+        :param dict packet: Data packet from the client
+        :param str key:
+        :return Future: See on_message
+        """
+
+        if packet["type"] == "subscribe":
+            self._subscribe(
+                handler,
+                channel,
+                key,
+                packet.get("presence"),
+                packet.get("filter")
+            )
+        elif packet["type"] == "publish":
+            return self._message(handler, channel, packet, key)
+        elif packet["type"] == "presence":
+            self._presence(handler, channel, packet, key)
+        else:
+            self.log.error(
+                "invalid_type",
+                "Client from {} sent an invalid message type {}",
+                handler.request.remote_ip,
+                packet["type"]
+            )
+            handler.close(1002, "Invalid message type")
+
+    def _delayed_dispatch(self, handler, channel, packet, key):
+        """
+        Dispatch a packet that was delayed by rate limits, unless the client
+        disconnected in the meanwhile
+        """
+
+        if self._is_open(handler):
+            self._dispatch(handler, channel, packet, key)
+
+    def _rate_limit(self, handler, channel, packet, key, size):
+        """
+        Apply the configured rate limits to a packet
+
+        :param str channel:
+        :param dict packet: Data packet from the client
+        :param str key:
+        :param int size: Size of the packet in bytes
+        :return bool: If the packet should be processed right away
+        """
+
+        action = self.settings.RATE_LIMIT_ACTION
+        if action == "delay":
+            max_wait = self.settings.RATE_LIMIT_MAX_DELAY
+        else:
+            max_wait = 0
+
+        wait = self.rate_limiter.acquire(
+            handler, packet["type"], channel, size, max_wait, time()
+        )
+
+        if wait == 0:
+            return True
+
+        if wait <= max_wait:
+            self.stats["rate_limit_delayed"] += 1
+            ioloop.IOLoop.current().call_later(
+                wait, self._delayed_dispatch, handler, channel, packet, key
+            )
+            return False
+
+        if self.settings.DEBUG:
+            self.logger.debug(
+                "Client from {} hit rate limits for {} on {}".format(
+                    handler.request.remote_ip,
+                    packet["type"],
+                    channel
+                )
+            )
+
+        if action == "close":
+            self.stats["rate_limit_closed"] += 1
+            handler.close(
+                self.settings.RATE_LIMIT_CLOSE_CODE,
+                "Rate limit exceeded"
+            )
+        else:
+            self.stats["rate_limit_dropped"] += 1
+
+        return False
+
+    def _subscribe(self, handler, channel, key, watch=False, expression=None):
+        """
+        Client is asking to subscribe to the given channel
+
+        :param str channel:
+        :param str key:
+        :param bool watch: If the client wants to know about presence changes
+                           on the channel
+        :param str expression: Filter for the messages the client wants, None
+                               for all of them
+        """
+
+        if not self._authenticate(handler, "subscribe", channel, key):
+            self.log.error(
+                "auth_failed",
+                "Client from {} failed subscribe authorization to {}",
+                handler.request.remote_ip,
+                channel
+            )
+            handler.close(1002, "Authorization failed")
+            return
+
+        state = self._get_state(handler)
+        subscriptions = state.subscriptions
+        if channel not in subscriptions and \
+                not self._check_subscription_limits(handler, channel):
+            return
+
+        if not self._set_filter(handler, channel, expression):
+            return
+
+        if channel not in subscriptions:
+            if handler.__class__ is Session:
+                self._add_session_channel(handler, channel)
+            elif state.session_channels is None or \
+                    channel not in state.session_channels:
+                self._add_subscriber(channel, handler)
+
+        subscriptions[channel] = key
+
+        if watch:
+            if channel not in self.presence_watchers:
+                self.presence_watchers[channel] = set()
+
+            self.presence_watchers[channel].add(handler)
+
+        if self.settings.DEBUG:
+            self.logger.debug(
+                "Client from {} subscribed to {}".format(
+                    handler.request.remote_ip,
+                    channel
+                )
+            )
+
+    def _check_subscription_limits(self, handler, channel):
+        """
+        Check if the client can subscribe to one more channel, and tell it
+        it's not subscribed if not
+
+        :param str channel:
+        :return bool:
+        """
+
+        max_subscriptions = self.settings.MAX_SUBSCRIPTIONS
+        max_channels = self.settings.MAX_CHANNELS
+
+        if max_subscriptions and len(
+                self._get_state(handler).subscriptions) >= max_subscriptions:
+            event, reason = "too_many_subscriptions", "Too many subscriptions"
+        elif max_channels and channel not in self.channel_subscribers and \
+                len(self.channel_subscribers) >= max_channels:
+            event, reason = "too_many_channels", "Too many channels"
+        else:
+            return True
+
+        self.log.error(
+            event,
+            "Client from {} could not subscribe to {}: {}",
+            handler.request.remote_ip,
+            channel,
+            reason
+        )
+
+        try:
+            handler.write_message(json.dumps({
+                "type": "unsubscribed",
+                "channel": channel,
+                "reason": reason
+            }))
+        except WebSocketClosedError:
+            pass
+
+        return False
+
+    def _unsubscribe(self, handler, channel, reason):
+        """
+        Remove the client's subscription to the channel, and let it know why
+
+        :param str channel:
+        :param str reason: Human readable reason
+        """
+
+        state = self._get_state(handler)
+        del state.subscriptions[channel]
+        state.versions.pop(channel, None)
+        self._remove_subscriber(channel, handler)
+        self._set_filter(handler, channel, None)
+        self.stats["unsubscribed"] += 1
+
+        try:
+            handler.write_message(json.dumps({
+                "type": "unsubscribed",
+                "channel": channel,
+                "reason": reason
+            }))
+        except WebSocketClosedError:
+            pass
+
+    def _set_filter(self, handler, channel, expression):
+        """
+        Change the filter for the client's subscription to the channel.
+        Filters are compiled once for every distinct expression on the
+        channel, and the clients using it are grouped together.
+
+        :param str channel:
+        :param str expression: Filter expression, None to remove the filter
+        :return bool: False if the expression was invalid, and the client
+                      disconnected
+        """
+
+        filters = self._get_state(handler).filters
+        previous = filters.get(channel)
+        if expression == previous:
+            return True
+
+        if expression is not None and handler.__class__ is Session:
+            self.log.error(
+                "invalid_filter",
+                "Client from {} sent a filter for a session",
+                handler.request.remote_ip
+            )
+            handler.close(1002, "Filters are not supported for sessions")
+            return False
+
+        if expression is not None:
+            # Only strings can be looked up, anything else is invalid
+            groups = self.channel_filters.get(channel)
+            group = None
+            if groups is not None and isinstance(expression, str):
+                group = groups.get(expression)
+
+            if group is None:
+                try:
+                    matches = compile_filter(expression)
+                except ValueError as e:
+                    self.log.error(
+                        "invalid_filter",
+                        "Client from {} sent an invalid filter: {}",
+                        handler.request.remote_ip,
+                        e
+                    )
+                    handler.close(1002, "Invalid filter")
+                    return False
+
+                if groups is None:
+                    groups = self.channel_filters[channel] = {}
+                group = groups[expression] = (matches, set())
+
+            group[1].add(handler)
+            filters[channel] = expression
+        else:
+            del filters[channel]
+
+        if previous is not None:
+            self._remove_filter(handler, channel, previous)
+
+        return True
+
+    def _remove_filter(self, handler, channel, expression):
+        """
+        Remove the client from the group of subscribers using the filter
+
+        :param str channel:
+        :param str expression:
+        """
+
+        groups = self.channel_filters[channel]
+        subscribers = groups[expression][1]
+        subscribers.discard(handler)
+
+        if not subscribers:
+            del groups[expression]
+            if not groups:
+                del self.channel_filters[channel]
+
+    def _add_subscriber(self, channel, handler):
+        """
+        Add the client to the channel's subscribers
+
+        :param str channel:
+        """
+
+        subscribers = self.channel_subscribers.get(channel)
+        if subscribers is None:
+            subscribers = self.channel_subscribers[channel] = []
+            # Every channel in use has stats, so they list all the channels
+            # for the admin API
+            if channel not in self.channel_stats:
+                self.channel_stats[channel] = ChannelStats(time())
+
+        subscribers.append(handler)
+        self._presence_changed(channel, 1, 0)
+
+    def _remove_subscriber(self, channel, handler):
+        """
+        Remove the client from the channel's subscribers
+
+        :param str channel:
+        """
+
+        if handler.__class__ is Session:
+            self._remove_session_channel(handler, channel)
+        else:
+            # Still subscribed for its sessions
+            state = self.connections.get(handler)
+            if state is not None and state.session_channels and \
+                    channel in state.session_channels:
+                return
+
+            subscribers = self.channel_subscribers.get(channel)
+            if subscribers is not None and handler in subscribers:
+                subscribers.remove(handler)
+                self._presence_changed(channel, 0, 1)
+
+        watchers = self.presence_watchers.get(channel)
+        if watchers is not None:
+            watchers.discard(handler)
+            if not watchers:
+                del self.presence_watchers[channel]
+
+    def _get_session(self, gateway, session_id, packet_type):
+        """
+        Find the logical session a gateway connection sent a packet for,
+        starting a new one if needed. Packets of type "end" end the session.
+
+        :param str|int session_id: Id for the session chosen by the gateway
+        :param str packet_type:
+        :return Session: None if the packet was handled or rejected
+        """
+
+        if isinstance(session_id, bool) or \
+                not isinstance(session_id, (str, int)):
+            self.log.error(
+                "invalid_packet",
+                "Client from {} sent an invalid session id",
+                gateway.request.remote_ip
+            )
+            gateway.close(1002, "Invalid session")
+            return None
+
+        state = self.connections[gateway]
+        if state.sessions is None:
+            state.sessions = {}
+            state.session_channels = {}
+            self._gateways.add(gateway)
+
+        session = state.sessions.get(session_id)
+
+        if packet_type == "end":
+            if session is not None:
+                self._end_session(session)
+            return None
+
+        if session is None:
+            max_sessions = self.settings.MAX_SESSIONS
+            if max_sessions and len(state.sessions) >= max_sessions:
+                self.log.error(
+                    "too_many_sessions",
+                    "Client from {} has too many sessions",
+                    gateway.request.remote_ip
+                )
+                self._send_session_end(
+                    gateway, session_id, "Too many sessions"
+                )
+                return None
+
+            session = Session(self, gateway, state, session_id, time())
+            state.sessions[session_id] = session
+            self.stats["sessions_started"] += 1
+
+        return session
+
+    def end_session(self, session, reason=None):
+        """
+        End a logical session, and tell the gateway why
+
+        :param Session session:
+        :param str reason: Human readable reason
+        """
+
+        if not session.active:
+            return
+
+        self._end_session(session)
+        self._send_session_end(session.gateway, session.id, reason)
+
+    def _end_session(self, session):
+        """
+        Forget a logical session and its subscriptions
+        """
+
+        session.active = False
+        del session.gateway_state.sessions[session.id]
+
+        for channel in session.state.subscriptions:
+            self._remove_subscriber(channel, session)
+
+        self.rate_limiter.forget(session)
+        if self._flow_paused:
+            self._release_flow(session)
+
+        self.stats["sessions_ended"] += 1
+
+    def _send_session_end(self, gateway, session_id, reason):
+        try:
+            gateway.write_message(json.dumps({
+                "type": "end",
+                "session": session_id,
+                "reason": reason
+            }))
+        except WebSocketClosedError:
+            pass
+
+    def _add_session_channel(self, session, channel):
+        """
+        Subscribe a logical session to a channel. The gateway connection
+        is subscribed once for all of its sessions.
+
+        :param Session session:
+        :param str channel:
+        """
+
+        gateway_state = session.gateway_state
+        entry = gateway_state.session_channels.get(channel)
+        if entry is None:
+            entry = gateway_state.session_channels[channel] = [set(), None]
+            if channel not in gateway_state.subscriptions:
+                self._add_subscriber(channel, session.gateway)
+
+        entry[0].add(session.id)
+        entry[1] = None
+
+    def _remove_session_channel(self, session, channel):
+        """
+        Unsubscribe a logical session from a channel, and the gateway
+        connection too if it was the last of its sessions on the channel
+
+        :param Session session:
+        :param str channel:
+        """
+
+        gateway_state = session.gateway_state
+        entry = gateway_state.session_channels.get(channel)
+        if entry is None or session.id not in entry[0]:
+            return
+
+        entry[0].discard(session.id)
+        entry[1] = None
+
+        if not entry[0]:
+            del gateway_state.session_channels[channel]
+            if channel not in gateway_state.subscriptions:
+                self._remove_subscriber(channel, session.gateway)
+
+    def _tag_sessions(self, handler, channel, message):
+        """
+        Add the list of the gateway's sessions subscribed to the channel to
+        a message. The list is serialized once, and again only when the
+        sessions on the channel change.
+
+        :param str channel:
+        :param str message:
+        :return str:
+        """
+
+        entry = self.connections[handler].session_channels.get(channel)
+        if entry is None:
+            return message
+
+        tag = entry[1]
+        if tag is None:
+            tag = entry[1] = json.dumps(list(entry[0]))
+
+        return add_field(message, "sessions", tag)
+
+    def _get_state(self, handler):
+        """
+        :return ConnectionState: State of a connection or logical session
+        """
+
+        if handler.__class__ is Session:
+            return handler.state
+
+        return self.connections[handler]
+
+    def _is_open(self, handler):
+        """
+        :return bool: If a connection or logical session is still open
+        """
+
+        if handler.__class__ is Session:
+            return handler.active
+
+        return handler in self.connections
+
+    def _presence(self, handler, channel, packet, key):
+        """
+        Client is asking how many subscribers the channel has
+
+        :param str channel:
+        :param dict packet: Data packet from the client
+        :param str key:
+        """
+
+        if not self._authenticate(handler, "subscribe", channel, key):
+            self.log.error(
+                "auth_failed",
+                "Client from {} failed presence authorization to {}",
+                handler.request.remote_ip,
+                channel
+            )
+            handler.close(1002, "Authorization failed")
+            return
+
+        reply = {
+            "type": "presence",
+            "channel": channel,
+            "count": self.get_subscriber_count(channel)
+        }
+
+        if packet.get("ids") and self.settings.PRESENCE_IDS:
+            reply["ids"] = self.get_subscriber_ids(channel)
+
+        try:
+            handler.write_message(json.dumps(reply))
+        except WebSocketClosedError:
+            pass
+
+    def _presence_changed(self, channel, joined, left):
+        """
+        Keep track of presence changes on the channel, if anyone is watching
+
+        :param str channel:
+        :param int joined: Number of clients that subscribed
+        :param int left: Number of clients that unsubscribed
+        """
+
+        if channel in self.presence_watchers:
+            changes = self._presence_changes.get(channel)
+            if changes is None:
+                changes = self._presence_changes[channel] = [0, 0]
+            changes[0] += joined
+            changes[1] += left
+
+        # Other shards collect changes from here in their own time
+        for peer in self.peers:
+            if channel in peer.presence_watchers:
+                peer._presence_inbox.append((channel, joined, left))
+
+    def _send_presence(self):
+        """
+        Tell watching clients about presence changes, once per
+        PRESENCE_INTERVAL, so busy channels don't cause a flood of updates
+        """
+
+        changes = self._presence_changes
+        inbox = self._presence_inbox
+        while inbox:
+            channel, joined, left = inbox.popleft()
+            if channel not in changes:
+                changes[channel] = [0, 0]
+            changes[channel][0] += joined
+            changes[channel][1] += left
+
+        if not changes:
+            return
+
+        self._presence_changes = {}
+
+        for channel, (joined, left) in changes.items():
+            watchers = self.presence_watchers.get(channel)
+            if not watchers:
+                continue
+
+            message = json.dumps({
+                "type": "presence",
+                "channel": channel,
+                "count": self.get_subscriber_count(channel),
+                "joined": joined,
+                "left": left
+            })
+
+            for handler in list(watchers):
+                try:
+                    handler.write_message(message)
+                except WebSocketClosedError:
+                    pass
+
+    def _auth(self, handler, key):
+        """
+        Client is authenticating its connection, so it doesn't need to send a
+        key with every packet
+
+        :param str key:
+        """
+
+        grant = self.auth_manager.get_grant(key)
+        if grant is None:
+            self.log.error(
+                "auth_failed",
+                "Client from {} failed authentication",
+                handler.request.remote_ip
+            )
+            handler.close(1002, "Authorization failed")
+            return
+
+        state = self._get_state(handler)
+        state.auth_key = key
+        state.grant = grant
+
+    def _authenticate(self, handler, event, channel, key):
+        """
+        Check if the user has the permission to do things. Packets without a
+        key are checked against the connection's grant, if it has one.
+
+        :param str event:
+        :param str channel:
+        :param str key:
+        :return bool:
+        """
+
+        if key is None:
+            state = self._get_state(handler)
+            grant = state.grant
+            if grant is not None:
+                if grant.expires is None or time() < grant.expires:
+                    return grant.allows(event, channel)
+
+                state.grant = None
+
+        return self.auth_manager.authenticate(event, channel, key)
+
+    def _is_channel_valid(self, channel):
+        """
+        Check if the given channel name is valid based on the configuration
+
+        :param str channel: The name of the channel
+        :return bool:
+        """
+
+        return self.channel_rules.matches(channel)
+
+    def _message(self, handler, channel, packet, key):
+        """
+        Send out a message to the channel
+
+        :param str channel:
+        :param dict packet: Original publish packet from client
+        :param str key:
+        :return Future: See _flow_control
+        """
+
+        if not self._authenticate(handler, "publish", channel, key):
+            self.log.error(
+                "auth_failed",
+                "Client from {} failed publish authorization to {}",
+                handler.request.remote_ip,
+                channel
+            )
+            handler.close(1002, "Authorization failed")
+            return
+
+        out_packet = copy(packet)
+        out_packet["type"] = "message"
+
+        try:
+            priority, expires = _get_priority(
+                out_packet.pop("priority", 0), out_packet.pop("ttl", None)
+            )
+        except ValueError:
+            self.log.error(
+                "invalid_packet",
+                "Client from {} sent an invalid priority or ttl",
+                handler.request.remote_ip
+            )
+            handler.close(1002, "Invalid message")
+            return
+
+        if self.settings.DEBUG:
+            self.logger.debug("Sending message from {} to channel {}".format(
+                handler.request.remote_ip,
+                channel
+            ))
+
+        self._publish_message(channel, out_packet, priority, expires)
+
+        return self._flow_control(handler, channel)
+
+    def _publish_message(self, channel, packet, priority, expires):
+        """
+        Publish a message packet, or hold on to it if the channel is
+        conflated
+
+        :param str channel:
+        :param dict packet: The message packet
+        :param int priority:
+        :param float expires:
+        """
+
+        conflation = self.conflation.lookup(channel)
+        if conflation is not None:
+            self._conflate(channel, packet, priority, expires, *conflation)
+        else:
+            self._publish_packet(channel, packet, priority, expires)
+
+    def _flow_control(self, handler, channel):
+        """
+        Hold back a publisher while more than FLOW_CONTROL_HIGH_WATER bytes
+        of messages to the channel are waiting to be written, until it's down
+        to FLOW_CONTROL_LOW_WATER again. Depending on FLOW_CONTROL_ACTION the
+        server either stops reading from the publisher, or tells it to slow
+        down with a "flow" packet.
+
+        :param str channel:
+        :return Future: Resolved when the publisher may continue, None if it
+                        isn't paused
+        """
+
+        high_water = self.settings.FLOW_CONTROL_HIGH_WATER
+        if not high_water or self.get_channel_backlog(channel) <= high_water:
+            return None
+
+        self.stats["flow_throttled"] += 1
+        paused = self._flow_paused.setdefault(channel, {})
+
+        if self.settings.FLOW_CONTROL_ACTION == "signal":
+            if handler not in paused:
+                paused[handler] = None
+                self._send_flow(handler, channel, "slow")
+            return None
+
+        future = paused.get(handler)
+        if future is None:
+            future = paused[handler] = Future()
+
+        return future
+
+    def _check_flow(self):
+        """
+        Let publishers continue on channels that have caught up
+        """
+
+        low_water = self.settings.FLOW_CONTROL_LOW_WATER
+
+        for channel in list(self._flow_paused):
+            if self.get_channel_backlog(channel) > low_water:
+                continue
+
+            for handler, future in self._flow_paused.pop(channel).items():
+                if future is not None:
+                    future.set_result(None)
+                elif self._is_open(handler):
+                    self._send_flow(handler, channel, "ok")
+
+    def _release_flow(self, handler):
+        """
+        Forget a disconnected publisher from every channel it was held back on
+        """
+
+        for channel, paused in list(self._flow_paused.items()):
+            future = paused.pop(handler, None)
+            if future is not None:
+                future.set_result(None)
+
+            if not paused:
+                del self._flow_paused[channel]
+
+    def _send_flow(self, handler, channel, status):
+        """
+        Tell a publisher to slow down on a channel, or that it's ok again
+
+        :param str channel:
+        :param str status: "slow" or "ok"
+        """
+
+        try:
+            handler.write_message(json.dumps({
+                "type": "flow",
+                "channel": channel,
+                "status": status
+            }))
+        except WebSocketClosedError:
+            self.log.error("write_failed", "Error writing to client.")
+
+    def _conflate(self, channel, packet, priority, expires, interval,
+                  key_field):
+        """
+        Hold on to the message until the end of the channel's conflation
+        interval, replacing any earlier message with the same key
+
+        :param str channel:
+        :param dict packet: The message packet
+        :param int priority: Higher priority messages are sent first
+        :param float expires: Timestamp after which the message is dropped
+        :param float interval: Seconds to collect messages for
+        :param str key_field: Field in the message data to conflate on, None
+                              to only keep the newest message
+        """
+
+        data = packet.get("data")
+        if key_field is not None and isinstance(data, dict):
+            conflation_key = data.get(key_field)
+            # Lists and objects can't be keys, booleans would be the same
+            # as 0 and 1
+            if conflation_key.__class__ not in (str, int, float):
+                conflation_key = None
+        else:
+            conflation_key = None
+
+        pending = self._conflated.get(channel)
+        if pending is None:
+            pending = self._conflated[channel] = {}
+            ioloop.IOLoop.current().call_later(
+                interval, self._flush_conflated, channel
+            )
+        elif conflation_key in pending:
+            self.stats["conflated"] += 1
+
+        pending[conflation_key] = (packet, priority, expires)
+
+    def _flush_conflated(self, channel):
+        """
+        Publish the newest messages held for the channel
+        """
+
+        now = time()
+        for packet, priority, expires in self._conflated.pop(channel).values():
+            if expires is not None and now >= expires:
+                self.stats["expired"] += 1
+                continue
+
+            self._publish_packet(channel, packet, priority, expires)
+
+    def _publish_packet(self, channel, packet, priority, expires):
+        """
+        Serialize a message packet and publish it, as a delta against the
+        previous message if it's a delta channel
+
+        :param str channel:
+        :param dict packet: The message packet
+        :param int priority:
+        :param float expires:
+        """
+
+        message = self.delta.encode(channel, packet)
+        if message is None:
+            message = json.dumps(packet)
+
+        self._publish(channel, message, priority, expires, packet)
+
+    def _publish(self, channel, message, priority=0, expires=None,
+                 packet=None):
+        """
+        Send a serialized message to the subscribers of the channel on every
+        shard
+
+        :param str channel:
+        :param str message:
+        :param int priority: Higher priority messages are sent first to
+                             clients that are falling behind
+        :param float expires: Timestamp after which the message is dropped
+                              instead of sent, None for never
+        :param dict packet: The message packet the message was serialized
+                            from, so it doesn't need to be parsed again. Must
+                            not be modified after this.
+        """
+
+        now = time()
+        stats = self.channel_stats.get(channel)
+        if stats is None:
+            stats = self.channel_stats[channel] = ChannelStats(now)
+        stats.add(len(message), now)
+
+        self._deliver(channel, message, priority, expires, packet)
+
+        for peer in self.peers:
+            peer.receive(channel, message, priority, expires, packet)
+
+    def _deliver(self, channel, message, priority=0, expires=None,
+                 packet=None):
+        """
+        Send a serialized message to the subscribers of the channel connected
+        to this manager
+
+        :param str channel:
+        :param str|DeltaMessage message:
+        :param int priority:
+        :param float expires:
+        :param dict packet: The message packet, None to parse the message if
+                            it's needed
+        """
+
+        callbacks = self.local_subscribers.get(channel)
+        if callbacks:
+            if packet is None:
+                packet = _parse_message(message)
+            self._notify_local(callbacks, packet)
+
+        subscribers = self.channel_subscribers.get(channel)
+        if not subscribers:
+            return
+
+        groups = self.channel_filters.get(channel)
+        if groups:
+            if packet is None:
+                packet = _parse_message(message)
+            subscribers = self._filter_subscribers(
+                groups, subscribers, packet
+            )
+            if not subscribers:
+                return
+
+        chunk_size = self.settings.FANOUT_CHUNK_SIZE
+        if channel in self._fanout_jobs or (
+                chunk_size and len(subscribers) > chunk_size):
+            self._queue_fanout(
+                channel, message, priority, expires, list(subscribers)
+            )
+            return
+
+        for subscriber in subscribers:
+            self._send(subscriber, channel, message, priority, expires)
+
+    def _notify_local(self, callbacks, packet):
+        """
+        Call the functions subscribed to a channel with subscribe()
+
+        :param list callbacks:
+        :param dict packet: The message packet
+        """
+
+        # A callback may unsubscribe itself
+        for callback in list(callbacks):
+            self.stats["local_delivered"] += 1
+            try:
+                callback(packet)
+            except Exception:
+                self.log.error(
+                    "local_subscriber_failed",
+                    "Error in subscriber callback for {}",
+                    packet.get("channel"),
+                    exc_info=True
+                )
+
+    def _filter_subscribers(self, groups, subscribers, packet):
+        """
+        Leave out the subscribers whose filter doesn't match the message.
+        Each filter is only checked once, no matter how many subscribers are
+        using it.
+
+        :param dict groups: Filter expressions to (filter, subscribers)
+        :param list subscribers: All subscribers of the channel
+        :param dict packet: The message packet
+        :return list:
+        """
+
+        excluded = set()
+        for matches, group in groups.values():
+            if not matches(packet):
+                excluded.update(group)
+
+        if not excluded:
+            return subscribers
+
+        self.stats["filtered"] += len(excluded)
+        return [handler for handler in subscribers if handler not in excluded]
+
+    def _queue_fanout(self, channel, message, priority, expires, subscribers):
+        """
+        Deliver a message to a large channel in chunks, over multiple IOLoop
+        iterations, so other clients don't have to wait for all of it. Later
+        messages to the same channel are queued behind it, to keep them in
+        order.
+
+        :param str channel:
+        :param str message:
+        :param int priority:
+        :param float expires:
+        :param list subscribers: Subscribers at the time of publishing
+        """
+
+        jobs = self._fanout_jobs.get(channel)
+        if jobs is None:
+            jobs = self._fanout_jobs[channel] = deque()
+            self._fanout_channels.append(channel)
+
+        jobs.append([message, priority, expires, subscribers, 0])
+        self._add_backlog(channel, len(message) * len(subscribers))
+        self.stats["fanout_chunked"] += 1
+
+        if not self._fanout_scheduled:
+            self._fanout_scheduled = True
+            ioloop.IOLoop.current().add_callback(self._run_fanout)
+
+    def _run_fanout(self):
+        """
+        Deliver chunks of queued messages until FANOUT_TIME_BUDGET runs out,
+        taking turns between channels, and continue on the next IOLoop
+        iteration if there's more to do
+        """
+
+        chunk_size = self.settings.FANOUT_CHUNK_SIZE or 1000
+        deadline = time() + self.settings.FANOUT_TIME_BUDGET
+        channels = self._fanout_channels
+        connections = self.connections
+
+        while channels:
+            channel = channels[0]
+            jobs = self._fanout_jobs[channel]
+            job = jobs[0]
+            message, priority, expires, subscribers, start = job
+
+            if expires is not None and time() >= expires:
+                # Expired while waiting for its turn, skip the rest
+                self.stats["expired"] += 1
+                end = len(subscribers)
+                self._add_backlog(channel, -len(message) * (end - start))
+            else:
+                chunk = subscribers[start:start + chunk_size]
+                end = start + len(chunk)
+                self._add_backlog(channel, -len(message) * len(chunk))
+
+                for subscriber in chunk:
+                    # Might have disconnected since the message was published
+                    if subscriber in connections:
+                        self._send(subscriber, channel, message, priority,
+                                   expires)
+
+            if end < len(subscribers):
+                job[4] = end
+                channels.rotate(-1)
+            else:
+                jobs.popleft()
+                if not jobs:
+                    del self._fanout_jobs[channel]
+                    channels.popleft()
+                else:
+                    channels.rotate(-1)
+
+            if time() >= deadline:
+                break
+
+        if channels:
+            ioloop.IOLoop.current().add_callback(self._run_fanout)
+        else:
+            self._fanout_scheduled = False
+
+        if self._flow_paused:
+            self._check_flow()
+
+    def _send(self, handler, channel, message, priority=0, expires=None):
+        """
+        Write a message to a client. If the client has more than
+        OUTBOUND_HIGH_WATER bytes waiting to be written, the message is
+        queued instead, and sent later in order of priority unless it has
+        expired by then.
+
+        :param str channel: Channel the message was published on
+        :param str|DeltaMessage message:
+        :param int priority:
+        :param float expires:
+        """
+
+        queue = self._outbound.get(handler)
+        high_water = self.settings.OUTBOUND_HIGH_WATER
+
+        if queue is None:
+            if not high_water or \
+                    handler.get_write_buffer_size() <= high_water:
+                if message.__class__ is DeltaMessage:
+                    message = self._resolve_delta(handler, channel, message)
+                    if message is None:
+                        return
+
+                if self._gateways and handler in self._gateways:
+                    message = self._tag_sessions(handler, channel, message)
+
+                try:
+                    handler.write_message(message)
+                except WebSocketClosedError:
+                    self.log.error("write_failed", "Error writing to client.")
+                return
+
+            # Not queuing at all, drop it
+            if not self.settings.OUTBOUND_QUEUE_LIMIT:
+                self.stats["outbound_dropped"] += 1
+                return
+
+            queue = self._outbound[handler] = []
+
+        entry = (
+            -priority, next(self._outbound_order), expires, message, channel
+        )
+
+        if len(queue) < self.settings.OUTBOUND_QUEUE_LIMIT:
+            heappush(queue, entry)
+            self._add_backlog(channel, len(message))
+            return
+
+        # Queue is full, make room by dropping the least important message
+        self.stats["outbound_dropped"] += 1
+        worst = max(queue)
+        if entry < worst:
+            queue[queue.index(worst)] = entry
+            heapify(queue)
+            self._add_backlog(worst[4], -len(worst[3]))
+            self._add_backlog(channel, len(message))
+
+    def _resolve_delta(self, handler, channel, message):
+        """
+        Pick the delta if the client has the version it applies to, otherwise
+        the full message. Messages older than what the client already has are
+        left out, since they'd take its state backwards.
+
+        :param str channel:
+        :param DeltaMessage message:
+        :return str: Message to write, None if it's out of date
+        """
+
+        versions = self.connections[handler].versions
+        version = versions.get(channel)
+        if version is not None and message.version <= version:
+            self.stats["delta_outdated"] += 1
+            return None
+
+        versions[channel] = message.version
+
+        if message.delta is not None and version == message.base:
+            self.stats["delta_sent"] += 1
+            return message.delta
+
+        return message.full
+
+    def _add_backlog(self, channel, size):
+        """
+        Update the bytes waiting to be written for a channel
+
+        :param str channel:
+        :param int size: Bytes added, negative for removed
+        """
+
+        backlog = self._channel_backlog.get(channel, 0) + size
+        if backlog > 0:
+            self._channel_backlog[channel] = backlog
+        else:
+            self._channel_backlog.pop(channel, None)
+
+    def _flush_outbound(self, now):
+        """
+        Write queued messages to clients that have caught up, dropping the
+        ones that have expired
+
+        :param float now: Current timestamp
+        """
+
+        high_water = self.settings.OUTBOUND_HIGH_WATER
+
+        for handler, queue in list(self._outbound.items()):
+            while queue and handler.get_write_buffer_size() <= high_water:
+                _, _, expires, message, channel = heappop(queue)
+                self._add_backlog(channel, -len(message))
+
+                if expires is not None and now >= expires:
+                    self.stats["expired"] += 1
+                    continue
+
+                if message.__class__ is DeltaMessage:
+                    message = self._resolve_delta(handler, channel, message)
+                    if message is None:
+                        continue
+
+                if self._gateways and handler in self._gateways:
+                    message = self._tag_sessions(handler, channel, message)
+
+                try:
+                    handler.write_message(message)
+                except WebSocketClosedError:
+                    break
+
+            if not queue:
+                del self._outbound[handler]
+
+    def receive(self, channel, message, priority=0, expires=None,
+                packet=None):
+        """
+        Hand a message published on another shard to this one. Safe to call
+        from any thread, the message is delivered on this manager's IOLoop.
+
+        :param str channel:
+        :param str message: Serialized message packet
+        :param int priority:
+        :param float expires:
+        :param dict packet: The message packet, read only
+        """
+
+        self._inbox.append((channel, message, priority, expires, packet))
+
+        if not self._inbox_scheduled:
+            self._inbox_scheduled = True
+            self.loop.add_callback(self._process_inbox)
+
+    def _process_inbox(self):
+        """
+        Deliver messages handed over from other shards
+        """
+
+        # Clear the flag first, so anything added from now on is either
+        # processed by this loop or schedules a new call
+        self._inbox_scheduled = False
+
+        inbox = self._inbox
+        while inbox:
+            self._deliver(*inbox.popleft())
+
+
+def _get_priority(priority, ttl):
+    """
+    Validate the priority and ttl of a message
+
+    :param int priority:
+    :param float ttl: Seconds, None for never expiring
+    :return tuple: (priority, expiry timestamp or None)
+    :raises ValueError: If either isn't a finite number
+    """
+
+    try:
+        # Also rejects infinity and NaN
+        priority = int(priority)
+        if ttl is None:
+            return priority, None
+
+        ttl = float(ttl)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid priority or ttl")
+
+    if not isfinite(ttl):
+        raise ValueError("Invalid priority or ttl")
+
+    return priority, time() + ttl
+
+
+def _parse_message(message):
+    """
+    :param str|DeltaMessage message: Serialized message
+    :return dict: The message packet
+    """
+
+    if message.__class__ is DeltaMessage:
+        return json.loads(message.full)
+
+    return json.loads(message)
+
+
+def _get_handler(manager):
+    """
+    Returns the WebSocket handler, giving it access to the connection manager
+
+    :param ConnectionManager manager:
+    :return:
+    """
+
+    class SocketHandler(websocket.WebSocketHandler):
+        """
+        Handler for all communications over WebSockets
+        """
+
+        def check_origin(self, origin):
+            """
+            This is a security protection against cross site scripting attacks
+            on browsers, since WebSockets are allowed to bypass the usual
+            same-origin policies and don't use CORS headers.
+
+            In the current system there is no need for this yet, thus we allow
+            all.
+
+            :param origin:
+            :return:
+            """
+
+            return True
+
+        def get(self, *args, **kwargs):
+            """
+            Reject new clients before upgrading to a WebSocket when the server
+            is overloaded, asking them to come back later
+            """
+
+            retry_after = manager.check_admission()
+            if retry_after is not None:
+                self.set_status(503)
+                self.set_header("Retry-After", str(retry_after))
+                self.finish()
+                return
+
+            return super(SocketHandler, self).get(*args, **kwargs)
+
+        def open(self):
+            """
+            Called when a new connection is opened by a client
+            """
+            manager.on_open(self)
+
+        def on_message(self, message):
+            """
+            Called when a client sends a message of any kind
+
+            :param str message:
+            :return Future: Tornado waits for it before reading more
+            """
+            return manager.on_message(self, message)
+
+        def on_pong(self, data):
+            """
+            Called when a client answers a ping
+
+            :param bytes data:
+            """
+            manager.on_pong(self)
+
+        def is_writing(self):
+            """
+            Check if there is data waiting to be written to the client
+
+            :return bool:
+            """
+
+            connection = self.ws_connection
+            return connection is not None and connection.stream.writing()
+
+        def get_write_buffer_size(self):
+            """
+            Number of bytes waiting to be written to the client
+
+            :return int:
+            """
+
+            connection = self.ws_connection
+            if connection is None:
+                return 0
+
+            return get_write_buffer_size(connection.stream)
+
+        def on_close(self):
+            """
+            Called when a client connection is closed
+            """
+            manager.on_close(self)
+
+    return SocketHandler
+
+
+class Server(object):
+    """
+    Main manager for the server application
+    """
+
+    def __init__(self, settings, logger):
+        self.settings = settings
+        self.logger = logger
+        self.manager = ConnectionManager(settings, logger)
+        self.app = self._get_app(self.manager)
+        self.ingest = None
+        self.admin = None
+        self._stats_callback = None
+        self._stopped = None
+        self._draining = None
+        self.capture = None
+
+        # The first shard runs on the main event loop, any others in their
+        # own threads, each with their own connections and handing published
+        # messages over to each other
+        self.shards = [Shard(0, self.manager, self.app, logger)]
+        for index in range(1, settings.SHARDS):
+            manager = ConnectionManager(settings, logger)
+            self.shards.append(
+                Shard(index, manager, self._get_app(manager), logger)
+            )
+
+        managers = self.get_managers()
+        for manager in managers:
+            manager.peers = [peer for peer in managers if peer is not manager]
+            # Delta versions need to be the same on every shard
+            manager.delta = self.manager.delta
+            # Channel and handshake rate limits are for the whole server
+            manager.rate_limiter.share_channels(self.manager.rate_limiter)
+            manager.admission.share_handshakes(self.manager.admission)
+
+    def _get_app(self, manager):
+        """
+        Create the Tornado application for a connection manager
+
+        :param ConnectionManager manager:
+        :return tornado.web.Application:
+        """
+
+        handlers = [
+            (r'/', _get_handler(manager))
+        ]
+
+        if self.settings.ADMIN_KEY and not self.settings.ADMIN_PORT:
+            handlers.extend(get_admin_handlers(self))
+
+        options = {}
+        # Tornado checks this before reading the message at all
+        if self.settings.MAX_MESSAGE_BYTES:
+            options["websocket_max_message_size"] = \
+                self.settings.MAX_MESSAGE_BYTES
+
+        return web.Application(
+            handlers,
+            autoreload=self.settings.DEBUG,
+            debug=self.settings.DEBUG,
+            **options
+        )
+
+    def get_managers(self):
+        """
+        All the connection managers, one for each shard
+
+        :return list:
+        """
+
+        return [shard.manager for shard in self.shards]
+
+    def publish(self, channel, data, priority=0, ttl=None):
+        """
+        Publish a message to the subscribers on every shard, without going
+        through a socket. Must be called on the IOLoop the server was started
+        on, use IOLoop.add_callback() from other threads.
+
+        See ConnectionManager.publish
+        """
+
+        self.manager.publish(channel, data, priority, ttl)
+
+    def subscribe(self, channel, callback):
+        """
+        Call a function on the server's IOLoop with the packet of every
+        message published on the channel.
+
+        See ConnectionManager.subscribe
+        """
+
+        self.manager.subscribe(channel, callback)
+
+    def unsubscribe(self, channel, callback):
+        """
+        See ConnectionManager.unsubscribe
+        """
+
+        self.manager.unsubscribe(channel, callback)
+
+    def run(self):
+        """
+        Run the server on a new event loop, until it's stopped with a signal
+        """
+
+        loop = new_event_loop(self.settings.EVENT_LOOP, self.logger)
+        asyncio.set_event_loop(loop)
+
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+
+        self.logger.info("Event loop closed")
+
+    async def serve(self):
+        """
+        Run the server on the current event loop until it's stopped with
+        stop() or a signal
+        """
+
+        self._stopped = asyncio.Event()
+        loop = asyncio.get_event_loop()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self._on_signal, signum)
+            except NotImplementedError:
+                # Windows, the handler can run at any point
+                signal.signal(signum, lambda s, f: loop.call_soon_threadsafe(
+                    self._on_signal, s
+                ))
+
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self._on_reload_signal)
+
+        self.start()
+        await self._stopped.wait()
+
+        for shard in self.shards[1:]:
+            await loop.run_in_executor(None, shard.thread.join)
+
+    def _on_signal(self, signum):
+        self.logger.info("Caught signal {}".format(signum))
+
+        if self._draining is None:
+            self._draining = asyncio.ensure_future(self.drain())
+        else:
+            self.logger.info("Already draining, stopping immediately")
+            self.stop()
+
+    def _on_reload_signal(self):
+        self.logger.info("Caught SIGHUP, reloading settings")
+        asyncio.ensure_future(self.reload())
+
+    async def reload(self):
+        """
+        Reload the channel rules and keys from the settings, without dropping
+        any connections
+
+        :return bool: If the settings were reloaded
+        """
+
+        loop = asyncio.get_event_loop()
+
+        try:
+            settings = await loop.run_in_executor(
+                None, _load_fresh_settings, self.settings
+            )
+            await asyncio.gather(*[
+                shard.reload(settings) for shard in self.shards
+            ])
+        except Exception:
+            self.logger.exception("Failed to reload settings")
+            return False
+
+        for name in RELOADABLE_SETTINGS:
+            setattr(self.settings, name, getattr(settings, name))
+
+        self.logger.info("Settings reloaded")
+        return True
+
+    async def drain(self):
+        """
+        Stop accepting new clients, close the existing ones gradually within
+        DRAIN_SECONDS, and then stop the server
+        """
+
+        self.logger.info("Draining connections for up to {} seconds".format(
+            self.settings.DRAIN_SECONDS
+        ))
+
+        if self.ingest is not None:
+            self.ingest.stop()
+            self.ingest = None
+
+        deadline = time() + self.settings.DRAIN_SECONDS
+        await asyncio.gather(*[
+            shard.drain(deadline) for shard in self.shards
+        ])
+
+        self.logger.info("Connections drained")
+        self.stop()
+
+    def start(self):
+        """
+        Start the server on the current IOLoop
+        """
+
+        self.logger.info("Listening to {addr}:{port}".format(
+            addr=self.settings.LISTEN_ADDRESS,
+            port=self.settings.LISTEN_PORT
+        ))
+
+        sockets = bind_sockets(self.settings.LISTEN_PORT,
+                               self.settings.LISTEN_ADDRESS)
+
+        self._start_capture()
+
+        self.shards[0].listen(sockets)
+        for shard in self.shards[1:]:
+            shard.start(sockets, self.settings.EVENT_LOOP)
+
+        # Shards listen to copies of these
+        for sock in sockets:
+            sock.close()
+
+        self._start_ingest()
+        self._start_admin()
+
+        self._stats_callback = ioloop.PeriodicCallback(
+            self.show_stats, self.settings.STATS_SECONDS * 1000
+        )
+        self._stats_callback.start()
+
+    def _start_ingest(self):
+        """
+        Start the local ingest listener, if one is configured
+        """
+
+        unix_socket = self.settings.INGEST_UNIX_SOCKET
+        port = self.settings.INGEST_PORT
+
+        if not unix_socket and not port:
+            return
+
+        self.ingest = IngestServer(
+            self.manager,
+            self.settings.INGEST_MAX_FRAME_BYTES
+        )
+
+        if unix_socket:
+            self.logger.info("Ingest listening to {}".format(unix_socket))
+            self.ingest.listen_unix(unix_socket)
+
+        if port:
+            self.logger.info("Ingest listening to {addr}:{port}".format(
+                addr=self.settings.INGEST_ADDRESS,
+                port=port
+            ))
+            self.ingest.listen(port=port,
+                               address=self.settings.INGEST_ADDRESS)
+
+    def _start_admin(self):
+        """
+        Start the admin API on its own port, if one is configured
+        """
+
+        port = self.settings.ADMIN_PORT
+        if not port:
+            return
+
+        self.logger.info("Admin API listening to {addr}:{port}".format(
+            addr=self.settings.ADMIN_ADDRESS,
+            port=port
+        ))
+
+        self.admin = HTTPServer(web.Application(get_admin_handlers(self)))
+        self.admin.listen(port, address=self.settings.ADMIN_ADDRESS)
+
+    def _start_capture(self):
+        """
+        Start recording what clients send, if CAPTURE_FILE is set
+        """
+
+        if not self.settings.CAPTURE_FILE:
+            return
+
+        self.logger.info("Capturing traffic to {}".format(
+            self.settings.CAPTURE_FILE
+        ))
+
+        self.capture = Capture(self.settings.CAPTURE_FILE, time())
+        for manager in self.get_managers():
+            manager.capture = self.capture
+
+    def stop(self):
+        """
+        Stop the server, must be called on the IOLoop it was started on
+        """
+
+        self.logger.info("Stopping server")
+
+        if self.ingest is not None:
+            self.ingest.stop()
+
+        if self.admin is not None:
+            self.admin.stop()
+
+        if self._stats_callback is not None:
+            self._stats_callback.stop()
+
+        for shard in self.shards:
+            shard.stop()
+
+        if self.capture is not None:
+            self.capture.close(time())
+
+        if self._stopped is not None:
+            self._stopped.set()
 
     def show_stats(self):
         """
         Called periodically to show the system stats
         """
 
-        self.logger.info("Connected clients: {}".format(_connections))
\ No newline at end of file
+        self.logger.info("Connected clients: {}".format(
+            self.manager.get_total_connections()
+        ))
+
+        counters = defaultdict(int)
+        for manager in self.get_managers():
+            for name, value in manager.stats.items():
+                counters[name] += value
+
+        if counters:
+            self.logger.info("Counters: {}".format(", ".join(
+                "{}={}".format(name, value)
+                for name, value in sorted(counters.items())
+            )))
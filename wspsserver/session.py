@@ -0,0 +1,87 @@
+import json
+
+from wspsserver.connection import ConnectionState
+
+
+def add_field(message, name, value):
+    """
+    Add a field to a serialized JSON object without parsing it again
+
+    :param str message: Serialized JSON object with at least one field, as
+                        created by json.dumps()
+    :param str name: Name of the field
+    :param str value: Serialized value
+    :return str:
+    """
+
+    return '{}, "{}": {}}}'.format(message[:-1], name, value)
+
+
+class Session(object):
+    """
+    wspsserver.session.Session
+
+    A logical session multiplexed over a gateway connection, e.g. one end
+    user of an edge gateway. Provides the same interface as the WebSocket
+    handler, so ConnectionManager can authenticate, rate limit and answer
+    sessions like connections. Packets written to a session are sent to the
+    gateway with the session id in a "session" field, and closing a session
+    only ends the session.
+
+    Messages published on channels are not written to sessions, the gateway
+    gets one copy for all of its sessions instead, see
+    ConnectionManager._tag_sessions.
+    """
+
+    __slots__ = (
+        "manager",
+        "gateway",
+        "gateway_state",
+        "id",
+        "request",
+        "state",
+        "active",
+    )
+
+    def __init__(self, manager, gateway, gateway_state, session_id, now):
+        """
+        :param wspsserver.server.ConnectionManager manager:
+        :param gateway: Handler for the gateway connection
+        :param ConnectionState gateway_state: State of the gateway connection
+        :param str|int session_id: Id for the session chosen by the gateway
+        :param float now: Current timestamp
+        """
+
+        self.manager = manager
+        self.gateway = gateway
+        self.gateway_state = gateway_state
+        self.id = session_id
+        self.request = gateway.request
+        self.state = ConnectionState(
+            gateway_state.id, gateway_state.remote_ip, now, False
+        )
+        self.active = True
+
+    def write_message(self, message):
+        """
+        Send a serialized WSPS packet to the session through the gateway
+
+        :param str message:
+        """
+
+        self.gateway.write_message(
+            add_field(message, "session", json.dumps(self.id))
+        )
+
+    def close(self, code=None, reason=None):
+        """
+        End the session, the gateway connection stays open
+
+        :param int code: Ignored, sessions don't have close codes
+        :param str reason: Sent to the gateway
+        """
+
+        self.manager.end_session(self, reason or "Closed")
+
+    def get_write_buffer_size(self):
+        return self.gateway.get_write_buffer_size()
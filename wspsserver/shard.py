@@ -0,0 +1,185 @@
+import asyncio
+import threading
+from time import time
+
+from tornado import ioloop
+from tornado.httpserver import HTTPServer
+
+
+def new_event_loop(name, logger):
+    """
+    Create a new asyncio event loop of the configured type
+
+    :param str name: "asyncio" or "uvloop"
+    :param logger:
+    :return asyncio.AbstractEventLoop:
+    """
+
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("uvloop is not installed, using asyncio")
+        else:
+            return uvloop.new_event_loop()
+    elif name != "asyncio":
+        raise ValueError("EVENT_LOOP \"{}\" is not valid.".format(name))
+
+    return asyncio.new_event_loop()
+
+
+class Shard(object):
+    """
+    wspsserver.shard.Shard
+
+    An IOLoop accepting WebSocket connections, with its own ConnectionManager.
+    The first shard runs on the server's main event loop, any others run in
+    their own threads. All shards accept connections from the same listening
+    sockets, and published messages are handed between the shards' managers,
+    so every shard writes to its own clients in parallel.
+    """
+
+    # Seconds between periodic checks
+    interval = 0.25
+
+    def __init__(self, index, manager, app, logger):
+        self.index = index
+        self.manager = manager
+        self.app = app
+        self.logger = logger
+        self.loop = None
+        self.thread = None
+        self.http_server = None
+        self._periodic = None
+        self._stopped = None
+        self._next_check = None
+
+    def listen(self, sockets):
+        """
+        Start accepting connections and running periodic checks on the
+        current IOLoop
+
+        :param list sockets: Listening sockets shared with the other shards,
+                             the caller is responsible for closing them
+        """
+
+        self.loop = ioloop.IOLoop.current()
+        self.manager.loop = self.loop
+
+        # Every shard gets its own copies of the sockets, so they can stop
+        # accepting connections independently
+        self.http_server = HTTPServer(self.app)
+        self.http_server.add_sockets([sock.dup() for sock in sockets])
+
+        self._next_check = time() + self.interval
+        self._periodic = ioloop.PeriodicCallback(
+            self._check, self.interval * 1000
+        )
+        self._periodic.start()
+
+    def start(self, sockets, event_loop):
+        """
+        Start the shard in its own thread, accepting connections from the
+        sockets
+
+        :param list sockets: Listening sockets shared with the other shards
+        :param str event_loop: Type of event loop to run, see new_event_loop
+        """
+
+        started = threading.Event()
+
+        def _run():
+            loop = new_event_loop(event_loop, self.logger)
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self._serve(sockets, started))
+            finally:
+                loop.close()
+
+            self.logger.info("IOLoop for shard {} closed".format(self.index))
+
+        self.thread = threading.Thread(target=_run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+
+    async def _serve(self, sockets, started):
+        self._stopped = asyncio.Event()
+        self.listen(sockets)
+
+        self.logger.info("Started IOLoop for shard {}".format(self.index))
+        started.set()
+
+        await self._stopped.wait()
+
+    def stop_accepting(self):
+        """
+        Stop accepting new connections, must be called on the shard's IOLoop
+        """
+
+        if self.http_server is not None:
+            self.http_server.stop()
+            self.http_server = None
+
+    def drain(self, deadline):
+        """
+        Stop accepting new connections and close the existing ones gradually,
+        see ConnectionManager.drain. Safe to call from any thread.
+
+        :param float deadline: Timestamp by which everything should be closed
+        :return asyncio.Future: Resolved once drained
+        """
+
+        async def _drain():
+            self.stop_accepting()
+            await self.manager.drain(deadline)
+
+        return self.run(_drain())
+
+    def reload(self, settings):
+        """
+        Switch the shard's manager to new channel rules and keys, see
+        ConnectionManager.reload. Safe to call from any thread.
+
+        :param module settings: Freshly loaded application settings
+        :return asyncio.Future: Resolved once reloaded
+        """
+
+        return self.run(self.manager.reload(settings))
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the shard's IOLoop
+
+        :param coroutine:
+        :return asyncio.Future: Future for the result, for the current loop
+        """
+
+        if self.loop is None or self.loop is ioloop.IOLoop.current():
+            return asyncio.ensure_future(coroutine)
+
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            coroutine, self.loop.asyncio_loop
+        ))
+
+    def stop(self):
+        """
+        Stop the shard, safe to call from any thread
+        """
+
+        if self.loop is not None:
+            self.loop.add_callback(self._stop)
+
+    def _stop(self):
+        self.stop_accepting()
+
+        if self._periodic is not None:
+            self._periodic.stop()
+
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def _check(self):
+        current = time()
+        self.manager.periodic(current, max(0, current - self._next_check))
+        self._next_check = current + self.interval
@@ -0,0 +1,173 @@
+import json
+
+from mock import Mock, patch
+from tornado.testing import AsyncHTTPTestCase
+
+from wspsserver.server import Server
+from wspsserver.test.test_server import Settings, Handler, logger
+
+
+class TestAdmin(AsyncHTTPTestCase):
+    def get_app(self):
+        settings = Settings()
+        settings.ADMIN_KEY = "secret"
+        self.server = Server(settings, logger)
+        return self.server.app
+
+    def get(self, path, key="secret", method="GET", body=None):
+        headers = {"X-Admin-Key": key} if key is not None else {}
+        response = self.fetch(path, headers=headers, method=method, body=body)
+        if response.code != 200:
+            return response.code, None
+
+        return response.code, json.loads(response.body)
+
+    def connect(self, write_buffer=0):
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.close = Mock()
+        handler.get_write_buffer_size = Mock(return_value=write_buffer)
+        self.server.manager.on_open(handler)
+        return handler
+
+    def test_key_required(self):
+        self.assertEqual(self.get("/admin/presence?channel=a", None)[0], 403)
+        self.assertEqual(self.get("/admin/presence?channel=a", "")[0], 403)
+        self.assertEqual(self.get("/admin/presence?channel=a", "abc")[0], 403)
+
+        # Not in the query, it would end up in access logs
+        response = self.fetch("/admin/presence?channel=a&key=secret")
+        self.assertEqual(response.code, 403)
+
+        self.assertEqual(self.get("/admin/presence?channel=a")[0], 200)
+
+    def test_presence(self):
+        manager = self.server.manager
+        handler = Handler()
+        manager.on_open(handler)
+        manager._subscribe(handler, "test", None)
+
+        code, body = self.get("/admin/presence?channel=test")
+        self.assertEqual(body, {"channel": "test", "count": 1})
+
+        code, body = self.get("/admin/presence?channel=test&ids=1")
+        self.assertEqual(body["ids"], [manager.connections[handler].id])
+
+        code, body = self.get("/admin/presence?channel=other")
+        self.assertEqual(body["count"], 0)
+
+    def test_channels(self):
+        manager = self.server.manager
+        publisher = self.connect()
+        subscriber = self.connect()
+        manager._subscribe(subscriber, "test", None)
+        manager._subscribe(subscriber, "quiet", None)
+
+        for _ in range(3):
+            manager._message(publisher, "test", {"data": "abc"}, None)
+        manager._message(publisher, "nobody", {"data": "abc"}, None)
+
+        code, body = self.get("/admin/channels")
+        self.assertEqual(body["total"], 3)
+
+        channels = body["channels"]
+        self.assertEqual(
+            [info["channel"] for info in channels],
+            ["test", "nobody", "quiet"]
+        )
+        self.assertEqual(channels[0]["subscribers"], 1)
+        self.assertEqual(channels[0]["messages"], 3)
+        self.assertTrue(channels[0]["bytes"] > 0)
+        self.assertTrue(channels[0]["rate"] > channels[1]["rate"] > 0)
+        self.assertEqual(channels[1]["subscribers"], 0)
+        self.assertEqual(channels[2]["messages"], 0)
+
+        code, body = self.get("/admin/channels?limit=1")
+        self.assertEqual(body["total"], 3)
+        self.assertEqual(
+            [info["channel"] for info in body["channels"]], ["test"]
+        )
+
+        code, body = self.get("/admin/channels?limit=abc")
+        self.assertEqual(code, 400)
+
+    def test_connections(self):
+        manager = self.server.manager
+        idle = self.connect()
+        backlogged = self.connect(write_buffer=1000)
+        manager._subscribe(backlogged, "test", "key")
+
+        code, body = self.get("/admin/connections")
+        self.assertEqual(body["total"], 2)
+
+        info = body["connections"][0]
+        self.assertEqual(info["id"], manager.connections[backlogged].id)
+        self.assertEqual(info["write_buffer"], 1000)
+        self.assertEqual(info["subscriptions"], ["test"])
+        self.assertEqual(info["shard"], 0)
+
+        code, body = self.get("/admin/connections?channel=test")
+        self.assertEqual(body["total"], 1)
+
+        # Clients with messages queued for them come first, without looking
+        # at every connection
+        queued = self.connect(write_buffer=500)
+        manager._outbound[queued] = []
+        code, body = self.get("/admin/connections?limit=1")
+        self.assertEqual(body["total"], 3)
+        self.assertEqual(
+            body["connections"][0]["id"], manager.connections[queued].id
+        )
+        self.assertEqual(
+            manager.get_backlogged_connections(2), [queued, idle]
+        )
+
+        # Same for the subscribers of a channel
+        manager._subscribe(idle, "test", "key")
+        manager._subscribe(queued, "test", "key")
+        code, body = self.get("/admin/connections?channel=test&limit=1")
+        self.assertEqual(body["total"], 3)
+        self.assertEqual(
+            body["connections"][0]["id"], manager.connections[queued].id
+        )
+        self.assertEqual(
+            manager.get_backlogged_connections(2, "test"), [queued, backlogged]
+        )
+        self.assertEqual(manager.get_backlogged_connections(2, "other"), [])
+
+        idle_id = manager.connections[idle].id
+        code, body = self.get("/admin/connections/{}".format(idle_id))
+        self.assertEqual(body["id"], idle_id)
+        self.assertEqual(body["remote_ip"], "127.0.0.1")
+
+        code, body = self.get("/admin/connections/123456789")
+        self.assertEqual(code, 404)
+
+    def test_disconnect(self):
+        handler = self.connect()
+        connection_id = self.server.manager.connections[handler].id
+        path = "/admin/connections/{}".format(connection_id)
+
+        code, body = self.get(path, method="DELETE")
+        self.assertEqual(code, 204)
+        handler.close.assert_called_once_with(1008, "Disconnected by admin")
+
+        self.server.manager.on_close(handler)
+        code, body = self.get(path, method="DELETE")
+        self.assertEqual(code, 404)
+
+    def test_reload(self):
+        settings = Settings()
+        settings.ALLOWED_CHANNELS = ("public",)
+
+        with patch("wspsserver.server._load_fresh_settings",
+                   return_value=settings):
+            code, body = self.get("/admin/reload", method="POST", body="")
+
+        self.assertEqual(body, {"reloaded": True})
+        self.assertFalse(self.server.manager._is_channel_valid("private"))
+        self.assertEqual(self.server.settings.ALLOWED_CHANNELS, ("public",))
+
+        # Settings that aren't a module can't be reloaded
+        code, body = self.get("/admin/reload", method="POST", body="")
+        self.assertEqual(code, 500)
@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+from wspsserver.admission import AdmissionController
+from wspsserver.server import ConnectionManager, _get_handler
+from wspsserver.test.test_server import Settings, Handler, logger
+
+
+class TestAdmissionController(TestCase):
+    def test_unlimited(self):
+        ac = AdmissionController(0, 0, 0, 0, 5, 100.0)
+        ac.update_lag(10)
+
+        for _ in range(1000):
+            self.assertIsNone(ac.check(100000, 100.0))
+
+    def test_max_connections(self):
+        ac = AdmissionController(10, 0, 0, 0, 5, 100.0)
+
+        self.assertIsNone(ac.check(9, 100.0))
+
+        reason, retry_after = ac.check(10, 100.0)
+        self.assertEqual(reason, "connections")
+        self.assertTrue(5 <= retry_after <= 10)
+
+    def test_handshake_rate(self):
+        ac = AdmissionController(0, 1, 2, 0, 5, 100.0)
+
+        self.assertIsNone(ac.check(0, 100.0))
+        self.assertIsNone(ac.check(0, 100.0))
+
+        reason, retry_after = ac.check(0, 100.0)
+        self.assertEqual(reason, "handshakes")
+        self.assertTrue(5 <= retry_after <= 10)
+
+        self.assertIsNone(ac.check(0, 101.0))
+
+    def test_share_handshakes(self):
+        first = AdmissionController(0, 1, 1, 0.5, 5, 100.0)
+        second = AdmissionController(0, 1, 1, 0.5, 5, 100.0)
+        second.share_handshakes(first)
+
+        self.assertIsNone(first.check(0, 100.0))
+        self.assertEqual(second.check(0, 100.0)[0], "handshakes")
+
+        # Lag is measured separately for each IOLoop
+        first.update_lag(1.0)
+        self.assertIsNone(second.check(0, 101.0))
+
+    def test_lag(self):
+        ac = AdmissionController(0, 0, 0, 0.5, 5, 100.0)
+
+        ac.update_lag(0.1)
+        self.assertIsNone(ac.check(0, 100.0))
+
+        ac.update_lag(1.0)
+        reason, retry_after = ac.check(0, 100.0)
+        self.assertEqual(reason, "lag")
+
+        # Lag decays gradually
+        ac.update_lag(0)
+        self.assertEqual(ac.check(0, 100.0)[0], "lag")
+        for _ in range(10):
+            ac.update_lag(0)
+        self.assertIsNone(ac.check(0, 100.0))
+
+
+class TestSocketHandlerAdmission(AsyncHTTPTestCase):
+    def get_app(self):
+        settings = Settings()
+        settings.MAX_CONNECTIONS = 1
+        self.manager = ConnectionManager(settings, logger)
+
+        return web.Application([(r'/', _get_handler(self.manager))])
+
+    def test_rejected(self):
+        self.manager.on_open(Handler())
+
+        response = self.fetch("/")
+        self.assertEqual(response.code, 503)
+        self.assertTrue(5 <= int(response.headers["Retry-After"]) <= 10)
+        self.assertEqual(self.manager.stats["rejected_connections"], 1)
+
+    def test_accepted(self):
+        # Not a WebSocket request, so accepted but not upgraded
+        response = self.fetch("/")
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.manager.stats["rejected_connections"], 0)
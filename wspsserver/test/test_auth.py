@@ -1,6 +1,7 @@
+from time import time
 from unittest import TestCase
 from wspsserver.auth import BaseAuthManager, NullAuthManager, \
-    SettingsAuthManager
+    SettingsAuthManager, TokenAuthManager, make_token
 
 
 class Settings(object):
@@ -14,6 +15,9 @@ class Settings(object):
         "another-channel": "cba321"
     }
 
+    TOKEN_SECRET = "secret"
+    TOKEN_CACHE_SIZE = 10
+
 
 class TestBaseAuthManager(TestCase):
     def test_authenticate(self):
@@ -171,3 +175,109 @@ class TestSettingsAuthManager(TestCase):
             True
         )
 
+
+class TestTokenAuthManager(TestCase):
+    def test_authenticate(self):
+        am = TokenAuthManager(Settings())
+        token = make_token(
+            "secret",
+            subscribe=["public", "user/1/*"],
+            publish=["user/1/*"],
+            expires=time() + 60
+        )
+
+        self.assertTrue(am.authenticate("subscribe", "public", token))
+        self.assertTrue(am.authenticate("subscribe", "user/1/chat", token))
+        self.assertTrue(am.authenticate("publish", "user/1/chat", token))
+        self.assertFalse(am.authenticate("publish", "public", token))
+        self.assertFalse(am.authenticate("subscribe", "user/2/chat", token))
+
+        with self.assertRaises(ValueError):
+            am.authenticate("invalid-event", "public", token)
+
+    def test_invalid_tokens(self):
+        am = TokenAuthManager(Settings())
+        token = make_token("wrong secret", subscribe=["*"])
+        payload, signature = make_token("secret", subscribe=["*"]).split(".")
+
+        for key in (None, "", "abc", "a.b.c", token, payload + ".abc",
+                    payload + "." + signature[:-2], ["a", "list"]):
+            self.assertFalse(am.authenticate("subscribe", "public", key))
+
+        self.assertTrue(am.authenticate(
+            "subscribe", "public", payload + "." + signature
+        ))
+
+    def test_expiry(self):
+        am = TokenAuthManager(Settings())
+        now = time()
+        token = make_token("secret", publish=["*"], expires=now + 60)
+
+        self.assertNotEqual(am.get_grant(token, now), None)
+        self.assertNotEqual(am.get_grant(token, now + 59), None)
+        self.assertEqual(am.get_grant(token, now + 60), None)
+
+    def test_cache(self):
+        am = TokenAuthManager(Settings())
+        now = time()
+
+        token = make_token("secret", publish=["*"])
+        grant = am.get_grant(token, now)
+        self.assertTrue(am.get_grant(token, now) is grant)
+
+        expired = make_token("secret", publish=["*"], expires=now + 1)
+        am.get_grant(expired, now)
+
+        for index in range(20):
+            am.get_grant(make_token("secret", publish=[str(index)]), now + 2)
+            self.assertTrue(len(am._grants) <= 10)
+
+        # Expired tokens are dropped first, then the oldest ones
+        self.assertFalse(expired.split(".")[1] in am._grants)
+        self.assertFalse(token.split(".")[1] in am._grants)
+
+    def test_cache_invalid(self):
+        am = TokenAuthManager(Settings())
+        token = make_token("secret", subscribe=["*"])
+        payload, signature = token.split(".")
+
+        for key in ("abc", payload + ".abc", make_token("wrong", ["*"]),
+                    token + "x" * 5000):
+            self.assertEqual(am.get_grant(key), None)
+        self.assertEqual(am._grants, {})
+
+        # A cached signature doesn't work with another payload
+        self.assertNotEqual(am.get_grant(token), None)
+        other = make_token("secret", publish=["*"]).split(".")[0]
+        self.assertEqual(am.get_grant(other + "." + signature), None)
+
+    def test_grant_cache(self):
+        am = TokenAuthManager(Settings())
+        grant = am.get_grant(make_token("secret", subscribe=["user/*"]))
+
+        for index in range(1000):
+            grant.allows("subscribe", "user/{}".format(index))
+
+        self.assertTrue(len(grant._channels["subscribe"]._cache) <= 100)
+
+    def test_secret_required(self):
+        settings = Settings()
+        settings.TOKEN_SECRET = None
+
+        with self.assertRaises(ValueError):
+            TokenAuthManager(settings)
+
+
+class TestKeyGrant(TestCase):
+    def test_allows(self):
+        am = SettingsAuthManager(Settings())
+        grant = am.get_grant("foobar")
+
+        self.assertTrue(grant.allows("subscribe", "a-channel"))
+        self.assertFalse(grant.allows("publish", "a-channel"))
+        self.assertTrue(grant.allows("publish", "other-channel"))
+        self.assertEqual(grant.expires, None)
+
+        # Decisions are cached
+        am.authenticate = None
+        self.assertTrue(grant.allows("subscribe", "a-channel"))
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import Mock
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from wspsserver import capture
+from wspsserver.capture import Capture, CaptureRecord, read_capture
+from wspsserver.replay import Replay, make_packet
+from wspsserver.server import ConnectionManager, Server
+from wspsserver.test.test_server import Settings, Handler, logger
+
+
+class TestCapture(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "capture.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        recorder = Capture(self.path, 100.0)
+        recorder.record(100.0, 1, capture.OPEN)
+        recorder.record_packet(100.5, 1, {
+            "type": "publish",
+            "channel": "chat/äö",
+            "key": "secret",
+            "data": "hello"
+        }, 80)
+        recorder.record_packet(101.0, 1, [], 2)
+        recorder.record(101.5, 1, capture.CLOSE)
+
+        # Nothing is written until it's time to flush
+        self.assertEqual(recorder.flush(100.5), None)
+        recorder.flush(101.5).result()
+        recorder.close(102.0)
+
+        records = list(read_capture(self.path))
+        self.assertEqual(records, [
+            CaptureRecord(100.0, 1, capture.OPEN, 0, 0, ""),
+            CaptureRecord(100.5, 1, capture.PUBLISH, 80,
+                          capture.redact_key("secret"), "chat/äö"),
+            CaptureRecord(101.0, 1, capture.INVALID, 2, 0, ""),
+            CaptureRecord(101.5, 1, capture.CLOSE, 0, 0, ""),
+        ])
+
+        with open(self.path, "rb") as f:
+            self.assertFalse(b"secret" in f.read())
+
+    def test_manager(self):
+        cm = ConnectionManager(Settings(), logger)
+        cm.capture = Capture(self.path, 0)
+
+        handler = Handler()
+        handler.close = Mock()
+        cm.on_open(handler)
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "test"
+        }))
+        cm.on_message(handler, "{invalid")
+        cm.on_close(handler)
+        cm.capture.close(0)
+
+        self.assertEqual(
+            [(record.event, record.channel) for record in
+             read_capture(self.path)],
+            [
+                (capture.OPEN, ""),
+                (capture.SUBSCRIBE, "test"),
+                (capture.INVALID, ""),
+                (capture.CLOSE, ""),
+            ]
+        )
+
+    def test_invalid_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"something else")
+
+        self.assertRaises(ValueError, list, read_capture(self.path))
+
+
+class TestReplay(AsyncHTTPTestCase):
+    def get_app(self):
+        self.server = Server(Settings(), logger)
+        return self.server.app
+
+    def test_make_packet(self):
+        record = CaptureRecord(0, 1, capture.PUBLISH, 200, 0, "test")
+        packet = make_packet(record)
+        self.assertEqual(len(packet), 200)
+        self.assertEqual(json.loads(packet)["channel"], "test")
+
+        record = CaptureRecord(0, 1, capture.AUTH, 20, 123, "")
+        self.assertEqual(make_packet(record), None)
+
+    @gen_test
+    def test_replay(self):
+        url = "ws://127.0.0.1:{}/".format(self.get_http_port())
+        records = [
+            CaptureRecord(10.0, 1, capture.OPEN, 0, 0, ""),
+            CaptureRecord(10.1, 1, capture.SUBSCRIBE, 40, 0, "test"),
+            # Connected before capturing started
+            CaptureRecord(10.2, 2, capture.SUBSCRIBE, 40, 0, "test"),
+            CaptureRecord(10.3, 3, capture.OPEN, 0, 0, ""),
+            CaptureRecord(10.4, 3, capture.PUBLISH, 100, 0, "test"),
+            CaptureRecord(10.5, 3, capture.PUBLISH, 100, 0, "test"),
+            CaptureRecord(10.6, 3, capture.CLOSE, 0, 0, ""),
+        ]
+
+        stats = yield Replay(url, speed=10).replay(records)
+        self.assertEqual(stats["connected"], 3)
+        self.assertEqual(stats["sent"], 4)
+        self.assertTrue(stats["elapsed"] >= 0.05)
+        self.assertEqual(self.server.manager.stats["clients_opened"], 3)
+
+    @gen_test
+    def test_rejected(self):
+        url = "ws://127.0.0.1:{}/".format(self.get_http_port())
+        records = [
+            CaptureRecord(10.0, 1, capture.OPEN, 0, 0, ""),
+            CaptureRecord(10.1, 2, capture.OPEN, 0, 0, ""),
+            CaptureRecord(10.2, 2, capture.SUBSCRIBE, 40, 0, "test"),
+        ]
+
+        # Every handshake is rejected with a 503
+        self.server.manager.admission.check = Mock(
+            return_value=("connections", 1)
+        )
+
+        stats = yield Replay(url, speed=10).replay(records)
+        self.assertEqual(stats["failed"], 2)
+        self.assertFalse("connected" in stats)
@@ -0,0 +1,28 @@
+from unittest import TestCase
+
+from wspsserver.channel import ChannelStats
+
+
+class TestChannelStats(TestCase):
+    def test_add(self):
+        stats = ChannelStats(100.0)
+        stats.add(10, 100.0)
+        stats.add(20, 100.0)
+
+        self.assertEqual(stats.messages, 2)
+        self.assertEqual(stats.bytes, 30)
+        self.assertAlmostEqual(stats.get_rate(100.0), 0.2)
+
+    def test_rate(self):
+        stats = ChannelStats(100.0)
+        self.assertEqual(stats.get_rate(100.0), 0)
+
+        # A steady 5 messages per second
+        for tick in range(1000):
+            stats.add(1, 100.0 + tick / 5.0)
+
+        self.assertAlmostEqual(stats.get_rate(300.0), 5, delta=0.5)
+
+        # Decays once the messages stop
+        self.assertTrue(stats.get_rate(310.0) < 2)
+        self.assertTrue(stats.get_rate(400.0) < 0.001)
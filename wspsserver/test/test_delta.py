@@ -0,0 +1,103 @@
+import json
+from copy import deepcopy
+from unittest import TestCase
+
+from wspsserver.delta import DeltaEncoder, diff, patch
+
+
+class TestDiff(TestCase):
+    def _check(self, old, new):
+        ops = diff(old, new)
+        self.assertEqual(patch(deepcopy(old), ops), new)
+        return ops
+
+    def test_objects(self):
+        ops = self._check(
+            {"a": 1, "b": {"c": 2, "d": 3}, "e": "x"},
+            {"a": 1, "b": {"c": 4}, "f": None}
+        )
+
+        self.assertEqual(ops, [
+            {"op": "replace", "path": "/b/c", "value": 4},
+            {"op": "remove", "path": "/b/d"},
+            {"op": "remove", "path": "/e"},
+            {"op": "add", "path": "/f", "value": None},
+        ])
+
+    def test_arrays(self):
+        self._check([1, 2, 3], [1, 5, 3, 4, 5])
+        self._check([1, 2, 3, 4], [0, 2])
+        self._check({"a": [{"b": 1}]}, {"a": [{"b": 2}, {"c": 3}]})
+
+    def test_types(self):
+        self.assertEqual(diff({"a": 1}, {"a": 1}), [])
+        self.assertEqual(len(diff({"a": 1}, {"a": 1.0})), 1)
+        self.assertEqual(len(diff({"a": 1}, {"a": True})), 1)
+        self._check({"a": [1]}, {"a": {"0": 1}})
+        self._check("abc", {"a": 1})
+
+    def test_escape(self):
+        ops = self._check({"a/b": 1, "c~d": 2}, {"a/b": 3, "c~d": 4})
+        self.assertEqual(
+            [op["path"] for op in ops],
+            ["/a~1b", "/c~0d"]
+        )
+
+
+class TestDeltaEncoder(TestCase):
+    def _packet(self, data):
+        return {"type": "message", "channel": "dash/1", "data": data}
+
+    def test_encode(self):
+        encoder = DeltaEncoder({"dash/*": 3})
+        self.assertEqual(encoder.encode("other", self._packet({})), None)
+
+        document = {"cpu": 0.5, "memory": 1000, "name": "x" * 100}
+        first = encoder.encode("dash/1", self._packet(document))
+        self.assertEqual(first.delta, None)
+        self.assertEqual(json.loads(first.full)["data"], document)
+
+        document = dict(document, cpu=0.75)
+        second = encoder.encode("dash/1", self._packet(document))
+        self.assertEqual(second.base, first.version)
+        self.assertTrue(second.version > first.version)
+        self.assertEqual(json.loads(second.delta), {
+            "type": "delta",
+            "channel": "dash/1",
+            "version": second.version,
+            "base": first.version,
+            "patch": [{"op": "replace", "path": "/cpu", "value": 0.75}]
+        })
+        self.assertEqual(json.loads(second.full)["data"], document)
+
+        # Full snapshot every 3 messages
+        third = encoder.encode("dash/1", self._packet(document))
+        self.assertEqual(third.delta, None)
+
+    def test_large_changes(self):
+        encoder = DeltaEncoder({"dash/*": 100})
+        encoder.encode("dash/1", self._packet({"a": 1}))
+        message = encoder.encode("dash/1", self._packet({"b": 2}))
+        self.assertEqual(message.delta, None)
+
+    def test_forget(self):
+        encoder = DeltaEncoder({"dash/*": 100})
+        first = encoder.encode("dash/1", self._packet({"a": 1}))
+        encoder.forget("dash/1")
+
+        second = encoder.encode("dash/1", self._packet({"a": 1}))
+        self.assertEqual(second.delta, None)
+        self.assertTrue(second.version > first.version)
+
+    def test_prune(self):
+        encoder = DeltaEncoder({"dash/*": 100})
+        encoder.encode("dash/1", self._packet({"a": 1}), 100.0)
+        encoder.encode("dash/2", self._packet({"a": 1}), 100.0)
+        encoder.encode("dash/2", self._packet({"a": 2}), 300.0)
+
+        encoder.prune(450.0)
+        self.assertEqual(list(encoder._states), ["dash/2"])
+
+        # Still encoded against the previous message
+        message = encoder.encode("dash/2", self._packet({"a": 3}), 450.0)
+        self.assertNotEqual(message.base, None)
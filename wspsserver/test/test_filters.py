@@ -0,0 +1,66 @@
+from unittest import TestCase
+
+from wspsserver.filters import compile_filter
+
+
+class TestFilters(TestCase):
+    packet = {
+        "type": "message",
+        "channel": "events",
+        "data": {
+            "region": "eu",
+            "level": 3,
+            "tags": ["a", "b"],
+            "internal": False,
+        }
+    }
+
+    def _matches(self, expression):
+        return compile_filter(expression)(self.packet)
+
+    def test_compare(self):
+        self.assertTrue(self._matches('data.region == "eu"'))
+        self.assertFalse(self._matches('data.region == "us"'))
+        self.assertTrue(self._matches('data.region != "us"'))
+        self.assertTrue(self._matches("data.level >= 3"))
+        self.assertFalse(self._matches("data.level < 3"))
+        self.assertTrue(self._matches("data.level <= 3.5"))
+        self.assertTrue(self._matches('data.tags.1 == "b"'))
+        self.assertTrue(self._matches('data.region in ["eu", "us"]'))
+        self.assertFalse(self._matches("data.level in []"))
+        self.assertTrue(self._matches("data.internal == false"))
+
+    def test_missing(self):
+        self.assertTrue(self._matches("data.missing == null"))
+        self.assertFalse(self._matches("data.tags.5"))
+        self.assertFalse(self._matches("data.region.x"))
+        self.assertFalse(self._matches("data.missing > 3"))
+        self.assertFalse(self._matches('data.level > "2"'))
+
+    def test_logic(self):
+        self.assertTrue(self._matches(
+            'data.region == "eu" and (data.level > 5 or data.tags.0 == "a")'
+        ))
+        self.assertFalse(self._matches(
+            'data.region == "eu" and not (data.level > 5 or data.tags)'
+        ))
+        self.assertTrue(self._matches("not data.internal"))
+        self.assertTrue(self._matches(
+            'data.level == 1 or data.level == 2 or data.level == 3'
+        ))
+
+    def test_invalid(self):
+        for expression in (
+                "",
+                "data.region ==",
+                'data.region = "eu"',
+                "data.region == eu",
+                "(data.level > 1",
+                "data.level > 1)",
+                "data.level in [1, 2",
+                "data.level and",
+                "(" * 20 + "data" + ")" * 20,
+                "data.level == 1 or " * 100 + "data",
+                None,
+                {"data.region": "eu"}):
+            self.assertRaises(ValueError, compile_filter, expression)
@@ -0,0 +1,103 @@
+import json
+import struct
+import socket
+from unittest import TestCase
+
+from tornado import gen
+from tornado.iostream import IOStream
+from mock import Mock
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+from wspsserver.connection import get_write_buffer_size
+from wspsserver.ingest import IngestServer, encode_frame
+from wspsserver.server import ConnectionManager
+from wspsserver.test.test_server import Settings, logger
+
+
+class TestEncodeFrame(TestCase):
+    def test_encode_frame(self):
+        self.assertEqual(encode_frame("{}"), b"\x00\x00\x00\x02{}")
+        self.assertEqual(encode_frame(b""), b"\x00\x00\x00\x00")
+
+
+class TestWriteBufferSize(TestCase):
+    def test_stream(self):
+        a, b = socket.socketpair()
+        stream = IOStream(a)
+        self.assertEqual(get_write_buffer_size(stream), 0)
+        stream.close()
+        b.close()
+
+    def test_fallback(self):
+        # Tornado without the private counters
+        stream = Mock(spec=["writing"])
+        stream.writing.return_value = True
+        self.assertEqual(get_write_buffer_size(stream), 1)
+
+        stream.writing.return_value = False
+        self.assertEqual(get_write_buffer_size(stream), 0)
+
+
+class TestIngestServer(AsyncTestCase):
+    def setUp(self):
+        super(TestIngestServer, self).setUp()
+        self.manager = ConnectionManager(Settings(), logger)
+        self.server = IngestServer(self.manager, 1024)
+
+        sock, self.port = bind_unused_port()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestIngestServer, self).tearDown()
+
+    def _connect(self):
+        stream = IOStream(socket.socket())
+        return stream.connect(("127.0.0.1", self.port))
+
+    @gen.coroutine
+    def _read_packet(self, stream):
+        header = yield stream.read_bytes(4)
+        length, = struct.unpack(">I", header)
+        body = yield stream.read_bytes(length)
+        raise gen.Return(json.loads(body.decode("utf-8")))
+
+    @gen_test
+    def test_publish_subscribe(self):
+        stream = yield self._connect()
+
+        stream.write(encode_frame(json.dumps({
+            "type": "subscribe",
+            "channel": "test"
+        })))
+        stream.write(encode_frame(b""))
+        stream.write(encode_frame(json.dumps({
+            "type": "publish",
+            "channel": "test",
+            "data": "abc123"
+        })))
+
+        packet = yield self._read_packet(stream)
+        self.assertEqual(packet, {
+            "type": "message",
+            "channel": "test",
+            "data": "abc123"
+        })
+        self.assertEqual(self.manager.get_connections(), 1)
+
+        stream.close()
+
+    @gen_test
+    def test_frame_too_big(self):
+        stream = yield self._connect()
+        stream.write(encode_frame("x" * 2048))
+
+        packet = yield self._read_packet(stream)
+        self.assertEqual(packet, {
+            "type": "close",
+            "code": 1009,
+            "reason": "Message too big"
+        })
+
+        # Server should close the connection after telling why
+        yield stream.read_until_close()
@@ -0,0 +1,72 @@
+import logging
+from collections import defaultdict
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from wspsserver.logs import SampledLogger
+
+
+class TestSampledLogger(TestCase):
+    def _get_logger(self):
+        logger = Mock()
+        logger.isEnabledFor.return_value = True
+        return logger
+
+    def test_sampling(self):
+        logger = self._get_logger()
+        counters = defaultdict(int)
+        log = SampledLogger(logger, counters, 1, 3)
+
+        with patch("wspsserver.logs.time", return_value=100.0):
+            for index in range(10):
+                log.info("opened", "Client {} from {}", index, "127.0.0.1")
+            log.error("invalid", "Invalid packet")
+
+        self.assertEqual(counters["opened"], 10)
+        self.assertEqual(counters["invalid"], 1)
+
+        # Burst for each event, then nothing
+        self.assertEqual(logger.log.call_count, 4)
+        logger.log.assert_any_call(
+            logging.INFO, "Client 2 from 127.0.0.1", exc_info=False
+        )
+        logger.log.assert_called_with(
+            logging.ERROR, "Invalid packet", exc_info=False
+        )
+
+        with patch("wspsserver.logs.time", return_value=101.0):
+            log.info("opened", "Client {}", 10)
+            log.info("opened", "Client {}", 11)
+        self.assertEqual(logger.log.call_count, 5)
+
+        log.flush()
+        logger.warning.assert_called_once_with(
+            "Suppressed log lines: opened=8"
+        )
+
+        log.flush()
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_unlimited(self):
+        logger = self._get_logger()
+        log = SampledLogger(logger, defaultdict(int), 0, 0)
+
+        for index in range(100):
+            log.error("invalid", "Invalid packet", exc_info=True)
+
+        self.assertEqual(logger.log.call_count, 100)
+        logger.log.assert_called_with(
+            logging.ERROR, "Invalid packet", exc_info=True
+        )
+
+    def test_disabled_level(self):
+        logger = self._get_logger()
+        logger.isEnabledFor.return_value = False
+        counters = defaultdict(int)
+        log = SampledLogger(logger, counters, 1, 1)
+
+        log.debug("said", "Client said {}", "abc")
+
+        self.assertFalse(logger.log.called)
+        self.assertEqual(counters["said"], 1)
@@ -0,0 +1,135 @@
+from unittest import TestCase
+
+from wspsserver.ratelimit import TokenBucket, RateLimiter
+
+
+class TestTokenBucket(TestCase):
+    def test_wait_time(self):
+        bucket = TokenBucket(4, 2, 100.0)
+
+        self.assertEqual(bucket.wait_time(1, 100.0), 0)
+        bucket.consume(1)
+        self.assertEqual(bucket.wait_time(1, 100.0), 0)
+        bucket.consume(1)
+        self.assertEqual(bucket.wait_time(1, 100.0), 0.25)
+
+        # Refills over time, but never above the burst
+        self.assertEqual(bucket.wait_time(1, 100.25), 0)
+        self.assertEqual(bucket.wait_time(2, 200.0), 0)
+        self.assertEqual(bucket.wait_time(3, 200.0), 0.25)
+
+    def test_debt(self):
+        bucket = TokenBucket(4, 1, 100.0)
+        bucket.consume(3)
+        self.assertEqual(bucket.wait_time(1, 100.0), 0.75)
+        self.assertFalse(bucket.is_full(100.5))
+        self.assertTrue(bucket.is_full(100.75))
+
+
+class TestRateLimiter(TestCase):
+    def test_disabled(self):
+        limiter = RateLimiter({}, {})
+        self.assertFalse(limiter.enabled)
+
+    def test_connection_limits(self):
+        limiter = RateLimiter({"publishes": (1, 1)}, {})
+        self.assertTrue(limiter.enabled)
+
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 0, 100.0), 1
+        )
+
+        # Other connections and events have their own limits
+        self.assertEqual(
+            limiter.acquire("b", "publish", "test", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("a", "subscribe", "test", 10, 0, 100.0), 0
+        )
+
+        limiter.forget("a")
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 0, 100.0), 0
+        )
+
+    def test_bytes(self):
+        limiter = RateLimiter({"bytes": (100, 100)}, {})
+
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 60, 0, 100.0), 0
+        )
+        self.assertAlmostEqual(
+            limiter.acquire("a", "publish", "test", 60, 0, 100.0), 0.2
+        )
+
+    def test_max_wait(self):
+        limiter = RateLimiter({"publishes": (1, 1)}, {})
+
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 5, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 5, 100.0), 1
+        )
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 5, 100.0), 2
+        )
+        # Rejected actions don't take tokens
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 2, 100.0), 3
+        )
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 5, 100.0), 3
+        )
+
+    def test_channel_limits(self):
+        limiter = RateLimiter({}, {"limited-*": {"subscribes": (1, 1)}})
+
+        self.assertEqual(
+            limiter.acquire("a", "subscribe", "limited-1", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("b", "subscribe", "limited-1", 10, 0, 100.0), 1
+        )
+        self.assertEqual(
+            limiter.acquire("b", "subscribe", "limited-2", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("b", "subscribe", "other", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            limiter.acquire("b", "subscribe", "other", 10, 0, 100.0), 0
+        )
+
+    def test_share_channels(self):
+        limits = {"limited-*": {"subscribes": (1, 1)}}
+        first = RateLimiter({"subscribes": (10, 10)}, limits)
+        second = RateLimiter({"subscribes": (10, 10)}, limits)
+        second.share_channels(first)
+
+        self.assertEqual(
+            first.acquire("a", "subscribe", "limited-1", 10, 0, 100.0), 0
+        )
+        self.assertEqual(
+            second.acquire("b", "subscribe", "limited-1", 10, 0, 100.0), 1
+        )
+
+        # Connection limits stay separate
+        self.assertNotIn("a", second._connection_buckets)
+
+    def test_prune(self):
+        limiter = RateLimiter({}, {"*": {"publishes": (1, 1)}})
+
+        limiter.acquire("a", "publish", "test", 10, 0, 100.0)
+        limiter.prune(100.5)
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 0, 100.5), 0.5
+        )
+
+        limiter.prune(101.5)
+        self.assertEqual(
+            limiter.acquire("a", "publish", "test", 10, 0, 101.5), 0
+        )
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from wspsserver.rules import PatternTable
+
+
+class TestPatternTable(TestCase):
+    def test_lookup(self):
+        table = PatternTable({
+            "public": 1,
+            "user/?*": 2,
+            "*": 3,
+        })
+
+        self.assertEqual(table.lookup("public"), 1)
+        self.assertEqual(table.lookup("user/abc"), 2)
+        self.assertEqual(table.lookup("user/"), 3)
+        self.assertEqual(table.lookup("other"), 3)
+        self.assertEqual(len(table), 3)
+
+    def test_first_match_wins(self):
+        table = PatternTable({
+            "user/*": 1,
+            "user/admin": 2,
+        })
+
+        self.assertEqual(table.lookup("user/admin"), 1)
+
+        table = PatternTable({
+            "user/admin": 2,
+            "user/*": 1,
+        })
+
+        self.assertEqual(table.lookup("user/admin"), 2)
+
+    def test_no_match(self):
+        table = PatternTable({"user/?*": "key"})
+
+        self.assertEqual(table.lookup("public"), None)
+        self.assertEqual(table.lookup("public", False), False)
+        self.assertFalse(table.matches("public"))
+        self.assertTrue(table.matches("user/abc"))
+
+        self.assertFalse(PatternTable({}).matches("public"))
+
+    def test_list(self):
+        table = PatternTable(("public", "room-[0-9]"))
+
+        self.assertTrue(table.matches("public"))
+        self.assertTrue(table.matches("room-1"))
+        self.assertTrue(table.matches("room-[0-9]"))
+        self.assertFalse(table.matches("room-10"))
+        self.assertFalse(table.matches("Public"))
+
+    def test_cached(self):
+        table = PatternTable(("user/*",))
+
+        self.assertTrue(table.matches("user/abc"))
+        self.assertTrue(table.matches("user/abc"))
+        self.assertFalse(table.matches("abc"))
+        self.assertEqual(len(table._cache), 2)
@@ -1,11 +1,16 @@
 import json
 import logging
+from time import time
 from unittest import TestCase
-from mock import Mock
-from tornado.websocket import WebSocketClosedError
+from mock import Mock, patch
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.websocket import WebSocketClosedError, websocket_connect
 
-from wspsserver.auth import NullAuthManager, SettingsAuthManager
-from wspsserver.server import _load_auth_manager, ConnectionManager
+from wspsserver import delta
+from wspsserver.auth import NullAuthManager, SettingsAuthManager, make_token
+from wspsserver.channel import ChannelStats
+from wspsserver.server import _load_auth_manager, ConnectionManager, Server
 
 
 def _get_logger():
@@ -24,6 +29,55 @@ logger = _get_logger()
 class Settings(object):
     AUTHORIZATION_MANAGER = "wspsserver.auth:NullAuthManager"
     ALLOWED_CHANNELS = ("*",)
+    SUBSCRIBE_KEYS = {}
+    PUBLISH_KEYS = {}
+    TOKEN_SECRET = None
+    TOKEN_CACHE_SIZE = 10000
+    CONNECTION_RATE_LIMITS = {}
+    CHANNEL_RATE_LIMITS = {}
+    CONFLATE_CHANNELS = {}
+    DELTA_CHANNELS = {}
+    FANOUT_CHUNK_SIZE = 1000
+    FANOUT_TIME_BUDGET = 0.005
+    OUTBOUND_HIGH_WATER = 1024 * 1024
+    OUTBOUND_QUEUE_LIMIT = 1000
+    FLOW_CONTROL_HIGH_WATER = 16 * 1024 * 1024
+    FLOW_CONTROL_LOW_WATER = 8 * 1024 * 1024
+    FLOW_CONTROL_ACTION = "pause"
+    RATE_LIMIT_ACTION = "drop"
+    RATE_LIMIT_MAX_DELAY = 5.0
+    RATE_LIMIT_CLOSE_CODE = 1008
+    MAX_CONNECTIONS = 0
+    MAX_HANDSHAKES_PER_SECOND = 0
+    HANDSHAKE_BURST = 100
+    MAX_IOLOOP_LAG = 0
+    ADMISSION_RETRY_SECONDS = 5
+    PING_INTERVAL = 30
+    IDLE_TIMEOUT = 90
+    HEARTBEAT_TICK = 1.0
+    HEARTBEAT_WHEEL_SLOTS = 512
+    STATS_SECONDS = 60
+    LOG_SAMPLE_RATE = 10
+    LOG_SAMPLE_BURST = 100
+    CAPTURE_FILE = None
+    MAX_MESSAGE_BYTES = 1024 * 1024
+    MAX_SUBSCRIPTIONS = 1000
+    MAX_CHANNEL_LENGTH = 256
+    MAX_CHANNELS = 1000000
+    MAX_SESSIONS = 10000
+    SHARDS = 1
+    EVENT_LOOP = "asyncio"
+    DRAIN_SECONDS = 10
+    DRAIN_FLUSH_SECONDS = 2
+    DRAIN_BATCH_SIZE = 100
+    DRAIN_CLOSE_CODE = 1012
+    DRAIN_RECONNECT_JITTER = 30
+    PRESENCE_INTERVAL = 1.0
+    PRESENCE_IDS = False
+    ADMIN_KEY = None
+    ADMIN_ADDRESS = "127.0.0.1"
+    ADMIN_PORT = None
+    RELOAD_RECHECK_SUBSCRIPTIONS = False
     DEBUG = True  # Making sure that debug logging doesn't cause errors
 
 
@@ -36,6 +90,9 @@ class Handler(object):
     def __init__(self):
         self.request = Request()
 
+    def get_write_buffer_size(self):
+        return 0
+
 
 class TestLoadAuthManager(TestCase):
     def test_load_auth_manager(self):
@@ -71,16 +128,13 @@ class TestLoadAuthManager(TestCase):
 
 
 class TestConnectionManager(TestCase):
-    def setUp(self):
-        ConnectionManager.reset()
-
     def test_on_open(self):
         settings = Settings()
         cm = ConnectionManager(settings, logger)
 
         handler = Handler()
         cm.on_open(handler)
-        self.assertIn(handler, cm.subscriptions)
+        self.assertIn(handler, cm.connections)
         self.assertEqual(cm.get_connections(), 1)
 
         cm.on_open(Handler())
@@ -128,8 +182,12 @@ class TestConnectionManager(TestCase):
             "data": "abc123"
         }
         cm.on_message(handler, json.dumps(packet))
-        expected = '{"data": "abc123", "type": "message", "channel": "test"}'
-        handler.write_message.assert_called_once_with(expected)
+        expected = {"data": "abc123", "type": "message", "channel": "test"}
+        self.assertEqual(handler.write_message.call_count, 1)
+        self.assertEqual(
+            json.loads(handler.write_message.call_args[0][0]),
+            expected
+        )
 
     def test_subscribe_auth_failed(self):
         settings = Settings()
@@ -169,6 +227,190 @@ class TestConnectionManager(TestCase):
         cm._message(handler, "test", packet, "invalid key")
         handler.close.assert_called_once_with(1002, "Authorization failed")
 
+    def test_session_auth(self):
+        settings = Settings()
+        settings.AUTHORIZATION_MANAGER = "wspsserver.auth:SettingsAuthManager"
+        settings.PUBLISH_KEYS = {"test": "key123"}
+        settings.SUBSCRIBE_KEYS = {"test": "key123", "other": "abc"}
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.close = Mock()
+        cm.on_open(handler)
+
+        cm.on_message(handler, json.dumps({"type": "auth", "key": "key123"}))
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "test"
+        }))
+        cm.on_message(handler, json.dumps({
+            "type": "publish",
+            "channel": "test",
+            "data": "abc123"
+        }))
+
+        self.assertEqual(handler.write_message.call_count, 1)
+        self.assertFalse(handler.close.called)
+
+        # Keys in packets still override the session
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "other",
+            "key": "abc"
+        }))
+        self.assertFalse(handler.close.called)
+
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "other"
+        }))
+        handler.close.assert_called_once_with(1002, "Authorization failed")
+
+    def test_session_auth_failed(self):
+        settings = Settings()
+        settings.AUTHORIZATION_MANAGER = "wspsserver.auth:TokenAuthManager"
+        settings.TOKEN_SECRET = "secret"
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.close = Mock()
+        cm.on_open(handler)
+
+        cm.on_message(handler, json.dumps({"type": "auth", "key": "invalid"}))
+        handler.close.assert_called_once_with(1002, "Authorization failed")
+        self.assertEqual(cm.connections[handler].grant, None)
+
+    def test_session_expired(self):
+        settings = Settings()
+        settings.AUTHORIZATION_MANAGER = "wspsserver.auth:TokenAuthManager"
+        settings.TOKEN_SECRET = "secret"
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.close = Mock()
+        cm.on_open(handler)
+
+        token = make_token("secret", subscribe=["*"], expires=time() + 60)
+        cm.on_message(handler, json.dumps({"type": "auth", "key": token}))
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "test"
+        }))
+        self.assertFalse(handler.close.called)
+
+        with patch("wspsserver.server.time", return_value=time() + 61):
+            cm.on_message(handler, json.dumps({
+                "type": "subscribe",
+                "channel": "test2"
+            }))
+
+        handler.close.assert_called_once_with(1002, "Authorization failed")
+        self.assertEqual(cm.connections[handler].grant, None)
+
+    def test_presence(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        handlers = []
+        for _ in range(3):
+            handler = Handler()
+            handler.write_message = Mock()
+            cm.on_open(handler)
+            handlers.append(handler)
+
+        for handler in handlers[1:]:
+            cm._subscribe(handler, "test", None)
+
+        cm.on_message(handlers[0], json.dumps({
+            "type": "presence",
+            "channel": "test",
+            "ids": True
+        }))
+
+        packet = json.loads(handlers[0].write_message.call_args[0][0])
+        self.assertEqual(
+            packet,
+            {"type": "presence", "channel": "test", "count": 2}
+        )
+
+        settings.PRESENCE_IDS = True
+        cm.on_message(handlers[0], json.dumps({
+            "type": "presence",
+            "channel": "test",
+            "ids": True
+        }))
+
+        packet = json.loads(handlers[0].write_message.call_args[0][0])
+        self.assertEqual(packet["ids"], [
+            cm.connections[handler].id for handler in handlers[1:]
+        ])
+
+        cm.on_close(handlers[1])
+        self.assertEqual(cm.get_subscriber_count("test"), 1)
+        self.assertEqual(cm.get_subscriber_count("other"), 0)
+
+    def test_presence_watch(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        watcher = Handler()
+        watcher.write_message = Mock()
+        cm.on_open(watcher)
+        cm.on_message(watcher, json.dumps({
+            "type": "subscribe",
+            "channel": "test",
+            "presence": True
+        }))
+
+        handlers = []
+        for _ in range(3):
+            handler = Handler()
+            cm.on_open(handler)
+            cm._subscribe(handler, "test", None)
+            handlers.append(handler)
+
+        cm.on_close(handlers[0])
+        self.assertFalse(watcher.write_message.called)
+
+        # Changes are sent together once per interval
+        cm.periodic(time() + 1, 0)
+        self.assertEqual(watcher.write_message.call_count, 1)
+        packet = json.loads(watcher.write_message.call_args[0][0])
+        self.assertEqual(packet, {
+            "type": "presence",
+            "channel": "test",
+            "count": 3,
+            "joined": 3,
+            "left": 1
+        })
+
+        cm.periodic(time() + 2, 0)
+        self.assertEqual(watcher.write_message.call_count, 1)
+
+        cm.on_close(watcher)
+        self.assertEqual(cm.presence_watchers, {})
+
+    def test_prune_channels(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        cm.on_open(handler)
+        cm._subscribe(handler, "test", None)
+        cm._subscribe(handler, "other", None)
+        cm._message(handler, "test", {"data": "abc"}, None)
+        cm._message(handler, "nobody", {"data": "abc"}, None)
+        cm._unsubscribe(handler, "other", "Testing")
+
+        cm._prune_channels(time() + 1)
+        self.assertEqual(sorted(cm.channel_subscribers), ["test"])
+        self.assertEqual(sorted(cm.channel_stats), ["nobody", "test"])
+
+        cm._prune_channels(time() + 300)
+        self.assertEqual(sorted(cm.channel_stats), ["test"])
+
     def test_invalid_channel(self):
         settings = Settings()
         settings.ALLOWED_CHANNELS = ("valid-*",)
@@ -185,7 +427,7 @@ class TestConnectionManager(TestCase):
             "key": None
         }
         cm.on_message(handler, json.dumps(packet))
-        handler.close.assert_has_calls([])
+        handler.close.assert_not_called()
 
         packet = {
             "type": "subscribe",
@@ -235,8 +477,12 @@ class TestConnectionManager(TestCase):
 
         cm._message(fail_handler, "test", packet, None)
 
-        expected = '{"type": "message", "data": "foo", "channel": "test"}'
-        handler.write_message.assert_called_once_with(expected)
+        expected = {"type": "message", "data": "foo", "channel": "test"}
+        self.assertEqual(handler.write_message.call_count, 1)
+        self.assertEqual(
+            json.loads(handler.write_message.call_args[0][0]),
+            expected
+        )
 
     def test_on_close(self):
         settings = Settings()
@@ -251,3 +497,1202 @@ class TestConnectionManager(TestCase):
 
         self.assertEqual(cm.get_channel_subscribers("test"), [])
         self.assertEqual(cm.get_connections(), 0)
+
+    def _rate_limited_manager(self, action):
+        settings = Settings()
+        settings.CONNECTION_RATE_LIMITS = {"publishes": (0.001, 1)}
+        settings.RATE_LIMIT_ACTION = action
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.close = Mock()
+        cm.on_open(handler)
+        cm._subscribe(handler, "test", None)
+
+        return cm, handler
+
+    def test_rate_limit_drop(self):
+        cm, handler = self._rate_limited_manager("drop")
+
+        packet = json.dumps({"type": "publish", "channel": "test"})
+        cm.on_message(handler, packet)
+        cm.on_message(handler, packet)
+
+        self.assertEqual(handler.write_message.call_count, 1)
+        self.assertEqual(cm.stats["rate_limit_dropped"], 1)
+        handler.close.assert_not_called()
+
+    def test_rate_limit_close(self):
+        cm, handler = self._rate_limited_manager("close")
+
+        packet = json.dumps({"type": "publish", "channel": "test"})
+        cm.on_message(handler, packet)
+        cm.on_message(handler, packet)
+
+        self.assertEqual(handler.write_message.call_count, 1)
+        self.assertEqual(cm.stats["rate_limit_closed"], 1)
+        handler.close.assert_called_once_with(1008, "Rate limit exceeded")
+
+    def test_rate_limit_delay(self):
+        cm, handler = self._rate_limited_manager("delay")
+        cm.rate_limiter.connection_limits = {"publishes": (1, 1)}
+        cm.rate_limiter.forget(handler)
+
+        packet = json.dumps({"type": "publish", "channel": "test"})
+        with patch("wspsserver.server.ioloop.IOLoop.current") as current:
+            cm.on_message(handler, packet)
+            cm.on_message(handler, packet)
+
+            self.assertEqual(handler.write_message.call_count, 1)
+            self.assertEqual(cm.stats["rate_limit_delayed"], 1)
+
+            call_later = current.return_value.call_later
+            self.assertEqual(call_later.call_count, 1)
+            args = call_later.call_args[0]
+            self.assertAlmostEqual(args[0], 1, places=2)
+
+            # Run the delayed callback
+            args[1](*args[2:])
+            self.assertEqual(handler.write_message.call_count, 2)
+
+            # Nothing is delivered after the client disconnects
+            cm.on_close(handler)
+            args[1](*args[2:])
+            self.assertEqual(handler.write_message.call_count, 2)
+
+    def test_heartbeat(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.ping = Mock()
+        handler.close = Mock()
+        cm.on_open(handler)
+        start = cm.connections[handler].last_activity
+
+        cm.heartbeat(start + 10)
+        handler.ping.assert_not_called()
+
+        # Pinged once quiet for PING_INTERVAL
+        cm.heartbeat(start + 31)
+        handler.ping.assert_called_once_with(b"")
+
+        # Answering the ping keeps the connection alive
+        cm.connections[handler].last_activity = start + 31
+        cm.heartbeat(start + 62)
+        self.assertEqual(handler.ping.call_count, 2)
+        cm.heartbeat(start + 93)
+        self.assertEqual(handler.ping.call_count, 3)
+        handler.close.assert_not_called()
+
+        # No answers, closed once idle for IDLE_TIMEOUT
+        cm.heartbeat(start + 122)
+        handler.close.assert_called_once_with(1001, "Idle timeout")
+        self.assertEqual(cm.stats["idle_closed"], 1)
+
+        cm.on_close(handler)
+        self.assertNotIn(handler, cm.timers)
+        self.assertNotIn(handler, cm.connections)
+
+    def test_heartbeat_activity(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.ping = Mock()
+        cm.on_open(handler)
+        start = cm.connections[handler].last_activity
+
+        cm.on_pong(handler)
+        cm.connections[handler].last_activity = start + 20
+        cm.heartbeat(start + 31)
+        handler.ping.assert_not_called()
+
+        cm.heartbeat(start + 51)
+        handler.ping.assert_called_once_with(b"")
+
+    def test_heartbeat_disabled(self):
+        settings = Settings()
+        settings.PING_INTERVAL = 0
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        cm.on_open(handler)
+        self.assertNotIn(handler, cm.timers)
+
+        cm.on_open(Handler(), heartbeat=False)
+        self.assertEqual(len(cm.timers), 0)
+
+
+class TestDrain(AsyncTestCase):
+    @gen_test
+    def test_drain(self):
+        settings = Settings()
+        settings.DRAIN_FLUSH_SECONDS = 0.2
+        settings.DRAIN_BATCH_SIZE = 2
+        cm = ConnectionManager(settings, logger)
+
+        closed = []
+        handlers = []
+        for _ in range(5):
+            handler = Handler()
+            handler.write_message = Mock()
+            handler.close = Mock(
+                side_effect=lambda *args: closed.append(time())
+            )
+            handler.is_writing = Mock(return_value=False)
+            cm.on_open(handler)
+            handlers.append(handler)
+
+        # One client never finishes writing and one is already closed,
+        # neither should hold up draining
+        handlers[0].is_writing.return_value = True
+        handlers[1].write_message.side_effect = WebSocketClosedError
+
+        start = time()
+        yield cm.drain(start + 0.8)
+        self.assertTrue(time() - start < 1.0)
+
+        for handler in handlers:
+            handler.close.assert_called_once_with(1012, "Server shutting down")
+
+        packet = json.loads(handlers[2].write_message.call_args[0][0])
+        self.assertEqual(packet["type"], "reconnect")
+        self.assertTrue(0 <= packet["delay"] <= 30)
+
+        # Flushing waited until its own deadline, then 3 batches spread over
+        # the rest of the time
+        self.assertTrue(closed[0] - start >= 0.2)
+        self.assertAlmostEqual(closed[0], closed[1], delta=0.05)
+        self.assertTrue(closed[2] - closed[1] >= 0.1)
+        self.assertTrue(closed[4] - closed[3] >= 0.1)
+        self.assertEqual(cm.stats["drained"], 5)
+
+
+class TestReload(AsyncTestCase):
+    @gen_test
+    def test_reload(self):
+        settings = Settings()
+        settings.ALLOWED_CHANNELS = ("public",)
+        cm = ConnectionManager(settings, logger)
+
+        self.assertTrue(cm._is_channel_valid("public"))
+        self.assertFalse(cm._is_channel_valid("private"))
+
+        new_settings = Settings()
+        new_settings.ALLOWED_CHANNELS = ("public", "private")
+        new_settings.AUTHORIZATION_MANAGER = \
+            "wspsserver.auth:SettingsAuthManager"
+        new_settings.PUBLISH_KEYS = {"private": "abc123"}
+        yield cm.reload(new_settings)
+
+        self.assertTrue(cm._is_channel_valid("private"))
+        self.assertTrue(isinstance(cm.auth_manager, SettingsAuthManager))
+        self.assertTrue(
+            cm.auth_manager.authenticate("publish", "private", "abc123")
+        )
+        self.assertFalse(
+            cm.auth_manager.authenticate("publish", "private", None)
+        )
+
+    @gen_test
+    def test_recheck_subscriptions(self):
+        settings = Settings()
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        cm.on_open(handler)
+
+        for channel in ("public", "private", "secret"):
+            cm.on_message(handler, json.dumps({
+                "type": "subscribe",
+                "channel": channel,
+                "key": "abc123"
+            }))
+
+        # Subscribing again doesn't add the client twice
+        cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": "public"
+        }))
+        self.assertEqual(cm.get_channel_subscribers("public"), [handler])
+
+        new_settings = Settings()
+        new_settings.ALLOWED_CHANNELS = ("public", "private")
+        new_settings.AUTHORIZATION_MANAGER = \
+            "wspsserver.auth:SettingsAuthManager"
+        new_settings.SUBSCRIBE_KEYS = {
+            "public": None,
+            "private": "abc123"
+        }
+        new_settings.RELOAD_RECHECK_SUBSCRIPTIONS = True
+        yield cm.reload(new_settings)
+
+        self.assertEqual(
+            sorted(cm.connections[handler].subscriptions),
+            ["private", "public"]
+        )
+        self.assertEqual(cm.get_channel_subscribers("secret"), [])
+        self.assertEqual(cm.stats["unsubscribed"], 1)
+
+        packet = json.loads(handler.write_message.call_args[0][0])
+        self.assertEqual(packet["type"], "unsubscribed")
+        self.assertEqual(packet["channel"], "secret")
+
+
+class TestConflation(AsyncTestCase):
+    def _publish(self, cm, handler, data):
+        cm.on_message(handler, json.dumps({
+            "type": "publish",
+            "channel": "prices/abc",
+            "data": data
+        }))
+
+    @gen_test
+    def test_conflation(self):
+        settings = Settings()
+        settings.CONFLATE_CHANNELS = {"prices/*": 0.05}
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        cm.on_open(handler)
+        cm._subscribe(handler, "prices/abc", None)
+
+        messages = [
+            json.dumps({
+                "type": "publish",
+                "channel": "prices/abc",
+                "data": {"price": price}
+            })
+            for price in range(10)
+        ]
+
+        with patch("wspsserver.server.json.dumps",
+                   side_effect=json.dumps) as dumps:
+            for message in messages:
+                cm.on_message(handler, message)
+
+            self.assertFalse(handler.write_message.called)
+            yield gen.sleep(0.1)
+
+            # Replaced messages are never serialized
+            self.assertEqual(dumps.call_count, 1)
+
+        self.assertEqual(handler.write_message.call_count, 1)
+        packet = json.loads(handler.write_message.call_args[0][0])
+        self.assertEqual(packet["data"], {"price": 9})
+        self.assertEqual(cm.stats["conflated"], 9)
+
+        self._publish(cm, handler, {"price": 10})
+        yield gen.sleep(0.1)
+        self.assertEqual(handler.write_message.call_count, 2)
+
+    @gen_test
+    def test_conflation_key(self):
+        settings = Settings()
+        settings.CONFLATE_CHANNELS = {"prices/*": (0.05, "symbol")}
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        cm.on_open(handler)
+        cm._subscribe(handler, "prices/abc", None)
+
+        for price in range(3):
+            for symbol in ("a", "b"):
+                self._publish(cm, handler, {"symbol": symbol, "price": price})
+        self._publish(cm, handler, "no key")
+
+        yield gen.sleep(0.1)
+
+        self.assertEqual(
+            [json.loads(call[0][0])["data"]
+             for call in handler.write_message.call_args_list],
+            [{"symbol": "a", "price": 2}, {"symbol": "b", "price": 2},
+             "no key"]
+        )
+
+    @gen_test
+    def test_conflation_key_types(self):
+        settings = Settings()
+        settings.CONFLATE_CHANNELS = {"prices/*": (0.05, "symbol")}
+        cm = ConnectionManager(settings, logger)
+
+        handler = Handler()
+        handler.write_message = Mock()
+        cm.on_open(handler)
+        cm._subscribe(handler, "prices/abc", None)
+
+        # Keys that aren't strings or numbers are like no key at all
+        for symbol in (1, 1.5, [1], {"a": 1}, True, None):
+            self._publish(cm, handler, {"symbol": symbol})
+
+        yield gen.sleep(0.1)
+
+        self.assertEqual(
+            [json.loads(call[0][0])["data"]
+             for call in handler.write_message.call_args_list],
+            [{"symbol": 1}, {"symbol": 1.5}, {"symbol": None}]
+        )
+
+
+class TestOutbound(TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.OUTBOUND_HIGH_WATER = 100
+        self.settings.OUTBOUND_QUEUE_LIMIT = 3
+        self.cm = ConnectionManager(self.settings, logger)
+
+        self.handler = Handler()
+        self.handler.write_message = Mock()
+        self.handler.close = Mock()
+        self.handler.get_write_buffer_size = Mock(return_value=0)
+        self.cm.on_open(self.handler)
+        self.cm._subscribe(self.handler, "test", None)
+
+    def _publish(self, data, **fields):
+        packet = {"type": "publish", "channel": "test", "data": data}
+        packet.update(fields)
+        self.cm.on_message(self.handler, json.dumps(packet))
+
+    def _written(self):
+        return [
+            json.loads(call[0][0])["data"]
+            for call in self.handler.write_message.call_args_list
+        ]
+
+    def test_priority(self):
+        self._publish("first", priority=5, ttl=10)
+        self.assertEqual(self._written(), ["first"])
+
+        packet = json.loads(self.handler.write_message.call_args[0][0])
+        self.assertFalse("priority" in packet)
+        self.assertFalse("ttl" in packet)
+
+        # Falling behind, messages are queued
+        self.handler.get_write_buffer_size.return_value = 1000
+        self._publish("low")
+        self._publish("high", priority=10)
+        self._publish("normal", priority=1)
+        self.assertEqual(self._written(), ["first"])
+
+        self.cm.periodic(time(), 0)
+        self.assertEqual(self._written(), ["first"])
+
+        # Caught up, queued messages go out most important first
+        self.handler.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time(), 0)
+        self.assertEqual(
+            self._written(),
+            ["first", "high", "normal", "low"]
+        )
+        self.assertEqual(self.cm._outbound, {})
+
+    def test_expiry(self):
+        self.handler.get_write_buffer_size.return_value = 1000
+        self._publish("stale", ttl=1)
+        self._publish("fresh", ttl=60)
+
+        self.handler.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time() + 2, 0)
+        self.assertEqual(self._written(), ["fresh"])
+        self.assertEqual(self.cm.stats["expired"], 1)
+
+    def test_queue_limit(self):
+        self.handler.get_write_buffer_size.return_value = 1000
+        for priority in (1, 0, 2, 0, 3):
+            self._publish(priority, priority=priority)
+
+        self.assertEqual(self.cm.stats["outbound_dropped"], 2)
+
+        self.handler.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time(), 0)
+        self.assertEqual(self._written(), [3, 2, 1])
+
+    def test_invalid(self):
+        self._publish("abc", priority="high")
+        self.handler.close.assert_called_once_with(1002, "Invalid message")
+        self.assertEqual(self._written(), [])
+
+    def test_not_finite(self):
+        # Python's json module accepts these, and 1e400 is infinity
+        for field, value in (("priority", "1e400"), ("priority", "Infinity"),
+                             ("priority", "NaN"), ("ttl", "NaN"),
+                             ("ttl", "-Infinity"), ("ttl", "1e400")):
+            self.handler.close.reset_mock()
+            self.cm.on_message(self.handler, (
+                '{{"type": "publish", "channel": "test", "data": "abc", '
+                '"{}": {}}}'
+            ).format(field, value))
+            self.handler.close.assert_called_once_with(
+                1002, "Invalid message"
+            )
+
+        self.assertEqual(self._written(), [])
+
+        for priority, ttl in ((float("inf"), None), (0, float("nan"))):
+            self.assertRaises(
+                ValueError, self.cm.publish, "test", "abc", priority, ttl
+            )
+
+    def test_disabled(self):
+        self.settings.OUTBOUND_HIGH_WATER = 0
+        self.handler.get_write_buffer_size.return_value = 1000
+        self._publish("abc")
+        self.assertEqual(self._written(), ["abc"])
+
+    def test_no_queue(self):
+        self.settings.OUTBOUND_QUEUE_LIMIT = 0
+        self.handler.get_write_buffer_size.return_value = 1000
+        self._publish("abc")
+        self._publish("def", priority=10)
+
+        self.assertEqual(self._written(), [])
+        self.assertEqual(self.cm.stats["outbound_dropped"], 2)
+        self.assertEqual(self.cm._outbound, {})
+
+
+class TestChunkedFanout(AsyncTestCase):
+    def _subscribe(self, cm, channel, count):
+        handlers = []
+        for _ in range(count):
+            handler = Handler()
+            handler.write_message = Mock()
+            cm.on_open(handler)
+            cm._subscribe(handler, channel, None)
+            handlers.append(handler)
+
+        return handlers
+
+    @gen_test
+    def test_chunked_fanout(self):
+        settings = Settings()
+        settings.FANOUT_CHUNK_SIZE = 3
+        settings.FANOUT_TIME_BUDGET = 0
+        cm = ConnectionManager(settings, logger)
+
+        large = self._subscribe(cm, "large", 10)
+        small = self._subscribe(cm, "small", 2)
+
+        cm._publish("large", "first")
+        cm._publish("large", "second")
+        cm._publish("small", "small")
+
+        # Small channels aren't held up
+        for handler in small:
+            handler.write_message.assert_called_once_with("small")
+        for handler in large:
+            self.assertFalse(handler.write_message.called)
+
+        cm.on_close(large[-1])
+
+        yield gen.moment
+        written = [h for h in large if h.write_message.called]
+        self.assertEqual(len(written), 3)
+
+        while cm._fanout_jobs:
+            yield gen.moment
+
+        for handler in large[:-1]:
+            self.assertEqual(
+                [call[0][0] for call in handler.write_message.call_args_list],
+                ["first", "second"]
+            )
+        self.assertFalse(large[-1].write_message.called)
+        self.assertEqual(cm.stats["fanout_chunked"], 2)
+
+    @gen_test
+    def test_expiry(self):
+        settings = Settings()
+        settings.FANOUT_CHUNK_SIZE = 3
+        settings.FANOUT_TIME_BUDGET = 0
+        cm = ConnectionManager(settings, logger)
+
+        handlers = self._subscribe(cm, "large", 10)
+        cm._publish("large", "message", 0, time() + 60)
+
+        yield gen.moment
+        written = [h for h in handlers if h.write_message.called]
+        self.assertEqual(len(written), 3)
+
+        # Expires before the next chunk, the rest is skipped
+        cm._fanout_jobs["large"][0][2] = time() - 1
+        while cm._fanout_jobs:
+            yield gen.moment
+
+        self.assertEqual(
+            [h for h in handlers if h.write_message.called], written
+        )
+        self.assertEqual(cm.stats["expired"], 1)
+        self.assertEqual(cm.get_channel_backlog("large"), 0)
+
+    @gen_test
+    def test_disabled(self):
+        settings = Settings()
+        settings.FANOUT_CHUNK_SIZE = 0
+        cm = ConnectionManager(settings, logger)
+
+        handlers = self._subscribe(cm, "large", 10)
+        cm._publish("large", "message")
+
+        for handler in handlers:
+            handler.write_message.assert_called_once_with("message")
+
+
+class TestFlowControl(AsyncTestCase):
+    def setUp(self):
+        super(TestFlowControl, self).setUp()
+        self.settings = Settings()
+        self.settings.OUTBOUND_HIGH_WATER = 10
+        self.settings.FLOW_CONTROL_HIGH_WATER = 200
+        self.settings.FLOW_CONTROL_LOW_WATER = 100
+        self.cm = ConnectionManager(self.settings, logger)
+
+        self.subscriber = Handler()
+        self.subscriber.write_message = Mock()
+        self.subscriber.get_write_buffer_size = Mock(return_value=1000)
+        self.cm.on_open(self.subscriber)
+        self.cm._subscribe(self.subscriber, "test", None)
+
+        self.publisher = Handler()
+        self.publisher.write_message = Mock()
+        self.cm.on_open(self.publisher)
+
+    def _publish(self):
+        return self.cm.on_message(self.publisher, json.dumps({
+            "type": "publish",
+            "channel": "test",
+            "data": "x" * 50
+        }))
+
+    def test_pause(self):
+        self.assertEqual(self._publish(), None)
+        self.assertEqual(self._publish(), None)
+        future = self._publish()
+        self.assertFalse(future.done())
+        self.assertEqual(self.cm.get_channel_backlog("test"), 300)
+        self.assertEqual(self.cm.stats["flow_throttled"], 1)
+
+        # Still above low water
+        self.cm._outbound[self.subscriber].pop()
+        self.cm._add_backlog("test", -100)
+        self.cm.periodic(time(), 0)
+        self.assertFalse(future.done())
+
+        self.subscriber.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time(), 0)
+        self.assertTrue(future.done())
+        self.assertEqual(self.cm.get_channel_backlog("test"), 0)
+        self.assertEqual(self.cm._flow_paused, {})
+
+    def test_signal(self):
+        self.settings.FLOW_CONTROL_ACTION = "signal"
+
+        for _ in range(4):
+            self.assertEqual(self._publish(), None)
+
+        self.publisher.write_message.assert_called_once_with(json.dumps({
+            "type": "flow",
+            "channel": "test",
+            "status": "slow"
+        }))
+
+        self.subscriber.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time(), 0)
+        self.publisher.write_message.assert_called_with(json.dumps({
+            "type": "flow",
+            "channel": "test",
+            "status": "ok"
+        }))
+        self.assertEqual(self.publisher.write_message.call_count, 2)
+
+    def test_close(self):
+        for _ in range(3):
+            future = self._publish()
+
+        self.cm.on_close(self.publisher)
+        self.assertTrue(future.done())
+        self.assertEqual(self.cm._flow_paused, {})
+
+        self.cm.on_close(self.subscriber)
+        self.assertEqual(self.cm.get_channel_backlog("test"), 0)
+
+    @gen_test
+    def test_fanout_backlog(self):
+        self.settings.FANOUT_CHUNK_SIZE = 1
+        self.settings.OUTBOUND_HIGH_WATER = 0
+        self.subscriber.get_write_buffer_size.return_value = 0
+
+        handler = Handler()
+        handler.write_message = Mock()
+        self.cm.on_open(handler)
+        self.cm._subscribe(handler, "test", None)
+
+        for _ in range(3):
+            future = self._publish()
+        self.assertEqual(self.cm.get_channel_backlog("test"), 600)
+        self.assertFalse(future.done())
+
+        yield future
+        self.assertTrue(self.cm.get_channel_backlog("test") <= 100)
+
+
+class TestDelta(TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.DELTA_CHANNELS = {"dash/*": 100}
+        self.settings.OUTBOUND_HIGH_WATER = 100
+        self.cm = ConnectionManager(self.settings, logger)
+        self.document = {"cpu": 0.5, "name": "x" * 100}
+
+        self.publisher = Handler()
+        self.cm.on_open(self.publisher)
+
+    def _subscribe(self):
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.get_write_buffer_size = Mock(return_value=0)
+        self.cm.on_open(handler)
+        self.cm._subscribe(handler, "dash/1", None)
+        return handler
+
+    def _publish(self, priority=0, **changes):
+        self.document = dict(self.document, **changes)
+        self.cm._message(self.publisher, "dash/1", {
+            "type": "publish",
+            "channel": "dash/1",
+            "data": self.document,
+            "priority": priority
+        }, None)
+
+    def test_prune_shared(self):
+        subscriber = self._subscribe()
+        self._publish()
+
+        # Another shard, where the channel was last used long ago
+        other = ConnectionManager(self.settings, logger)
+        other.delta = self.cm.delta
+        other.channel_stats["dash/1"] = ChannelStats(0)
+        other._prune_channels(time() + 60)
+        self.assertEqual(other.channel_stats, {})
+
+        self._publish(cpu=0.6)
+        self.assertEqual(self._written(subscriber)[1]["type"], "delta")
+
+    def _written(self, handler):
+        return [
+            json.loads(call[0][0])
+            for call in handler.write_message.call_args_list
+        ]
+
+    def test_delta(self):
+        first = self._subscribe()
+        self._publish()
+        second = self._subscribe()
+        self._publish(cpu=0.75)
+
+        written = self._written(first)
+        self.assertEqual(
+            [packet["type"] for packet in written],
+            ["message", "delta"]
+        )
+        self.assertEqual(written[1]["base"], written[0]["version"])
+        self.assertEqual(
+            delta.patch(written[0]["data"], written[1]["patch"]),
+            self.document
+        )
+
+        # Didn't have the previous version
+        written = self._written(second)
+        self.assertEqual(written[0]["type"], "message")
+        self.assertEqual(written[0]["data"], self.document)
+        self.assertEqual(self.cm.stats["delta_sent"], 1)
+
+    def test_falling_behind(self):
+        handler = self._subscribe()
+        self._publish()
+
+        handler.get_write_buffer_size.return_value = 1000
+        self._publish(cpu=0.6, priority=1)
+        self._publish(cpu=0.7, priority=5)
+
+        # The newer message goes first in full, the older one is left out
+        handler.get_write_buffer_size.return_value = 0
+        self.cm.periodic(time(), 0)
+
+        written = self._written(handler)
+        self.assertEqual(
+            [packet["type"] for packet in written],
+            ["message", "message"]
+        )
+        self.assertEqual(written[1]["data"]["cpu"], 0.7)
+        self.assertEqual(self.cm.stats["delta_outdated"], 1)
+
+        self._publish(cpu=0.8)
+        written = self._written(handler)
+        self.assertEqual(written[2]["type"], "delta")
+        self.assertEqual(written[2]["base"], written[1]["version"])
+
+
+class TestFilters(TestCase):
+    def setUp(self):
+        self.cm = ConnectionManager(Settings(), logger)
+        self.publisher = Handler()
+        self.cm.on_open(self.publisher)
+
+    def _subscribe(self, expression=None):
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.close = Mock()
+        self.cm.on_open(handler)
+        self.cm._process_packet(handler, {
+            "type": "subscribe",
+            "channel": "events",
+            "filter": expression
+        })
+        return handler
+
+    def _publish(self, region):
+        self.cm._message(self.publisher, "events", {
+            "type": "publish",
+            "channel": "events",
+            "data": {"region": region}
+        }, None)
+
+    def _received(self, handler):
+        return [
+            json.loads(call[0][0])["data"]["region"]
+            for call in handler.write_message.call_args_list
+        ]
+
+    def test_filters(self):
+        with patch("wspsserver.server.compile_filter") as compile_filter:
+            compile_filter.return_value = \
+                lambda packet: packet["data"]["region"] == "eu"
+            eu = [self._subscribe('data.region == "eu"') for _ in range(3)]
+            self.assertEqual(compile_filter.call_count, 1)
+
+        us = self._subscribe('data.region == "us"')
+        everything = self._subscribe()
+
+        self._publish("eu")
+        self._publish("us")
+        self._publish("asia")
+
+        for handler in eu:
+            self.assertEqual(self._received(handler), ["eu"])
+        self.assertEqual(self._received(us), ["us"])
+        self.assertEqual(self._received(everything), ["eu", "us", "asia"])
+        self.assertEqual(self.cm.stats["filtered"], 8)
+
+    def test_change_filter(self):
+        handler = self._subscribe('data.region == "eu"')
+        self.cm._subscribe(handler, "events", None, False, "data.region")
+        self.assertEqual(list(self.cm.channel_filters["events"]),
+                         ["data.region"])
+
+        self.cm._subscribe(handler, "events", None)
+        self.assertEqual(self.cm.channel_filters, {})
+        self.assertEqual(self.cm.get_subscriber_count("events"), 1)
+
+    def test_close(self):
+        first = self._subscribe('data.region == "eu"')
+        second = self._subscribe('data.region == "eu"')
+
+        self.cm.on_close(first)
+        self.assertEqual(
+            self.cm.channel_filters["events"]['data.region == "eu"'][1],
+            {second}
+        )
+
+        self.cm.on_close(second)
+        self.assertEqual(self.cm.channel_filters, {})
+
+    def test_invalid(self):
+        handler = self._subscribe('data.region = "eu"')
+        handler.close.assert_called_once_with(1002, "Invalid filter")
+        self.assertEqual(self.cm.get_subscriber_count("events"), 0)
+        self.assertEqual(self.cm.channel_filters, {})
+
+    def test_invalid_type(self):
+        self._subscribe('data.region == "eu"')
+
+        for expression in (["data.region"], {"data": "region"}, 1):
+            handler = self._subscribe(expression)
+            handler.close.assert_called_once_with(1002, "Invalid filter")
+
+        self.assertEqual(self.cm.get_subscriber_count("events"), 1)
+        self.assertEqual(list(self.cm.channel_filters["events"]),
+                         ['data.region == "eu"'])
+
+
+class TestLimits(TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.MAX_MESSAGE_BYTES = 100
+        self.settings.MAX_SUBSCRIPTIONS = 2
+        self.settings.MAX_CHANNEL_LENGTH = 10
+        self.settings.MAX_CHANNELS = 3
+        self.cm = ConnectionManager(self.settings, logger)
+
+    def _connect(self):
+        handler = Handler()
+        handler.write_message = Mock()
+        handler.close = Mock()
+        self.cm.on_open(handler)
+        return handler
+
+    def _subscribe(self, handler, channel):
+        self.cm.on_message(handler, json.dumps({
+            "type": "subscribe",
+            "channel": channel
+        }))
+
+    def _rejected(self, handler):
+        return [
+            json.loads(call[0][0])["reason"]
+            for call in handler.write_message.call_args_list
+        ]
+
+    def test_message_size(self):
+        handler = self._connect()
+        with patch("json.loads") as loads:
+            self.cm.on_message(handler, json.dumps({
+                "type": "publish",
+                "channel": "test",
+                "data": "x" * 100
+            }))
+            self.assertFalse(loads.called)
+
+        handler.close.assert_called_once_with(1009, "Message too big")
+        self.assertEqual(self.cm.stats["message_too_big"], 1)
+
+    def test_invalid_packet(self):
+        handler = self._connect()
+        self.cm.on_message(handler, "[1, 2, 3]")
+        handler.close.assert_called_once_with(1002, "Invalid message")
+
+        handler = self._connect()
+        self._subscribe(handler, ["test"])
+        handler.close.assert_called_once_with(1002, "Invalid channel")
+
+    def test_channel_length(self):
+        handler = self._connect()
+        self._subscribe(handler, "x" * 10)
+        self.assertFalse(handler.close.called)
+
+        self._subscribe(handler, "x" * 11)
+        handler.close.assert_called_once_with(1002, "Invalid channel")
+        self.assertEqual(self.cm.stats["channel_too_long"], 1)
+
+    def test_subscriptions(self):
+        handler = self._connect()
+        for channel in ("a", "b", "c"):
+            self._subscribe(handler, channel)
+
+        self.assertEqual(
+            sorted(self.cm.connections[handler].subscriptions),
+            ["a", "b"]
+        )
+        self.assertEqual(self._rejected(handler), ["Too many subscriptions"])
+        self.assertEqual(self.cm.stats["too_many_subscriptions"], 1)
+
+        # Subscribing again is fine
+        self._subscribe(handler, "a")
+        self.assertEqual(self.cm.stats["too_many_subscriptions"], 1)
+
+    def test_channels(self):
+        self.settings.MAX_SUBSCRIPTIONS = 0
+        first = self._connect()
+        second = self._connect()
+        for channel in ("a", "b"):
+            self._subscribe(first, channel)
+        for channel in ("b", "c", "d"):
+            self._subscribe(second, channel)
+
+        self.assertEqual(sorted(self.cm.channel_subscribers), ["a", "b", "c"])
+        self.assertEqual(self._rejected(second), ["Too many channels"])
+        self.assertEqual(self.cm.stats["too_many_channels"], 1)
+
+
+class TestMessageSize(AsyncHTTPTestCase):
+    def get_app(self):
+        settings = Settings()
+        settings.MAX_MESSAGE_BYTES = 100
+        return Server(settings, logger).app
+
+    @gen_test
+    def test_message_size(self):
+        url = "ws://127.0.0.1:{}/".format(self.get_http_port())
+        connection = yield websocket_connect(url)
+        connection.write_message("x" * 101)
+
+        self.assertEqual((yield connection.read_message()), None)
+        self.assertEqual(connection.close_code, 1009)
+
+
+class TestLogicalSessions(TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.AUTHORIZATION_MANAGER = \
+            "wspsserver.auth:SettingsAuthManager"
+        self.settings.SUBSCRIBE_KEYS = {"private": "key123"}
+        self.cm = ConnectionManager(self.settings, logger)
+
+        self.gateway = Handler()
+        self.gateway.write_message = Mock()
+        self.gateway.close = Mock()
+        self.cm.on_open(self.gateway)
+
+        self.publisher = Handler()
+        self.cm.on_open(self.publisher)
+
+    def _send(self, session, packet_type, channel=None, **fields):
+        packet = {"type": packet_type, "session": session}
+        if channel is not None:
+            packet["channel"] = channel
+        packet.update(fields)
+        self.cm.on_message(self.gateway, json.dumps(packet))
+
+    def _publish(self, channel, data):
+        self.cm._message(self.publisher, channel, {
+            "type": "publish",
+            "channel": channel,
+            "data": data
+        }, None)
+
+    def _written(self):
+        return [
+            json.loads(call[0][0])
+            for call in self.gateway.write_message.call_args_list
+        ]
+
+    def test_delivery(self):
+        self._send("a", "subscribe", "test")
+        self._send("b", "subscribe", "test")
+        self._send(3, "subscribe", "other")
+
+        self.assertEqual(self.cm.channel_subscribers["test"], [self.gateway])
+        self.assertEqual(self.cm.get_subscriber_count("test"), 1)
+
+        self._publish("test", "hello")
+        self._publish("other", "world")
+
+        first, second = self._written()
+        self.assertEqual(first["data"], "hello")
+        self.assertEqual(sorted(first["sessions"]), ["a", "b"])
+        self.assertEqual(second["data"], "world")
+        self.assertEqual(second["sessions"], [3])
+
+    def test_publish(self):
+        self._send("a", "subscribe", "test")
+        self._send("b", "publish", "test", data="hello")
+
+        packet, = self._written()
+        self.assertFalse("session" in packet)
+        self.assertEqual(packet["sessions"], ["a"])
+
+    def test_auth(self):
+        self._send("a", "subscribe", "private", key="key123")
+        self._send("b", "auth", key="key123")
+        self._send("b", "subscribe", "private")
+        self._send("c", "subscribe", "private")
+
+        self.assertFalse(self.gateway.close.called)
+        self.assertEqual(self._written(), [{
+            "type": "end",
+            "session": "c",
+            "reason": "Authorization failed"
+        }])
+        self.assertEqual(
+            sorted(self.cm.connections[self.gateway].sessions),
+            ["a", "b"]
+        )
+
+        self._publish("private", "secret")
+        self.assertEqual(sorted(self._written()[1]["sessions"]), ["a", "b"])
+
+    def test_replies(self):
+        self._send("a", "subscribe", "test")
+        self._send("b", "presence", "test")
+        self.assertEqual(self._written(), [{
+            "type": "presence",
+            "channel": "test",
+            "count": 1,
+            "session": "b"
+        }])
+
+    def test_end(self):
+        self._send("a", "subscribe", "test")
+        self._send("b", "subscribe", "test")
+
+        self._send("a", "end")
+        self._publish("test", "hello")
+        self.assertEqual(self._written()[0]["sessions"], ["b"])
+
+        self._send("b", "end")
+        self.assertEqual(self.cm.channel_subscribers["test"], [])
+        self.assertEqual(self.cm.connections[self.gateway].sessions, {})
+        self.assertEqual(self.cm.stats["sessions_ended"], 2)
+
+    def test_gateway_subscription(self):
+        self.cm._subscribe(self.gateway, "test", None)
+        self._send("a", "subscribe", "test")
+        self.assertEqual(self.cm.channel_subscribers["test"], [self.gateway])
+
+        self._send("a", "end")
+        self.assertEqual(self.cm.channel_subscribers["test"], [self.gateway])
+
+    def test_close(self):
+        self._send("a", "subscribe", "test")
+        sessions = list(self.cm.connections[self.gateway].sessions.values())
+
+        self.cm.on_close(self.gateway)
+        self.assertEqual(self.cm.channel_subscribers["test"], [])
+        self.assertFalse(sessions[0].active)
+        self.assertEqual(self.cm._gateways, set())
+
+    def test_limits(self):
+        self.settings.MAX_SESSIONS = 2
+        for session in ("a", "b", "c"):
+            self._send(session, "subscribe", "test")
+
+        self.assertEqual(self._written()[0]["reason"], "Too many sessions")
+        self.assertEqual(self.cm.stats["too_many_sessions"], 1)
+
+        self._send("a", "subscribe", "other", filter="data.x")
+        self.assertEqual(
+            self._written()[1]["reason"],
+            "Filters are not supported for sessions"
+        )
+
+        self._send(["a"], "subscribe", "test")
+        self.gateway.close.assert_called_once_with(1002, "Invalid session")
+
+
+class TestLocalAPI(TestCase):
+    def setUp(self):
+        self.settings = Settings()
+        self.cm = ConnectionManager(self.settings, logger)
+
+        self.subscriber = Handler()
+        self.subscriber.write_message = Mock()
+        self.cm.on_open(self.subscriber)
+        self.cm._subscribe(self.subscriber, "test", None)
+
+    def test_publish(self):
+        with patch("wspsserver.server.json.dumps", wraps=json.dumps) as dumps:
+            self.cm.publish("test", {"foo": "bar"}, priority=2)
+
+        dumps.assert_called_once_with(
+            {"type": "message", "channel": "test", "data": {"foo": "bar"}}
+        )
+        self.assertEqual(
+            json.loads(self.subscriber.write_message.call_args[0][0]),
+            {"type": "message", "channel": "test", "data": {"foo": "bar"}}
+        )
+        self.assertEqual(self.cm.stats["local_published"], 1)
+
+        self.assertRaises(ValueError, self.cm.publish, 123, "foo")
+
+    def test_subscribe(self):
+        received = []
+        self.cm.subscribe("test", received.append)
+        self.cm.subscribe("other", received.append)
+
+        # Client and in-process publishes both reach the callbacks, parsed
+        # only if they came from another shard
+        publisher = Handler()
+        self.cm.on_open(publisher)
+        with patch("wspsserver.server._parse_message") as parse:
+            self.cm._message(publisher, "test", {
+                "type": "publish",
+                "channel": "test",
+                "data": 1
+            }, None)
+            self.cm.publish("other", 2)
+        parse.assert_not_called()
+
+        self.cm._deliver("test", json.dumps({
+            "type": "message",
+            "channel": "test",
+            "data": 3
+        }))
+
+        self.assertEqual([packet["data"] for packet in received], [1, 2, 3])
+        self.assertEqual(self.subscriber.write_message.call_count, 2)
+
+        self.cm.unsubscribe("test", received.append)
+        self.cm.unsubscribe("test", received.append)
+        self.cm.publish("test", 4)
+        self.assertEqual(len(received), 3)
+        self.assertEqual(list(self.cm.local_subscribers), ["other"])
+
+    def test_callback_error(self):
+        received = []
+        failing = Mock(side_effect=RuntimeError("Oops"))
+        self.cm.subscribe("test", failing)
+        self.cm.subscribe("test", received.append)
+
+        self.cm.publish("test", "foo")
+
+        failing.assert_called_once_with(
+            {"type": "message", "channel": "test", "data": "foo"}
+        )
+        self.assertEqual(len(received), 1)
+        self.assertEqual(self.cm.stats["local_subscriber_failed"], 1)
+        self.assertEqual(self.subscriber.write_message.call_count, 1)
+
+    def test_filters(self):
+        self.cm._set_filter(self.subscriber, "test", "data.level > 2")
+
+        with patch("wspsserver.server._parse_message") as parse:
+            self.cm.publish("test", {"level": 1})
+            self.cm.publish("test", {"level": 3})
+        parse.assert_not_called()
+
+        self.assertEqual(self.subscriber.write_message.call_count, 1)
+        self.assertEqual(self.cm.stats["filtered"], 1)
+
+    def test_copied(self):
+        self.settings.DELTA_CHANNELS = {"dash/*": 100}
+        cm = ConnectionManager(self.settings, logger)
+        subscriber = Handler()
+        subscriber.write_message = Mock()
+        cm.on_open(subscriber)
+        cm._subscribe(subscriber, "dash/1", None)
+
+        received = []
+        cm.subscribe("dash/1", received.append)
+
+        state = {"cpu": 0.5, 1: "a", "name": "x" * 100}
+        cm.publish("dash/1", state)
+        state["cpu"] = 0.9
+        cm.publish("dash/1", state)
+
+        packet = json.loads(subscriber.write_message.call_args[0][0])
+        self.assertEqual(packet["type"], "delta")
+        self.assertEqual(
+            packet["patch"], [{"op": "replace", "path": "/cpu", "value": 0.9}]
+        )
+
+        # Callbacks see the same data as socket subscribers
+        self.assertEqual(received[0]["data"]["cpu"], 0.5)
+        self.assertEqual(received[1]["data"]["1"], "a")
+
+        self.assertRaises(TypeError, cm.publish, "dash/1", object())
+
+    def test_server(self):
+        server = Server(self.settings, logger)
+        received = []
+        server.subscribe("test", received.append)
+        server.publish("test", "foo", ttl=10)
+        server.unsubscribe("test", received.append)
+        server.publish("test", "bar")
+
+        self.assertEqual(received, [
+            {"type": "message", "channel": "test", "data": "foo"}
+        ])
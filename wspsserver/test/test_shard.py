@@ -0,0 +1,189 @@
+import json
+
+from mock import Mock
+from tornado import gen
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+from tornado.websocket import websocket_connect
+
+from wspsserver.server import ConnectionManager, Server
+from wspsserver.shard import Shard
+from wspsserver.test.test_server import Settings, Handler, logger
+
+
+class TestPeers(AsyncTestCase):
+    @gen_test
+    def test_receive(self):
+        first = ConnectionManager(Settings(), logger)
+        second = ConnectionManager(Settings(), logger)
+        first.peers = [second]
+        second.peers = [first]
+        first.loop = second.loop = self.io_loop
+
+        publisher = Handler()
+        first.on_open(publisher)
+
+        subscriber = Handler()
+        subscriber.write_message = Mock()
+        second.on_open(subscriber)
+        second._subscribe(subscriber, "test", None)
+
+        self.assertEqual(first.get_total_connections(), 2)
+
+        packet = {"type": "publish", "channel": "test", "data": "foo"}
+        first._message(publisher, "test", packet, None)
+        first._message(publisher, "test", packet, None)
+
+        # Delivered on the IOLoop, not right away
+        subscriber.write_message.assert_not_called()
+        yield gen.moment
+
+        self.assertEqual(subscriber.write_message.call_count, 2)
+        self.assertEqual(
+            json.loads(subscriber.write_message.call_args[0][0]),
+            {"type": "message", "channel": "test", "data": "foo"}
+        )
+
+    @gen_test
+    def test_local_subscribers(self):
+        first = ConnectionManager(Settings(), logger)
+        second = ConnectionManager(Settings(), logger)
+        first.peers = [second]
+        second.peers = [first]
+        first.loop = second.loop = self.io_loop
+
+        received = []
+        first.subscribe("test", received.append)
+        second.publish("test", {"foo": "bar"})
+
+        self.assertEqual(received, [])
+        yield gen.moment
+
+        # The packet is handed over as is, not parsed again
+        self.assertEqual(received, [
+            {"type": "message", "channel": "test", "data": {"foo": "bar"}}
+        ])
+        self.assertEqual(first.stats["local_delivered"], 1)
+
+    def test_presence(self):
+        first = ConnectionManager(Settings(), logger)
+        second = ConnectionManager(Settings(), logger)
+        first.peers = [second]
+        second.peers = [first]
+
+        watcher = Handler()
+        watcher.write_message = Mock()
+        first.on_open(watcher)
+        first._subscribe(watcher, "test", None, True)
+
+        subscriber = Handler()
+        second.on_open(subscriber)
+        second._subscribe(subscriber, "test", None)
+
+        self.assertEqual(first.get_subscriber_count("test"), 2)
+        self.assertEqual(
+            sorted(second.get_subscriber_ids("test")),
+            [first.connections[watcher].id, second.connections[subscriber].id]
+        )
+
+        first._send_presence()
+        packet = json.loads(watcher.write_message.call_args[0][0])
+        self.assertEqual(packet["count"], 2)
+        self.assertEqual(packet["joined"], 1)
+
+
+class TestShard(AsyncTestCase):
+    def setUp(self):
+        super(TestShard, self).setUp()
+
+        settings = Settings()
+        settings.SHARDS = 2
+        settings.DRAIN_SECONDS = 0.5
+        settings.DRAIN_BATCH_SIZE = 2
+        self.server = Server(settings, logger)
+
+        sock, self.port = bind_unused_port()
+        self.server.shards[0].listen([sock])
+        self.shard = self.server.shards[1]
+        self.shard.start([sock], "asyncio")
+        sock.close()
+
+    def tearDown(self):
+        self.server.stop()
+        self.shard.thread.join()
+        super(TestShard, self).tearDown()
+
+    @gen.coroutine
+    def _connect_subscribers(self, count):
+        url = "ws://127.0.0.1:{}/".format(self.port)
+        subscribers = []
+        for _ in range(count):
+            subscriber = yield websocket_connect(url)
+            subscriber.write_message(json.dumps({
+                "type": "subscribe",
+                "channel": "test"
+            }))
+            subscribers.append(subscriber)
+
+        # Wait for every subscription to go through
+        while sum(
+            len(manager.channel_subscribers.get("test", []))
+            for manager in self.server.get_managers()
+        ) < len(subscribers):
+            yield gen.sleep(0.01)
+
+        raise gen.Return(subscribers)
+
+    def test_shared_limits(self):
+        rate_limiter = self.server.manager.rate_limiter
+        admission = self.server.manager.admission
+
+        self.assertIs(
+            self.shard.manager.rate_limiter._channel_buckets,
+            rate_limiter._channel_buckets
+        )
+        self.assertIs(self.shard.manager.admission._lock, admission._lock)
+
+    @gen_test
+    def test_drain(self):
+        subscribers = yield self._connect_subscribers(8)
+
+        yield self.server.drain()
+
+        for subscriber in subscribers:
+            message = yield subscriber.read_message()
+            packet = json.loads(message)
+            self.assertEqual(packet["type"], "reconnect")
+            self.assertTrue(0 <= packet["delay"] <= 30)
+
+            message = yield subscriber.read_message()
+            self.assertIsNone(message)
+            self.assertEqual(subscriber.close_code, 1012)
+
+        self.assertEqual(self.server.manager.get_total_connections(), 0)
+
+    @gen_test
+    def test_publish_subscribe(self):
+        self.assertIsInstance(self.shard, Shard)
+        self.assertEqual(self.server.manager.peers, [self.shard.manager])
+        self.assertEqual(self.shard.manager.peers, [self.server.manager])
+
+        subscribers = yield self._connect_subscribers(8)
+
+        url = "ws://127.0.0.1:{}/".format(self.port)
+        publisher = yield websocket_connect(url)
+        publisher.write_message(json.dumps({
+            "type": "publish",
+            "channel": "test",
+            "data": "foo"
+        }))
+
+        for subscriber in subscribers:
+            message = yield subscriber.read_message()
+            self.assertEqual(json.loads(message), {
+                "type": "message",
+                "channel": "test",
+                "data": "foo"
+            })
+            subscriber.close()
+
+        publisher.close()
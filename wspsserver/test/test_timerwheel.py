@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from wspsserver.timerwheel import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    def test_expiry(self):
+        wheel = TimerWheel(1.0, 8, 100.0)
+        wheel.schedule("a", 1)
+        wheel.schedule("b", 2.5)
+        self.assertEqual(len(wheel), 2)
+
+        self.assertEqual(wheel.advance(100.5), [])
+        self.assertEqual(wheel.advance(101.0), ["a"])
+        self.assertEqual(wheel.advance(102.0), [])
+        self.assertEqual(wheel.advance(103.0), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_rounds(self):
+        wheel = TimerWheel(1.0, 4, 100.0)
+        wheel.schedule("a", 4)
+        wheel.schedule("b", 5)
+        wheel.schedule("c", 13)
+
+        self.assertEqual(wheel.advance(103.0), [])
+        self.assertEqual(wheel.advance(104.0), ["a"])
+        self.assertEqual(wheel.advance(105.0), ["b"])
+        self.assertEqual(wheel.advance(112.0), [])
+        self.assertEqual(wheel.advance(113.0), ["c"])
+
+    def test_catch_up(self):
+        wheel = TimerWheel(1.0, 4, 100.0)
+        wheel.schedule("a", 1)
+        wheel.schedule("b", 3)
+        wheel.schedule("c", 10)
+
+        self.assertEqual(sorted(wheel.advance(110.0)), ["a", "b", "c"])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(1.0, 8, 100.0)
+        wheel.schedule("a", 1)
+        wheel.schedule("a", 3)
+        wheel.schedule("b", 1)
+        wheel.cancel("b")
+        wheel.cancel("unknown")
+
+        self.assertIn("a", wheel)
+        self.assertNotIn("b", wheel)
+        self.assertEqual(wheel.advance(102.0), [])
+        self.assertEqual(wheel.advance(103.0), ["a"])
@@ -0,0 +1,83 @@
+class TimerWheel(object):
+    """
+    wspsserver.timerwheel.TimerWheel
+
+    Hashed timer wheel, for keeping track of a large number of timeouts with
+    O(1) scheduling and cancellation, and no per-timer IOLoop callbacks.
+
+    Time is split into ticks, and the wheel has a fixed number of slots. A
+    timer is put into the slot its expiry time falls into, along with the
+    number of full rotations of the wheel left before it expires. Advancing
+    the wheel only has to look at the slots for the ticks that have passed.
+    """
+
+    def __init__(self, tick, slots, now):
+        self.tick = float(tick)
+        self.time = now
+        self._slots = [{} for _ in range(slots)]
+        self._positions = {}
+        self._current = 0
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def schedule(self, key, delay):
+        """
+        Schedule a timer for the key, replacing any existing timer for it
+
+        :param key: Any hashable value, returned by advance() on expiry
+        :param float delay: Seconds until the timer expires, rounded up to
+                            full ticks
+        """
+
+        self.cancel(key)
+
+        ticks = max(1, int(-(-delay // self.tick)))
+        slots = len(self._slots)
+        index = (self._current + ticks) % slots
+
+        self._slots[index][key] = (ticks - 1) // slots
+        self._positions[key] = index
+
+    def cancel(self, key):
+        """
+        Cancel the timer for the key, if there is one
+
+        :param key:
+        """
+
+        index = self._positions.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
+
+    def advance(self, now):
+        """
+        Move the wheel forward to the current time
+
+        :param float now: Current timestamp
+        :return list: Keys for the timers that expired
+        """
+
+        expired = []
+        slots = len(self._slots)
+
+        while self.time + self.tick <= now:
+            self.time += self.tick
+            self._current = (self._current + 1) % slots
+            slot = self._slots[self._current]
+
+            if not slot:
+                continue
+
+            for key, rounds in list(slot.items()):
+                if rounds:
+                    slot[key] = rounds - 1
+                else:
+                    del slot[key]
+                    del self._positions[key]
+                    expired.append(key)
+
+        return expired